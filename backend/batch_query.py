@@ -0,0 +1,277 @@
+# File to answer a file of questions in bulk from the command line, e.g.
+# python -m backend.batch_query testing/chatbot_tests_quality.csv --model llama3.2 --output answers.jsonl
+
+import argparse
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import csv
+import json
+import logging
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from chromadb import Collection
+
+from backend.chatbot import (
+    cache_response,
+    compile_full_response,
+    fit_context,
+    generate_response,
+    get_cached_response,
+    retrieve_broad_context,
+    retrieve_contexts,
+)
+from backend.data_prep import EMBED_BATCH_SIZE, get_collection, get_embedding_function
+from backend.instrumentation import collect_timings
+
+BATCH_SIZE = 256  # Number of questions embedded and retrieved together
+BATCH_WORKERS = 4  # Questions answered concurrently. Set OLLAMA_NUM_PARALLEL on the Ollama server to at least this.
+# Field names read as the question, in order of preference
+QUESTION_FIELDS = ("input", "query", "question")
+
+logger = logging.getLogger(__name__)
+
+
+def read_questions(path: str, field: Optional[str] = None) -> List[str]:
+    """
+    Read questions from a CSV file with a header row, or a JSONL file with one object per line
+
+    Args:
+        path (str): Path of the .csv or .jsonl file
+        field (Optional[str], optional): Column or key holding the question. Defaults to the first of QUESTION_FIELDS present.
+
+    Returns:
+        List[str]: Questions in file order
+    """
+
+    with open(path, "r", newline="", encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+
+    if not rows:
+        return []
+    if field is None:
+        field = next((name for name in QUESTION_FIELDS if name in rows[0]), None)
+    if field is None or field not in rows[0]:
+        raise ValueError(
+            f"No question field found in {path}. Use --field to name the column that holds the questions."
+        )
+
+    return [row[field] for row in rows]
+
+
+def read_answered(path: str) -> Set[int]:
+    """
+    Find the questions already answered in an existing output file
+
+    Args:
+        path (str): Path of the JSONL output file
+
+    Returns:
+        Set[int]: Indices of the answered questions
+    """
+
+    if not os.path.isfile(path):
+        return set()
+
+    answered = set()
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                # An interrupted run may leave a partial last line
+                continue
+            if "error" not in row:
+                answered.add(row["index"])
+
+    return answered
+
+
+def retrieve_batches(
+    questions: List[Tuple[int, str]], index: Collection, batch_size: int = BATCH_SIZE
+) -> Iterator[Tuple[int, str, dict]]:
+    """
+    Embed and retrieve context for the questions in batches. Broad questions about whole documents are answered from
+    the summary index.
+
+    Args:
+        questions (List[Tuple[int, str]]): Question indices and questions
+        index (Collection): Chunked and embedded text to retrieve from
+        batch_size (int, optional): Number of questions per batch. Defaults to BATCH_SIZE.
+
+    Yields:
+        Tuple[int, str, dict]: Question index, question, and its retrieved context
+    """
+
+    embedding_function = get_embedding_function()
+    for start in range(0, len(questions), batch_size):
+        batch = questions[start : start + batch_size]
+        contexts = {i: retrieve_broad_context(query=question) for i, question in batch}
+        remaining = [(i, question) for i, question in batch if contexts[i] is None]
+        queries = [question for _, question in remaining]
+        embeddings = []
+        for embed_start in range(0, len(queries), EMBED_BATCH_SIZE):
+            embeddings.extend(
+                embedding_function(
+                    queries[embed_start : embed_start + EMBED_BATCH_SIZE]
+                )
+            )
+        if queries:
+            for (i, _), context in zip(
+                remaining,
+                retrieve_contexts(
+                    queries=queries, index=index, query_embeddings=embeddings
+                ),
+            ):
+                contexts[i] = context
+        for i, question in batch:
+            yield i, question, contexts[i]
+
+
+def answer_question(i: int, question: str, context: dict, model: str) -> Dict:
+    """
+    Generate the answer to a single question from its retrieved context
+
+    Args:
+        i (int): Question index
+        question (str): The question
+        context (dict): Retrieved context for the question
+        model (str): The LLM to use to generate the response
+
+    Returns:
+        Dict: Output row with "index", "query", "response", "sources", "cache_hit", and "timings"
+    """
+
+    history = [{"role": "user", "content": question}]
+    with collect_timings() as timings:
+        context = fit_context(context=context, model=model, history=history)
+        response = get_cached_response(
+            model=model, retrieval_query=question, context=context
+        )
+        cache_hit = response is not None
+        if not cache_hit:
+            response, _ = generate_response(
+                context=context, model=model, history=history
+            )
+            cache_response(
+                model=model,
+                retrieval_query=question,
+                context=context,
+                response=response,
+            )
+        output = compile_full_response(context=context, response=response)
+
+    return {
+        "index": i,
+        "query": question,
+        **output,
+        "cache_hit": cache_hit,
+        "timings": timings.to_rows(),
+    }
+
+
+def run_batch(
+    questions: List[str],
+    output_path: str,
+    model: str,
+    workers: int = BATCH_WORKERS,
+    resume: bool = False,
+) -> int:
+    """
+    Answer all questions and append one JSON line per answer to the output file as soon as it is generated.
+    Lines are written in completion order; the "index" field is the question's position in the input file.
+
+    Args:
+        questions (List[str]): Questions to answer
+        output_path (str): Path of the JSONL output file
+        model (str): The LLM to use to generate the responses
+        workers (int, optional): Number of questions answered concurrently. Defaults to BATCH_WORKERS.
+        resume (bool, optional): Skip questions already answered in the output file. Defaults to False.
+
+    Returns:
+        int: Number of questions that failed
+    """
+
+    answered = read_answered(path=output_path) if resume else set()
+    pending = [(i, q) for i, q in enumerate(questions) if i not in answered]
+    logger.info(
+        f"Answering {len(pending)} questions ({len(answered)} already answered) with {workers} workers"
+    )
+
+    index = get_collection()
+    num_done = 0
+    num_failed = 0
+    start = time.perf_counter()
+    with open(
+        output_path, "a" if resume else "w", encoding="utf-8"
+    ) as output, ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight: Dict[Future, Tuple[int, str]] = {}
+
+        def write_completed(block: bool) -> None:
+            nonlocal num_done, num_failed
+            done, _ = wait(
+                in_flight, timeout=None if block else 0, return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                i, question = in_flight.pop(future)
+                try:
+                    row = future.result()
+                except Exception as error:
+                    logger.exception(f"Failed to answer question {i}")
+                    row = {"index": i, "query": question, "error": str(error)}
+                    num_failed += 1
+                output.write(json.dumps(row) + "\n")
+                output.flush()
+                num_done += 1
+            if done:
+                elapsed = time.perf_counter() - start
+                logger.info(
+                    f"Answered {num_done} of {len(pending)} questions ({num_done / elapsed:.2f} per second)"
+                )
+
+        for i, question, context in retrieve_batches(questions=pending, index=index):
+            # Keep a few questions per worker queued, so retrieval doesn't run far ahead of generation
+            while len(in_flight) >= workers * 2:
+                write_completed(block=True)
+            future = executor.submit(
+                answer_question, i=i, question=question, context=context, model=model
+            )
+            in_flight[future] = (i, question)
+        while in_flight:
+            write_completed(block=True)
+
+    return num_failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Answer a CSV or JSONL file of questions with the chatbot and write the answers as JSONL"
+    )
+    parser.add_argument("questions", help="CSV file with a header row, or JSONL file")
+    parser.add_argument("--model", required=True, help="Ollama model name")
+    parser.add_argument("--output", default="answers.jsonl", help="JSONL output file")
+    parser.add_argument(
+        "--field",
+        help=f"Column or key with the questions. Defaults to the first of {', '.join(QUESTION_FIELDS)}",
+    )
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Append to the output file and skip questions already answered in it",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    num_failed = run_batch(
+        questions=read_questions(path=args.questions, field=args.field),
+        output_path=args.output,
+        model=args.model,
+        workers=args.workers,
+        resume=args.resume,
+    )
+    if num_failed:
+        raise SystemExit(f"{num_failed} questions failed, see {args.output}")
@@ -0,0 +1,238 @@
+# File to fit the chat history into a bounded number of prompt tokens, summarizing turns that no longer fit
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import hashlib
+import logging
+import threading
+from typing import List, Optional
+
+from backend.context_packing import get_context_window
+from backend.data_prep import count_tokens
+from backend.llm_client import chat
+from backend.scheduler import get_scheduler
+
+MAX_HISTORY = 4  # Sets the maximum number of previous messages to include verbatim
+HISTORY_TOKEN_BUDGET = 1024  # Tokens of verbatim messages (including the user query) included in the prompt
+# Older messages are cut to this many tokens. The user query is never cut.
+MAX_MESSAGE_TOKENS = 256
+SUMMARY_WORDS = 150  # Target length of the summary of messages that no longer fit
+SUMMARY_CACHE_SIZE = 256  # Number of conversation summaries kept in memory
+SUMMARY_OPTIONS = {"temperature": 0.0}
+# Scheduler session of the summary requests. Summaries wait for a place on the model like chat responses do.
+SUMMARY_SESSION_ID = "history-summary"
+
+logger = logging.getLogger(__name__)
+
+# Summaries of conversation prefixes, keyed by the hash of the summarized messages
+_summaries: OrderedDict = OrderedDict()
+_summaries_lock = threading.Lock()
+_pending = set()
+# A single thread, so summaries are refreshed one at a time and hold at most one place on the LLM server
+_summary_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="history-summary"
+)
+
+
+@lru_cache(maxsize=1024)
+def message_tokens(content: str) -> int:
+    """
+    Count the tokens of a message. Cached, since the same messages are counted again every turn.
+
+    Args:
+        content (str): Message content
+
+    Returns:
+        int: Number of tokens
+    """
+
+    return count_tokens(text=content)
+
+
+def compact_history(
+    history: List[dict], model: str, budget: int = HISTORY_TOKEN_BUDGET
+) -> List[dict]:
+    """
+    Fit the chat history into a token budget. The most recent messages are kept verbatim, older long messages are cut,
+    and messages that don't fit are replaced by a rolling summary. The summary is refreshed in the background, so a
+    turn uses the most recent summary available and never waits for the LLM to summarize.
+
+    Args:
+        history (List[dict]): Chat history, including the user query as the last message
+        model (str): The LLM used to summarize older messages
+        budget (int, optional): Token budget of the verbatim messages. Defaults to HISTORY_TOKEN_BUDGET.
+
+    Returns:
+        List[dict]: A system message with the summary of older messages (if any), followed by the recent messages
+    """
+
+    verbatim = [{"role": history[-1]["role"], "content": history[-1]["content"]}]
+    used_tokens = message_tokens(content=history[-1]["content"])
+    start = len(history) - 1
+    while start > 0 and len(verbatim) <= MAX_HISTORY:
+        m = history[start - 1]
+        content = truncate(text=m["content"], max_tokens=MAX_MESSAGE_TOKENS)
+        tokens = message_tokens(content=content)
+        if used_tokens + tokens > budget:
+            break
+        verbatim.insert(0, {"role": m["role"], "content": content})
+        used_tokens += tokens
+        start -= 1
+
+    if start == 0:
+        return verbatim
+
+    summary = get_summary(older=history[:start], model=model)
+    if summary is None:
+        return verbatim
+
+    return [
+        {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
+    ] + verbatim
+
+
+def truncate(text: str, max_tokens: int) -> str:
+    """
+    Cut a text to about max_tokens tokens
+
+    Args:
+        text (str): Text to cut
+        max_tokens (int): Maximum number of tokens
+
+    Returns:
+        str: The text, or its beginning followed by "..." if it is longer than max_tokens
+    """
+
+    tokens = message_tokens(content=text)
+    if tokens <= max_tokens:
+        return text
+
+    # Cut proportionally, tokens are roughly evenly spread over the text
+    return text[: len(text) * max_tokens // tokens].rstrip() + " ..."
+
+
+def prefix_hashes(messages: List[dict]) -> List[str]:
+    """
+    Hash every prefix of a list of messages, so a conversation can be matched to the summary of its longest summarized prefix
+
+    Args:
+        messages (List[dict]): Messages
+
+    Returns:
+        List[str]: Hash of messages[: i + 1] at position i
+    """
+
+    hashes = []
+    digest = ""
+    for m in messages:
+        digest = hashlib.sha256(
+            f"{digest}\x00{m['role']}\x00{m['content']}".encode("utf-8")
+        ).hexdigest()
+        hashes.append(digest)
+
+    return hashes
+
+
+def get_summary(older: List[dict], model: str) -> Optional[str]:
+    """
+    Get the most recent summary of the older messages of a conversation. If it doesn't cover all of them yet,
+    a refresh that adds the remaining messages to it is scheduled in the background.
+
+    Args:
+        older (List[dict]): Messages that don't fit in the prompt verbatim, oldest first
+        model (str): The LLM used to summarize
+
+    Returns:
+        Optional[str]: Summary of the longest summarized prefix of the older messages, or None if there is none yet
+    """
+
+    hashes = prefix_hashes(messages=older)
+    covered, summary = 0, None
+    with _summaries_lock:
+        for i in range(len(hashes) - 1, -1, -1):
+            if hashes[i] in _summaries:
+                _summaries.move_to_end(hashes[i])
+                covered, summary = i + 1, _summaries[hashes[i]]
+                break
+
+        if covered < len(older) and hashes[-1] not in _pending:
+            _pending.add(hashes[-1])
+            _summary_executor.submit(
+                refresh_summary,
+                key=hashes[-1],
+                summary=summary,
+                messages=older[covered:],
+                model=model,
+            )
+
+    return summary
+
+
+def refresh_summary(
+    key: str, summary: Optional[str], messages: List[dict], model: str
+) -> None:
+    """
+    Add messages to a conversation summary with the LLM and store the result. Runs on the summary thread, and waits
+    for a place on the model in the request scheduler, so it never runs beyond the model's concurrency limit.
+
+    Args:
+        key (str): Hash of all messages covered by the new summary
+        summary (Optional[str]): Summary of the messages before the new ones, or None
+        messages (List[dict]): Messages to add to the summary
+        model (str): The LLM used to summarize
+    """
+
+    try:
+        ticket = get_scheduler().submit(session_id=SUMMARY_SESSION_ID, model=model)
+        try:
+            ticket.wait()
+            new_summary = summarize(summary=summary, messages=messages, model=model)
+        finally:
+            ticket.release()
+        with _summaries_lock:
+            _summaries[key] = new_summary
+            while len(_summaries) > SUMMARY_CACHE_SIZE:
+                _summaries.popitem(last=False)
+    except Exception:
+        logger.exception("Failed to summarize the chat history")
+    finally:
+        with _summaries_lock:
+            _pending.discard(key)
+
+
+def summarize(summary: Optional[str], messages: List[dict], model: str) -> str:
+    """
+    Summarize messages with the LLM, continuing an existing summary
+
+    Args:
+        summary (Optional[str]): Existing summary of earlier messages, or None
+        messages (List[dict]): Messages to add to the summary
+        model (str): The LLM used to summarize
+
+    Returns:
+        str: Updated summary
+    """
+
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    message = [
+        {
+            "role": "system",
+            "content": f"Update the summary of a conversation between a user and an assistant with the new messages. \
+                Keep the topics, names, and facts that later questions may refer to. Use at most {SUMMARY_WORDS} words.\
+                Only return the updated summary and no additional text.",
+        },
+        {
+            "role": "user",
+            "content": f"SUMMARY:\n{summary or 'None'}\n\nNEW MESSAGES:\n{transcript}",
+        },
+    ]
+
+    # Same num_ctx as the chat requests, so Ollama doesn't reload the model
+    response = chat(
+        model=model,
+        messages=message,
+        options={**SUMMARY_OPTIONS, "num_ctx": get_context_window(model=model)},
+    )
+
+    return response.message.content.strip()
@@ -1,16 +1,183 @@
 # File to create OpenAI chatbot responses based on user queries
 
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 from datetime import datetime, timezone
-from sqlite3 import Connection
-from typing import List, Tuple
+import logging
+import re
+import time
+from typing import Iterator, List, Optional, Tuple
 
 from chromadb import Collection
-from ollama import Client
+import numpy as np
 
-from backend.data_tracking import add_tracking_entry
+from backend.chat_history import compact_history
+from backend.context_packing import (
+    format_context,
+    get_context_budget,
+    get_context_window,
+    pack_context,
+)
+from backend.data_prep import count_tokens, get_embedding_function, get_index_version
+from backend.data_tracking import (
+    add_stage_timings,
+    add_tracking_entry,
+    TrackingWriter,
+)
+from backend.lexical_index import get_lexical_index
+from backend.instrumentation import (
+    collect_timings,
+    record_llm_metrics,
+    span,
+    timed,
+    Timings,
+)
+from backend.llm_client import chat, chat_stream, MODEL_WARMUP, preload
+from backend.prompts import (
+    DEFAULT_DOCUMENT_TYPE,
+    get_static_prompt,
+    load_corpus_config,
+    render_prompt_part,
+)
+from backend.reranker import RERANK_CANDIDATES, RERANK_RESULTS, RERANKER_ENABLED, rerank
+from backend.response_cache import RESPONSE_CACHE_ENABLED, response_cache
+from backend.summary_index import retrieve_summaries, summaries_enabled
 
 NUM_RESULTS = 5  # Sets the number of chunks to return as context to the LLM
-MAX_HISTORY = 4  # Sets the number of previous messages to include in the history
+# Combine keyword (BM25) and vector search results. Keyword search finds exact terms like gene names and numbers.
+HYBRID_RETRIEVAL = True
+RETRIEVAL_CANDIDATES = (
+    20  # Number of results of each search that are fused into the final NUM_RESULTS
+)
+RRF_K = 60  # Reciprocal rank fusion constant. Larger values give lower ranked results more weight
+COMPLETION_OPTIONS = {"temperature": 0.0, "top_p": 0.5}
+# When to rewrite the user query with the LLM before retrieval. "always", "never", or "auto" (only follow-up questions that depend on the chat history)
+REWRITE_POLICY = "auto"
+# Retrieve with the raw query while the rewrite runs and merge both results, instead of waiting for the rewrite
+PARALLEL_REWRITE = True
+# In "auto" mode, a query is self-contained if prepending the previous user message barely moves its embedding (cosine similarity at or above this)
+SELF_CONTAINED_SIMILARITY = 0.9
+# Words that usually refer back to earlier turns. he/she/her are left out since "her" is part of "HER-2/neu"
+REFERENCE_WORDS = {
+    "it",
+    "its",
+    "this",
+    "that",
+    "these",
+    "those",
+    "they",
+    "them",
+    "their",
+    "above",
+    "previous",
+    "earlier",
+    "more",
+    "else",
+    "again",
+    "same",
+    "other",
+}
+# Words that ask about documents as a whole, e.g. "Summarize this article" or "What are the key takeaways?". Questions
+# with one of them and otherwise only GENERIC_QUERY_WORDS are answered from the summary index.
+BROAD_QUERY_WORDS = {
+    "summarize",
+    "summarise",
+    "summary",
+    "summaries",
+    "overview",
+    "recap",
+    "gist",
+    "about",
+    "takeaway",
+    "takeaways",
+    "highlights",
+    "findings",
+    "conclusion",
+    "conclusions",
+    "points",
+    "ideas",
+    "themes",
+}
+# Words that don't narrow a question down to a topic. The document_type of the corpus is added to them.
+GENERIC_QUERY_WORDS = {
+    "a",
+    "an",
+    "the",
+    "this",
+    "these",
+    "that",
+    "those",
+    "it",
+    "its",
+    "their",
+    "what",
+    "s",
+    "are",
+    "is",
+    "was",
+    "were",
+    "of",
+    "from",
+    "in",
+    "on",
+    "for",
+    "to",
+    "with",
+    "and",
+    "me",
+    "us",
+    "i",
+    "you",
+    "please",
+    "can",
+    "could",
+    "give",
+    "tell",
+    "provide",
+    "write",
+    "list",
+    "describe",
+    "explain",
+    "do",
+    "does",
+    "say",
+    "short",
+    "brief",
+    "briefly",
+    "simple",
+    "plain",
+    "language",
+    "terms",
+    "words",
+    "main",
+    "key",
+    "most",
+    "important",
+    "major",
+    "overall",
+    "whole",
+    "entire",
+    "all",
+    "each",
+    "every",
+    "article",
+    "articles",
+    "document",
+    "documents",
+    "paper",
+    "papers",
+    "pdf",
+    "file",
+    "files",
+    "report",
+    "study",
+    "text",
+}
+
+logger = logging.getLogger(__name__)
+
+# Model warm-ups run in the background, one at a time, so selecting a model never blocks the app
+_warmup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-warmup")
 
 
 def query_chatbot(
@@ -18,8 +185,9 @@ def query_chatbot(
     index: Collection,
     model: str,
     history: List[dict],
-    connection: Connection,
+    connection: TrackingWriter,
     is_test: bool,
+    where: Optional[dict] = None,
 ) -> dict:
     """
     Retrieves context based on the user query and then generates a response.
@@ -29,33 +197,476 @@ def query_chatbot(
         index (Collection): Chunked and embedded text to retrieve from
         model (str): The selected LLM to use for generating the response
         history (List[dict]): History of the chat session
-        connection (sqlite3.Connection): Valid sqlite3 connection for the database
+        connection (TrackingWriter): Background writer for the data tracking database
         is_test (bool): True if test suite is running, False otherwise. This is to avoid saving all test queries in data tracking db
+        where (Optional[dict], optional): Chroma where clause limiting retrieval to some documents or pages, see build_filter(). Defaults to None (all documents).
 
     Returns:
-        dict: The response to the user's query from the model. Dictionary with "response" (str) and "sources" (List[str]).
+        dict: The response to the user's query from the model. Dictionary with "response" (str), "sources" (List[str]), "timings" (List[dict], latency per stage),
+            and "entry_id" (int, id of the tracking entry, only if is_test is False).
     """
-    retrieval_query = update_query(query=query, model=model, history=history)
-    context = retrieve_context(query=retrieval_query, index=index)
-    response, full_query = generate_response(
-        context=context, model=model, history=history
-    )
-    chat_output = compile_full_response(context=context, response=response)
-    if not is_test:
-        time_now = str(datetime.now(timezone.utc))
-        add_tracking_entry(
+    request_start = time.perf_counter()
+    with collect_timings() as timings:
+        retrieval_query, context = route_and_retrieve(
+            query=query, index=index, model=model, history=history, where=where
+        )
+        context = fit_context(context=context, model=model, history=history)
+        cached_response = get_cached_response(
+            model=model, retrieval_query=retrieval_query, context=context
+        )
+        if cached_response is None:
+            response, full_query = generate_response(
+                context=context, model=model, history=history
+            )
+            cache_response(
+                model=model,
+                retrieval_query=retrieval_query,
+                context=context,
+                response=response,
+            )
+        else:
+            response = cached_response
+            full_query = build_response_message(
+                context=context, model=model, history=history
+            )
+        chat_output = compile_full_response(context=context, response=response)
+        timings.add_duration(
+            stage="total", duration_ms=(time.perf_counter() - request_start) * 1000
+        )
+        if not is_test:
+            track_response(
+                connection=connection,
+                user_query=query,
+                retrieval_query=retrieval_query,
+                full_query=full_query,
+                chat_output=chat_output,
+                context=context,
+                model=model,
+                cache_hit=cached_response is not None,
+                timings=timings,
+            )
+        chat_output["timings"] = timings.to_rows()
+
+    return chat_output
+
+
+def query_chatbot_stream(
+    query: str,
+    index: Collection,
+    model: str,
+    history: List[dict],
+    connection: TrackingWriter,
+    is_test: bool,
+    where: Optional[dict] = None,
+) -> Tuple[Iterator[str], dict]:
+    """
+    Streaming version of query_chatbot. Retrieves context based on the user query and then streams the response tokens as they are generated.
+    The returned dict is completed, and the entry is tracked, once the token stream is exhausted.
+
+    Args:
+        query (str): User query from the frontend
+        index (Collection): Chunked and embedded text to retrieve from
+        model (str): The selected LLM to use for generating the response
+        history (List[dict]): History of the chat session
+        connection (TrackingWriter): Background writer for the data tracking database
+        is_test (bool): True if test suite is running, False otherwise. This is to avoid saving all test queries in data tracking db
+        where (Optional[dict], optional): Chroma where clause limiting retrieval to some documents or pages, see build_filter(). Defaults to None (all documents).
+
+    Returns:
+        Tuple[Iterator[str], dict]: Iterator over the response tokens, and the response dictionary with "response" (str, filled in when the stream ends), "sources" (List[str]), and "timings" (List[dict], latency per stage) and "entry_id" (int, id of the tracking entry, only if is_test is False) added when the stream ends.
+    """
+    request_start = time.perf_counter()
+    with collect_timings() as timings:
+        retrieval_query, context = route_and_retrieve(
+            query=query, index=index, model=model, history=history, where=where
+        )
+        context = fit_context(context=context, model=model, history=history)
+        cached_response = get_cached_response(
+            model=model, retrieval_query=retrieval_query, context=context
+        )
+        if cached_response is None:
+            tokens, full_query = generate_response_stream(
+                context=context, model=model, history=history
+            )
+        else:
+            tokens = iter([cached_response])
+            full_query = build_response_message(
+                context=context, model=model, history=history
+            )
+        chat_output = compile_full_response(context=context, response="")
+
+    def token_stream() -> Iterator[str]:
+        # The stream is consumed by the caller after this function returns, so the timings are collected again here
+        with collect_timings(timings=timings):
+            response = []
+            with span(stage="generate_response"):
+                try:
+                    for token in tokens:
+                        if not response:
+                            elapsed = time.perf_counter() - request_start
+                            timings.add_duration(
+                                stage="time_to_first_token", duration_ms=elapsed * 1000
+                            )
+                        response.append(token)
+                        yield token
+                finally:
+                    # Closes the LLM request if the caller stops reading early, e.g. when the request is cancelled
+                    if hasattr(tokens, "close"):
+                        tokens.close()
+
+            chat_output["response"] = "".join(response)
+            if cached_response is None:
+                cache_response(
+                    model=model,
+                    retrieval_query=retrieval_query,
+                    context=context,
+                    response=chat_output["response"],
+                )
+            timings.add_duration(
+                stage="total", duration_ms=(time.perf_counter() - request_start) * 1000
+            )
+            if not is_test:
+                track_response(
+                    connection=connection,
+                    user_query=query,
+                    retrieval_query=retrieval_query,
+                    full_query=full_query,
+                    chat_output=chat_output,
+                    context=context,
+                    model=model,
+                    cache_hit=cached_response is not None,
+                    timings=timings,
+                )
+            chat_output["timings"] = timings.to_rows()
+
+    return token_stream(), chat_output
+
+
+def track_response(
+    connection: TrackingWriter,
+    user_query: str,
+    retrieval_query: str,
+    full_query: List[dict],
+    chat_output: dict,
+    context: Optional[dict] = None,
+    model: Optional[str] = None,
+    cache_hit: bool = False,
+    timings: Optional[Timings] = None,
+) -> None:
+    """
+    Save a completed chatbot response and its stage timings in the data tracking database. The entry id is added to chat_output as "entry_id".
+
+    Args:
+        connection (TrackingWriter): Background writer for the data tracking database
+        user_query (str): User query from the frontend
+        retrieval_query (str): Query used to retrieve context
+        full_query (List[dict]): The full message sent to the LLM
+        chat_output (dict): The response to the user's query with "response" (str) and "sources" (List[str])
+        context (Optional[dict], optional): Context in the full message, its chunks are stored once instead of in every entry. Defaults to None.
+        model (Optional[str], optional): The LLM that generated the response. Defaults to None.
+        cache_hit (bool, optional): True if the response was served from the response cache. Defaults to False.
+        timings (Optional[Timings], optional): Stage timings of the request. Defaults to None.
+    """
+    time_now = str(datetime.now(timezone.utc))
+    with span(stage="track_response"):
+        chat_output["entry_id"] = add_tracking_entry(
             connection=connection,
             query_timestamp=time_now,
-            user_query=query,
+            user_query=user_query,
             retrieval_query=retrieval_query,
             full_query=full_query,
-            llm_response=response,
+            llm_response=chat_output["response"],
             sources=chat_output["sources"],
+            cache_hit=cache_hit,
+            model=model,
+            chunks=(
+                dict(zip(context["ids"][0], context["documents"][0]))
+                if context is not None
+                else None
+            ),
+        )
+    if timings is not None:
+        add_stage_timings(
+            connection=connection,
+            entry_id=chat_output["entry_id"],
+            stages=timings.to_rows(),
         )
 
-    return chat_output
 
+@timed(stage="pack_context")
+def fit_context(context: dict, model: str, history: List[dict]) -> dict:
+    """
+    Pack the retrieved context into the space the prompt instructions and chat history leave in the model's context window
+
+    Args:
+        context (dict): Retrieved context from source documents
+        model (str): The LLM to use to generate the response
+        history (List[dict]): Chat history, including the user query
+
+    Returns:
+        dict: Packed context, deduplicated and merged into passages that fit the token budget
+    """
+
+    empty_context = {
+        "ids": [[]],
+        "documents": [[]],
+        "metadatas": [[]],
+        "distances": [[]],
+    }
+    prompt_tokens = sum(
+        count_tokens(text=m["content"])
+        for m in build_response_message(
+            context=empty_context, model=model, history=history
+        )
+    )
+
+    return pack_context(
+        context=context,
+        budget=get_context_budget(model=model, prompt_tokens=prompt_tokens),
+    )
+
+
+@timed(stage="response_cache")
+def get_cached_response(
+    model: str, retrieval_query: str, context: dict
+) -> Optional[str]:
+    """
+    Look up a previously generated response for the same model, retrieval query, and retrieved chunks
+
+    Args:
+        model (str): The selected LLM
+        retrieval_query (str): Query used to retrieve the context
+        context (dict): Retrieved context from source documents
+
+    Returns:
+        Optional[str]: The cached response, or None if there is none
+    """
+
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+
+    return response_cache.get(
+        model=model,
+        retrieval_query=retrieval_query,
+        chunk_ids=context["ids"][0],
+        index_version=get_index_version(),
+        query_embedding=get_embedding_function()([retrieval_query])[0],
+    )
+
+
+def cache_response(
+    model: str, retrieval_query: str, context: dict, response: str
+) -> None:
+    """
+    Save a generated response in the response cache
+
+    Args:
+        model (str): The selected LLM
+        retrieval_query (str): Query used to retrieve the context
+        context (dict): Retrieved context from source documents
+        response (str): Chat completion from the LLM
+    """
+
+    if not RESPONSE_CACHE_ENABLED:
+        return
 
+    response_cache.put(
+        model=model,
+        retrieval_query=retrieval_query,
+        chunk_ids=context["ids"][0],
+        index_version=get_index_version(),
+        response=response,
+        query_embedding=get_embedding_function()([retrieval_query])[0],
+    )
+
+
+def route_and_retrieve(
+    query: str,
+    index: Collection,
+    model: str,
+    history: List[dict],
+    where: Optional[dict] = None,
+) -> Tuple[str, dict]:
+    """
+    Retrieve context for the user query. Broad questions about whole documents are answered from the summary index,
+    which needs a much shorter prompt than chunks spread over the documents. Other questions, and broad questions
+    without summaries, are answered from the chunks, see rewrite_and_retrieve().
+
+    Args:
+        query (str): User query from the frontend
+        index (Collection): Chunked and embedded text to retrieve from
+        model (str): LLM to use to update the query
+        history (List[dict]): Chat history, including the user query
+        where (Optional[dict], optional): Chroma where clause limiting retrieval. Defaults to None (all documents).
+
+    Returns:
+        Tuple[str, dict]: The query used for retrieval and the retrieved context
+    """
+
+    context = retrieve_broad_context(query=query, where=where)
+    if context is not None:
+        return query, context
+
+    return rewrite_and_retrieve(
+        query=query, index=index, model=model, history=history, where=where
+    )
+
+
+def is_broad_query(query: str) -> bool:
+    """
+    Cheaply decide whether a query asks about the documents as a whole rather than a topic in them
+
+    Args:
+        query (str): User query from frontend
+
+    Returns:
+        bool: True if the query has a BROAD_QUERY_WORDS word and no words that narrow it down to a topic
+    """
+
+    words = re.findall(r"[a-z0-9]+", query.lower())
+    if not BROAD_QUERY_WORDS.intersection(words):
+        return False
+
+    document_type = load_corpus_config().get("document_type", DEFAULT_DOCUMENT_TYPE)
+    generic_words = GENERIC_QUERY_WORDS.union(
+        re.findall(r"[a-z0-9]+", document_type.lower())
+    )
+
+    return all(
+        word in BROAD_QUERY_WORDS or word in generic_words or word.isdigit()
+        for word in words
+    )
+
+
+def retrieve_broad_context(query: str, where: Optional[dict] = None) -> Optional[dict]:
+    """
+    Retrieve the summaries for a broad question about whole documents
+
+    Args:
+        query (str): User query from the frontend
+        where (Optional[dict], optional): Chroma where clause limiting retrieval. Defaults to None (all documents).
+
+    Returns:
+        Optional[dict]: Retrieved summaries, or None if the query isn't broad or there are no summaries for it
+    """
+
+    if not summaries_enabled() or not is_broad_query(query=query):
+        return None
+
+    context = retrieve_summaries(query=query, where=where)
+    if not context["ids"][0]:
+        return None
+
+    return context
+
+
+def rewrite_and_retrieve(
+    query: str,
+    index: Collection,
+    model: str,
+    history: List[dict],
+    where: Optional[dict] = None,
+) -> Tuple[str, dict]:
+    """
+    Rewrite the user query if the REWRITE_POLICY requires it and retrieve context for it. With PARALLEL_REWRITE, context for the
+    raw query is retrieved while the rewrite runs and merged with the context for the rewritten query.
+
+    Args:
+        query (str): User query from the frontend
+        index (Collection): Chunked and embedded text to retrieve from
+        model (str): LLM to use to update the query
+        history (List[dict]): Chat history, including the user query
+        where (Optional[dict], optional): Chroma where clause limiting retrieval. Defaults to None (all documents).
+
+    Returns:
+        Tuple[str, dict]: The query used for retrieval and the retrieved context
+    """
+
+    if not needs_rewrite(query=query, history=history):
+        return query, retrieve_context(query=query, index=index, where=where)
+
+    if not PARALLEL_REWRITE:
+        retrieval_query = update_query(query=query, model=model, history=history)
+        return retrieval_query, retrieve_context(
+            query=retrieval_query, index=index, where=where
+        )
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Run the rewrite in a copy of this context so its timings are collected with the rest of the request
+        future = executor.submit(
+            copy_context().run, update_query, query=query, model=model, history=history
+        )
+        raw_context = retrieve_context(query=query, index=index, where=where)
+        retrieval_query = future.result()
+
+    if retrieval_query.strip().lower() == query.strip().lower():
+        return retrieval_query, raw_context
+
+    context = merge_contexts(
+        contexts=[
+            retrieve_context(query=retrieval_query, index=index, where=where),
+            raw_context,
+        ],
+        n_results=NUM_RESULTS,
+    )
+
+    return retrieval_query, context
+
+
+def needs_rewrite(query: str, history: List[dict]) -> bool:
+    """
+    Decide whether the user query has to be rewritten with the chat history before retrieval, based on REWRITE_POLICY
+
+    Args:
+        query (str): User query from frontend
+        history (List[dict]): Chat history, including the user query
+
+    Returns:
+        bool: True if the query should be rewritten with the LLM
+    """
+
+    if REWRITE_POLICY == "always":
+        return True
+    if REWRITE_POLICY == "never":
+        return False
+
+    previous_queries = [m["content"] for m in history[:-1] if m["role"] == "user"]
+    if not previous_queries:
+        # Nothing in the history can be resolved on the first message
+        return False
+
+    return not is_self_contained(query=query, previous_query=previous_queries[-1])
+
+
+def is_self_contained(query: str, previous_query: str) -> bool:
+    """
+    Cheaply estimate whether a query can be understood without the chat history. Queries with words that refer back to
+    earlier turns are not self-contained. Otherwise the query is self-contained if adding the previous user message to it
+    barely changes its embedding.
+
+    Args:
+        query (str): User query from frontend
+        previous_query (str): The previous user message in the chat history
+
+    Returns:
+        bool: True if the query can be used for retrieval as is
+    """
+
+    words = re.findall(r"[a-z0-9]+", query.lower())
+    if len(words) < 3 or REFERENCE_WORDS.intersection(words):
+        return False
+
+    query_embedding, combined_embedding = get_embedding_function()(
+        [query, f"{previous_query} {query}"]
+    )
+    similarity = np.dot(query_embedding, combined_embedding) / (
+        np.linalg.norm(query_embedding) * np.linalg.norm(combined_embedding)
+    )
+
+    return similarity >= SELF_CONTAINED_SIMILARITY
+
+
+@timed(stage="update_query")
 def update_query(query: str, model: str, history: List[dict]) -> str:
     """
     Update the user query based on the conversation context using the selected LLM
@@ -69,61 +680,204 @@ def update_query(query: str, model: str, history: List[dict]) -> str:
         str: The Gen AI generated response to the user query
     """
 
-    message = [
-        {
-            "role": "system",
-            "content": f"Use the below user query, article abstract, and recent chat history to create an updated user query that will return relevant context \
-                    from the article to answer their question. If the current user query is sufficient, just return the same query.\
-                    BEGIN USER QUERY:\
-                    {query}\
-                    END USER QUERY\
-                    BEGIN ARTICLE ABSTRACT:\
-                    The HER-2/neu oncogene is a member of the erbB-like \
-                    oncogene family, and is related to, but distinct from, the \
-                    epidermal growth factor receptor. This gene has been \
-                    shown to be amplified in human breast cancer cell lines. \
-                    In the current study, alterations of the gene in 189 \
-                    primary human breast cancers were investigated. HER-2/ \
-                    neu was found to be amplified from 2- to greater than 20- \
-                    fold in 30% of the tumors. Correlation of gene amplification \
-                    with several disease parameters was evaluated. Amplification \
-                    of the HER-2/neu gene was a significant predictor \
-                    of both overall survival and time to relapse in \
-                    patients with breast cancer. It retained its significance \
-                    even when adjustments were made for other known \
-                    prognostic factors. Moreover, HER-2/neu amplification \
-                    had greater prognostic value than most currently used \
-                    prognostic factors, incuding hormonal-receptor status, \
-                    in lymph node-positive disease. These data indicate that \
-                    this gene may play a role in the biologic behavior and/or \
-                    pathogenesis of human breast cancer.\
-                    END ARTICLE ABSTRACT\
-                    Only return the updated user query and no additional text, explanation, or thought process.",
-        }
-    ]
+    message = [{"role": "system", "content": get_static_prompt(name="rewrite")}]
 
-    # Add chat history
-    for m in history[-MAX_HISTORY - 1 :]:
-        message.append({"role": m["role"], "content": m["content"]})
+    # Add recent chat history, with a summary of older messages that don't fit
+    message.extend(compact_history(history=history, model=model))
 
     return generate_completion(message=message, model=model)
 
 
-def retrieve_context(query: str, index: Collection) -> dict:
+@timed(stage="retrieve_context")
+def retrieve_context(
+    query: str, index: Collection, where: Optional[dict] = None
+) -> dict:
     """
     Retrieve relevant context from the DB based on the query
 
     Args:
         query (str): The query to return context about
         index (Collection): The collection of embedding text to retrieve context from
+        where (Optional[dict], optional): Chroma where clause limiting retrieval. Defaults to None (all documents).
 
     Returns:
         dict: Retrieved context and metadata
     """
 
-    return index.query(query_texts=[query], n_results=NUM_RESULTS)
+    return retrieve_contexts(queries=[query], index=index, where=where)[0]
+
+
+def build_filter(
+    filenames: Optional[List[str]] = None, pages: Optional[Tuple[int, int]] = None
+) -> Optional[dict]:
+    """
+    Build a where clause that limits retrieval to some documents and pages. It is applied inside the vectorstore and
+    the keyword index, so only matching chunks are searched.
+
+    Args:
+        filenames (Optional[List[str]], optional): Filenames as stored in the chunk metadata. Defaults to None (all documents).
+        pages (Optional[Tuple[int, int]], optional): First and last page number, inclusive. Defaults to None (all pages).
+
+    Returns:
+        Optional[dict]: Chroma where clause, or None if retrieval isn't limited
+    """
+
+    conditions = []
+    if filenames:
+        conditions.append({"filename": {"$in": list(filenames)}})
+    if pages is not None:
+        conditions.append({"page_number": {"$gte": pages[0]}})
+        conditions.append({"page_number": {"$lte": pages[1]}})
+
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+
+    return {"$and": conditions}
+
+
+def retrieve_contexts(
+    queries: List[str],
+    index: Collection,
+    query_embeddings: Optional[List[np.ndarray]] = None,
+    where: Optional[dict] = None,
+) -> List[dict]:
+    """
+    Retrieve relevant context for several queries at once. The vector search for all queries is a single query to the DB.
+
+    Args:
+        queries (List[str]): The queries to return context about
+        index (Collection): The collection of embedding text to retrieve context from
+        query_embeddings (Optional[List[np.ndarray]], optional): Embeddings of the queries. Defaults to embedding them here.
+        where (Optional[dict], optional): Chroma where clause limiting retrieval, applied by both the vector and the
+            keyword search. Defaults to None (all documents).
+
+    Returns:
+        List[dict]: Retrieved context and metadata for each query
+    """
+
+    # With reranking, more candidates are retrieved and the reranker picks the best few of them
+    n_results = RERANK_CANDIDATES if RERANKER_ENABLED else NUM_RESULTS
+    n_candidates = (
+        max(RETRIEVAL_CANDIDATES, n_results) if HYBRID_RETRIEVAL else n_results
+    )
+
+    if query_embeddings is None:
+        query_embeddings = get_embedding_function()(queries)
+    vector_results = index.query(
+        query_embeddings=query_embeddings, n_results=n_candidates, where=where
+    )
+
+    contexts = []
+    for i, query in enumerate(queries):
+        context = {
+            key: [vector_results[key][i]]
+            for key in ("ids", "documents", "metadatas", "distances")
+        }
+        if HYBRID_RETRIEVAL:
+            keyword_results = get_lexical_index().search(
+                query=query, n_results=n_candidates, where=where
+            )
+            context = fuse_results(
+                index=index,
+                vector_results=context,
+                keyword_ids=[chunk_id for chunk_id, _ in keyword_results],
+                n_results=n_results,
+            )
+        if RERANKER_ENABLED:
+            context = rerank(query=query, context=context, n_results=RERANK_RESULTS)
+        contexts.append(context)
+
+    return contexts
+
+
+def fuse_results(
+    index: Collection, vector_results: dict, keyword_ids: List[str], n_results: int
+) -> dict:
+    """
+    Combine vector and keyword search results with reciprocal rank fusion. Each chunk scores 1 / (RRF_K + rank)
+    in every result list it appears in, so chunks ranked well by both searches come first.
+
+    Args:
+        index (Collection): The collection the chunks are stored in
+        vector_results (dict): Vector search results for a single query
+        keyword_ids (List[str]): Chunk ids found by keyword search, best first
+        n_results (int): Number of chunks to return
+
+    Returns:
+        dict: Context with ids, documents, metadatas and distances. The distance is 1 minus the fused score scaled to [0, 1].
+    """
+
+    vector_ids = vector_results["ids"][0]
+    scores = {}
+    for ranking in (vector_ids, keyword_ids):
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1 / (RRF_K + rank)
+    best = sorted(scores, key=lambda chunk_id: scores[chunk_id], reverse=True)
+    best = best[:n_results]
+
+    chunks = {
+        chunk_id: (
+            vector_results["documents"][0][i],
+            vector_results["metadatas"][0][i],
+        )
+        for i, chunk_id in enumerate(vector_ids)
+    }
+    # Chunks only found by keyword search are read from the vectorstore
+    missing = [chunk_id for chunk_id in best if chunk_id not in chunks]
+    if missing:
+        stored = index.get(ids=missing, include=["documents", "metadatas"])
+        for chunk_id, document, metadata in zip(
+            stored["ids"], stored["documents"], stored["metadatas"]
+        ):
+            chunks[chunk_id] = (document, metadata)
+    best = [chunk_id for chunk_id in best if chunk_id in chunks]
+
+    max_score = 2 / (RRF_K + 1)
+
+    return {
+        "ids": [best],
+        "documents": [[chunks[chunk_id][0] for chunk_id in best]],
+        "metadatas": [[chunks[chunk_id][1] for chunk_id in best]],
+        "distances": [[1 - scores[chunk_id] / max_score for chunk_id in best]],
+    }
+
+
+def merge_contexts(contexts: List[dict], n_results: int) -> dict:
+    """
+    Merge the results of several retrievals into one, keeping the closest n_results unique chunks
+
+    Args:
+        contexts (List[dict]): Retrieved contexts, each for a single query
+        n_results (int): Maximum number of chunks in the merged context
+
+    Returns:
+        dict: Merged context with ids, documents, metadatas and distances, sorted by distance
+    """
+
+    best = {}
+    for context in contexts:
+        for i, chunk_id in enumerate(context["ids"][0]):
+            distance = context["distances"][0][i]
+            if chunk_id not in best or distance < best[chunk_id][2]:
+                best[chunk_id] = (
+                    context["documents"][0][i],
+                    context["metadatas"][0][i],
+                    distance,
+                )
+
+    ranked = sorted(best.items(), key=lambda item: item[1][2])[:n_results]
 
+    return {
+        "ids": [[chunk_id for chunk_id, _ in ranked]],
+        "documents": [[chunk[0] for _, chunk in ranked]],
+        "metadatas": [[chunk[1] for _, chunk in ranked]],
+        "distances": [[chunk[2] for _, chunk in ranked]],
+    }
 
+
+@timed(stage="generate_response")
 def generate_response(
     context: dict, model: str, history: List[dict]
 ) -> Tuple[str, str]:
@@ -139,45 +893,100 @@ def generate_response(
         Tuple[str, str]: The Gen AI generated response to the user query and the full query sent to the LLM
     """
 
+    message = build_response_message(context=context, model=model, history=history)
+
+    return generate_completion(message=message, model=model), message
+
+
+def generate_response_stream(
+    context: dict, model: str, history: List[dict]
+) -> Tuple[Iterator[str], List[dict]]:
+    """
+    Stream the response to the user query based on the supplied context, history, and user query.
+
+    Args:
+        context (dict): Retrieved context from source documents
+        model (str): The LLM to use to generate the response
+        history (List[dict]): Chat history, including the user query
+
+    Returns:
+        Tuple[Iterator[str], List[dict]]: Iterator over the generated response tokens and the full query sent to the LLM
+    """
+
+    message = build_response_message(context=context, model=model, history=history)
+
+    return generate_completion_stream(message=message, model=model), message
+
+
+def build_response_message(
+    context: dict, model: str, history: List[dict]
+) -> List[dict]:
+    """
+    Build the message sent to the LLM to answer the user query from the retrieved context and chat history.
+
+    Args:
+        context (dict): Retrieved context from source documents
+        model (str): The LLM to use to generate the response
+        history (List[dict]): Chat history, including the user query
+
+    Returns:
+        List[dict]: Static system prompt, the context passages, and the recent chat history
+    """
+
+    # Static instructions and abstract first, so the prefix of the prompt is the same for every request
     message = [
+        {"role": "system", "content": get_static_prompt(name="response")},
         {
             "role": "system",
-            "content": f"You are an assistant that answers user questions based only on the supplied context and the article abstract. \
-                Only answer using information in the following context and abstract.\
-                BEGIN CONTEXT:\
-                {context['documents']}\
-                END CONTEXT\
-                BEGIN ABSTRACT:\
-                The HER-2/neu oncogene is a member of the erbB-like \
-                oncogene family, and is related to, but distinct from, the \
-                epidermal growth factor receptor. This gene has been \
-                shown to be amplified in human breast cancer cell lines. \
-                In the current study, alterations of the gene in 189 \
-                primary human breast cancers were investigated. HER-2/ \
-                neu was found to be amplified from 2- to greater than 20- \
-                fold in 30% of the tumors. Correlation of gene amplification \
-                with several disease parameters was evaluated. Amplification \
-                of the HER-2/neu gene was a significant predictor \
-                of both overall survival and time to relapse in \
-                patients with breast cancer. It retained its significance \
-                even when adjustments were made for other known \
-                prognostic factors. Moreover, HER-2/neu amplification \
-                had greater prognostic value than most currently used \
-                prognostic factors, incuding hormonal-receptor status, \
-                in lymph node-positive disease. These data indicate that \
-                this gene may play a role in the biologic behavior and/or \
-                pathogenesis of human breast cancer.\
-                END ABSTRACT\
-                If the context and abstract don't have the information needed to answer the question, just answer with 'I don't know the answer.' and no other text.\
-                Only include your answer and no additional reasoning or thought process.",
-        }
+            "content": render_prompt_part(
+                name="response", part="context", context=format_context(context=context)
+            ),
+        },
     ]
 
-    # Add chat history
-    for m in history[-MAX_HISTORY - 1 :]:
-        message.append({"role": m["role"], "content": m["content"]})
+    # Add recent chat history, with a summary of older messages that don't fit
+    message.extend(compact_history(history=history, model=model))
 
-    return generate_completion(message=message, model=model), message
+    return message
+
+
+def get_options(model: str) -> dict:
+    """
+    Get the completion options for a model. The context window is always the same for a model, since Ollama
+    reloads the model whenever num_ctx changes.
+
+    Args:
+        model (str): The model name to use for completion
+
+    Returns:
+        dict: Ollama model options
+    """
+
+    return {**COMPLETION_OPTIONS, "num_ctx": get_context_window(model=model)}
+
+
+def warm_up_model(model: str) -> None:
+    """
+    Load the model in Ollama in the background, with the options later requests use, so the first response doesn't
+    wait for the model to load. Does nothing if MODEL_WARMUP is off. Failures are only logged, since the first
+    request loads the model anyway. Not sent through the request scheduler, since it generates nothing and waiting
+    behind running responses would only delay the load.
+
+    Args:
+        model (str): The model name to load
+    """
+
+    if not MODEL_WARMUP:
+        return
+
+    def warm_up():
+        try:
+            preload(model=model, options=get_options(model=model))
+            logger.info(f"Loaded model {model}")
+        except Exception as error:
+            logger.warning(f"Could not preload model {model}: {error}")
+
+    _warmup_executor.submit(warm_up)
 
 
 def generate_completion(message: List[dict], model: str) -> str:
@@ -192,14 +1001,37 @@ def generate_completion(message: List[dict], model: str) -> str:
         str: Chat completion output message
     """
 
-    client = Client(host="http://host.docker.internal:11434")
-    response = client.chat(
-        model=model, messages=message, options={"temperature": 0.0, "top_p": 0.5}
-    )
+    response = chat(model=model, messages=message, options=get_options(model=model))
+    record_llm_metrics(response=response)
 
     return response.message.content
 
 
+def generate_completion_stream(message: List[dict], model: str) -> Iterator[str]:
+    """
+    Stream the chat completion for the input message
+
+    Args:
+        message (List[dict]): Input message with relevant history and/or context
+        model (str): The model name to use for completion
+
+    Yields:
+        str: Chat completion output tokens as they are generated
+    """
+
+    stream = chat_stream(
+        model=model, messages=message, options=get_options(model=model)
+    )
+
+    try:
+        for chunk in stream:
+            if chunk.done:
+                record_llm_metrics(response=chunk)
+            yield chunk.message.content
+    finally:
+        stream.close()
+
+
 def compile_full_response(context: dict, response: str) -> dict:
     """
     Compile the full response with sources
@@ -218,6 +1050,12 @@ def compile_full_response(context: dict, response: str) -> dict:
         filename = (context["metadatas"][0][i]["filename"]).split("/")[-1]
         page = context["metadatas"][0][i]["page_number"]
         score = round(context["distances"][0][i], 3)
-        sources.append(f"{filename} page {page}.")
+        level = context["metadatas"][0][i].get("level")
+        if level == "document":
+            sources.append(f"{filename} summary.")
+        elif level == "page":
+            sources.append(f"{filename} page {page} summary.")
+        else:
+            sources.append(f"{filename} page {page}.")
 
     return {"sources": sources, "response": response}
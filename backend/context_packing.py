@@ -0,0 +1,195 @@
+# File to pack retrieved chunks into the LLM prompt within the token budget of the selected model
+
+from typing import Dict
+
+from backend.data_prep import count_tokens
+
+# Ollama's context window (num_ctx) for models not listed in MODEL_CONTEXT_WINDOWS. Prompts longer than this are truncated.
+DEFAULT_CONTEXT_WINDOW = 4096
+# Context window per model, e.g. {"phi4": 8192}. Matched on the full model name first and then on the name without the tag.
+# Larger windows fit more context but use more memory in Ollama.
+MODEL_CONTEXT_WINDOWS: Dict[str, int] = {}
+RESPONSE_TOKEN_RESERVE = 512  # Tokens of the context window kept free for the response
+# Context always gets at least this many tokens, even with a long chat history
+MIN_CONTEXT_TOKENS = 256
+MIN_OVERLAP_CHARS = 20  # Shortest text overlap between adjacent chunks that is merged rather than concatenated
+
+
+def get_context_window(model: str) -> int:
+    """
+    Look up the context window used for a model
+
+    Args:
+        model (str): The model name, e.g. "llama3.2" or "llama3.2:1b"
+
+    Returns:
+        int: Context window in tokens, passed to Ollama as num_ctx
+    """
+
+    if model in MODEL_CONTEXT_WINDOWS:
+        return MODEL_CONTEXT_WINDOWS[model]
+
+    return MODEL_CONTEXT_WINDOWS.get(model.split(":")[0], DEFAULT_CONTEXT_WINDOW)
+
+
+def get_context_budget(model: str, prompt_tokens: int) -> int:
+    """
+    Compute how many tokens of retrieved context fit in the prompt
+
+    Args:
+        model (str): The model name
+        prompt_tokens (int): Tokens of the rest of the prompt (instructions and chat history)
+
+    Returns:
+        int: Token budget for the retrieved context
+    """
+
+    budget = get_context_window(model=model) - RESPONSE_TOKEN_RESERVE - prompt_tokens
+
+    return max(budget, MIN_CONTEXT_TOKENS)
+
+
+def pack_context(context: dict, budget: int) -> dict:
+    """
+    Pack the retrieved chunks into as few, non-overlapping passages as possible and keep the most relevant passages
+    that fit in the token budget. Duplicate chunks are dropped, and adjacent chunks of the same page are merged into one
+    passage without repeating their overlap. Passages are ordered by their most relevant chunk.
+
+    Args:
+        context (dict): Retrieved context with ids, documents, metadatas and distances for a single query
+        budget (int): Maximum number of tokens of the packed passages
+
+    Returns:
+        dict: Packed context in the same format, one entry per passage. Ids of merged chunks are joined with "+".
+    """
+
+    chunks = sorted(
+        zip(
+            context["ids"][0],
+            context["documents"][0],
+            context["metadatas"][0],
+            context["distances"][0],
+        ),
+        key=lambda chunk: chunk[3],
+    )
+
+    # Drop chunks whose text is already part of a more relevant chunk
+    unique = []
+    for chunk in chunks:
+        text = " ".join(chunk[1].split())
+        if not any(text in " ".join(kept[1].split()) for kept in unique):
+            unique.append(chunk)
+
+    # Runs of consecutive chunks of the same page become one passage
+    unique.sort(
+        key=lambda chunk: (
+            chunk[2]["filename"],
+            chunk[2]["page_number"],
+            chunk[2].get("chunk_number", 0),
+        )
+    )
+    passages = []
+    for chunk_id, document, metadata, distance in unique:
+        if passages and is_adjacent(
+            metadata=passages[-1]["metadatas"][-1], other=metadata
+        ):
+            passage = passages[-1]
+            passage["distance"] = min(passage["distance"], distance)
+        else:
+            passage = {
+                "ids": [],
+                "documents": [],
+                "metadatas": [],
+                "distance": distance,
+            }
+            passages.append(passage)
+        passage["ids"].append(chunk_id)
+        passage["documents"].append(document)
+        passage["metadatas"].append(metadata)
+    passages.sort(key=lambda passage: passage["distance"])
+
+    packed = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+    used_tokens = 0
+    for passage in passages:
+        text = passage["documents"][0]
+        for document in passage["documents"][1:]:
+            text = merge_overlapping(text=text, next_text=document)
+        tokens = count_tokens(text=text)
+        if used_tokens + tokens > budget:
+            continue
+        used_tokens += tokens
+        packed["ids"].append("+".join(passage["ids"]))
+        packed["documents"].append(text)
+        packed["metadatas"].append(passage["metadatas"][0])
+        packed["distances"].append(passage["distance"])
+
+    return {key: [values] for key, values in packed.items()}
+
+
+def is_adjacent(metadata: dict, other: dict) -> bool:
+    """
+    Check whether a chunk directly follows another chunk on the same page
+
+    Args:
+        metadata (dict): Metadata (filename, page_number, chunk_number) of the first chunk
+        other (dict): Metadata of the chunk that may follow it
+
+    Returns:
+        bool: True if other is the next chunk after metadata
+    """
+
+    return (
+        metadata["filename"] == other["filename"]
+        and metadata["page_number"] == other["page_number"]
+        and metadata.get("chunk_number", -2) + 1 == other.get("chunk_number", -1)
+    )
+
+
+def merge_overlapping(text: str, next_text: str) -> str:
+    """
+    Join two consecutive chunks, removing the text they share because of the chunk overlap
+
+    Args:
+        text (str): Earlier chunk
+        next_text (str): Following chunk
+
+    Returns:
+        str: Combined text
+    """
+
+    probe = next_text[:MIN_OVERLAP_CHARS]
+    start = text.find(probe)
+    while start != -1 and len(probe) == MIN_OVERLAP_CHARS:
+        if next_text.startswith(text[start:]):
+            return text[:start] + next_text
+        start = text.find(probe, start + 1)
+
+    return f"{text} {next_text}"
+
+
+def format_context(context: dict) -> str:
+    """
+    Format packed context as numbered passages with their source labels
+
+    Args:
+        context (dict): Packed context (see pack_context)
+
+    Returns:
+        str: Passages separated by blank lines, each starting with "[n] filename, page p", or with "[n] filename,
+            summary of page p" or "[n] filename, summary of the whole document" for summaries
+    """
+
+    passages = []
+    for i, (document, metadata) in enumerate(
+        zip(context["documents"][0], context["metadatas"][0]), start=1
+    ):
+        filename = metadata["filename"].split("/")[-1]
+        if metadata.get("level") == "document":
+            label = "summary of the whole document"
+        elif metadata.get("level") == "page":
+            label = f"summary of page {metadata['page_number']}"
+        else:
+            label = f"page {metadata['page_number']}"
+        passages.append(f"[{i}] {filename}, {label}\n{document.strip()}")
+
+    return "\n\n".join(passages)
@@ -2,7 +2,8 @@
 
 from typing import Dict, Any
 
-from chatbot import generate_completion
+# Import through the backend package (on PYTHONPATH) so the test and evaluation providers share the Ollama client
+from backend.chatbot import generate_completion
 
 LOCAL_EVAL_MODEL = "phi4"  # Not recommended to go below 14B parameter model
 
@@ -2,8 +2,9 @@
 
 from typing import Dict, Any
 
-from chatbot import query_chatbot
-from data_prep import prepare_data
+# Import through the backend package (on PYTHONPATH) so every module shares the same collection and Ollama client
+from backend.chatbot import query_chatbot
+from backend.data_prep import get_collection
 
 LOCAL_TESTING_MODEL = "llama3.2"  # Change this model name to whichever model you want to test, the name should match the named used in the ollama pull command
 
@@ -21,7 +22,8 @@ def call_api(prompt: str, options: Dict[str, Any], context: Dict[str, Any]) -> d
         dict: Model response
     """
 
-    index = prepare_data()
+    # Ingested on the first test case only, later test cases reuse the collection
+    index = get_collection()
 
     response = query_chatbot(
         query=prompt,
@@ -1,59 +1,430 @@
 # File to handle all data ingestion, chunking, embedding, and storage
 
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import contextmanager
+import fcntl
+from functools import lru_cache
 import glob
-from typing import List, Tuple
+import hashlib
+import json
+import logging
+import multiprocessing
+import re
+import threading
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TYPE_CHECKING,
+    Union,
+)
 import os
 
 import chromadb
+from chromadb.api.types import EmbeddingFunction
+from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
 from PyPDF2 import PdfReader
-import semchunk
-from transformers import AutoTokenizer
+
+from backend.embedding_cache import (
+    CachedEmbeddingFunction,
+    EmbeddingCache,
+    EMBEDDING_CACHE_DIR,
+)
+from backend.lexical_index import get_lexical_index, LexicalIndex
+from backend.sharding import ShardedCollection
+
+if TYPE_CHECKING:
+    # transformers takes seconds to import, so it is only imported once the tokenizer is needed
+    from transformers import PreTrainedTokenizerBase
 
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 20
+CHROMADB_PATH = "./data/chromadb/"
+MANIFEST_PATH = "./data/chromadb/manifest.json"  # Per-file content hashes of everything stored in the vectorstore
+# Processes used to extract and chunk PDFs. Set to 1 to ingest in the main process
+INGEST_WORKERS = os.cpu_count() or 1
+INGEST_BATCH_SIZE = 256  # Number of chunks streamed into the vectorstore at a time
+PAGES_PER_TASK = 20  # Large PDFs are split into page ranges of this size so they can be processed in parallel
+INSERT_BATCH_SIZE = 128  # Number of chunks written to the vectorstore per write
+# Number of texts embedded per call to the embedding model
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "32"))
+# Embedding function of the vectorstore. "default" is Chroma's float32 ONNX MiniLM. "onnx-int8" is an int8 quantized
+# MiniLM that embeds several times faster on CPU, with slightly different vectors. Changing it re-embeds every chunk.
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "default")
+# Name of the model behind each embedding backend, stored in the collection metadata and used for the embedding cache
+EMBEDDING_MODELS = {
+    "default": "all-MiniLM-L6-v2",
+    "onnx-int8": "all-MiniLM-L6-v2-int8",
+}
+REINDEX_BATCH_SIZE = 1000  # Number of chunks read from the vectorstore at a time when rebuilding the keyword index
+# Collections the vectorstore is split into, each holding all chunks of a fixed set of documents. Above a few tens of
+# thousands of pages, shards searched in parallel keep queries fast. Changing it re-embeds every chunk.
+VECTORSTORE_SHARDS = int(os.environ.get("VECTORSTORE_SHARDS", "1"))
+# Held while ingesting, so parallel processes (e.g. promptfoo workers) don't ingest into the same store at once
+INGEST_LOCK_PATH = "./data/chromadb/ingest.lock"
+
+# A single collection, or a ShardedCollection with VECTORSTORE_SHARDS > 1
+VectorStore = Union[chromadb.Collection, ShardedCollection]
+
+_collection: Optional[VectorStore] = None
+_collection_lock = threading.Lock()
+# Progress of the ingestion started by start_background_ingestion(), read by the app while it starts
+_ingestion_status = {
+    "state": "not_started",  # "not_started", "running", "ready", or "failed"
+    "message": "",
+    "pages_done": 0,
+    "pages_total": 0,
+    "error": None,
+}
+_ingestion_status_lock = threading.Lock()
+_ingestion_thread: Optional[threading.Thread] = None
+
+logger = logging.getLogger(__name__)
+
+
+def get_collection() -> VectorStore:
+    """
+    Get the process-wide vectorstore collection. The first call runs the data preparation pipeline, later calls
+    reuse the same collection, so callers that query many times (e.g. the test providers) don't reconnect or re-ingest.
+
+    Returns:
+        VectorStore: ChromaDB collection with the input documents chunked and embedded
+    """
+
+    global _collection
+    if _collection is None:
+        with _collection_lock:
+            if _collection is None:
+                _collection = prepare_data()
+
+    return _collection
+
+
+def start_background_ingestion() -> None:
+    """
+    Run the data preparation pipeline and load the models used for retrieval in a background thread, so the app can
+    render while documents are ingested. Follow the progress with get_ingestion_status(). Only the first call starts
+    a thread.
+    """
+
+    global _ingestion_thread
+    with _ingestion_status_lock:
+        if _ingestion_thread is not None:
+            return
+        _ingestion_status.update(state="running", message="Starting up")
+        _ingestion_thread = threading.Thread(
+            target=_ingest_in_background, name="ingestion", daemon=True
+        )
+        _ingestion_thread.start()
+
+
+def _ingest_in_background() -> None:
+    """Prepare the collection and the retrieval models, and record the outcome. Runs on the ingestion thread."""
+    try:
+        get_collection()
+        update_ingestion_status(message="Loading the embedding model")
+        warm_up_models()
+    except Exception as error:
+        logger.exception("Data preparation failed")
+        update_ingestion_status(state="failed", error=str(error))
+    else:
+        update_ingestion_status(state="ready", message="Ready")
 
 
-def prepare_data() -> chromadb.Collection:
+def get_ingestion_status() -> dict:
+    """
+    Get the progress of the ingestion started by start_background_ingestion()
+
+    Returns:
+        dict: Copy of the status with "state" ("not_started", "running", "ready", or "failed"), "message",
+            "pages_done" and "pages_total" of the files being ingested, and "error" if it failed
+    """
+
+    with _ingestion_status_lock:
+        return dict(_ingestion_status)
+
+
+def update_ingestion_status(**values) -> None:
+    """
+    Update the ingestion progress shown while the app starts
+
+    Args:
+        **values: Status fields to set, see get_ingestion_status()
+    """
+
+    with _ingestion_status_lock:
+        _ingestion_status.update(values)
+
+
+def warm_up_models() -> None:
+    """Load the tokenizer and the embedding model, so the first query doesn't wait for them to load"""
+    get_tokenizer()
+    # Bypass the embedding cache, which would otherwise answer without loading the model
+    get_embedding_function().embedding_function(["warm up"])
+
+
+@contextmanager
+def ingest_lock() -> Iterator[None]:
+    """
+    Hold an exclusive lock on the vectorstore across processes. A process that waits for the lock finds the
+    data already ingested by the process that held it.
+    """
+
+    os.makedirs(os.path.dirname(INGEST_LOCK_PATH), exist_ok=True)
+    with open(INGEST_LOCK_PATH, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def prepare_data() -> VectorStore:
     """
     Data preparation pipeline. Ingests documents, chunks them, and embeds them in a ChromaDB vectorstore.
+    Only new or changed files are ingested. Chunks of changed or removed files are deleted from the vectorstore.
+    With SUMMARY_MODEL set, page and document summaries of new or changed files are added to the summary index.
+    Use get_collection() to reuse the collection instead of running the pipeline again.
 
     Returns:
-        chromadb.Collection: ChromaDB collection with the input document chunked and embedded
+        VectorStore: ChromaDB collection with the input document chunked and embedded
     """
 
-    if not os.path.isfile("./data/chromadb/chroma.sqlite3"):
-        # Only read and chunk data if the DB doesn't exist
-        file_text, filenames = read_data()
-        chunk_list, metadata_list, id_list = chunk_data(
-            docs=file_text, doc_names=filenames
-        )
+    # Runs once per process at a time and waits for other processes ingesting into the same store
+    update_ingestion_status(message="Waiting for other processes to finish ingesting")
+    with ingest_lock():
+        update_ingestion_status(message="Checking for new or changed documents")
+        files = list_data_files()
         collection = manage_db()
-        insert_data_to_db(
-            collection=collection,
-            chunk_list=chunk_list,
-            metadata_list=metadata_list,
-            id_list=id_list,
+        lexical_index = get_lexical_index()
+        manifest = load_manifest()
+
+        settings = {"chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP}
+        if VECTORSTORE_SHARDS > 1:
+            settings["shards"] = VECTORSTORE_SHARDS
+        embedding_model = get_embedding_model()
+        # Collections created before the model was recorded were embedded with the default model
+        stored_embedding_model = (collection.metadata or {}).get(
+            "embedding_model", EMBEDDING_MODELS["default"]
         )
-    else:
-        collection = manage_db()
+        if stored_embedding_model != embedding_model:
+            logger.warning(
+                f"The vectorstore was embedded with {stored_embedding_model}, but EMBEDDING_BACKEND uses "
+                f"{embedding_model}. Their vectors can't be compared, so every chunk is embedded again."
+            )
+        if (
+            manifest["settings"] != settings
+            or stored_embedding_model != embedding_model
+        ):
+            # Chunker settings, shards, or embedding model changed, so every stored chunk is stale
+            collection = reset_db()
+            lexical_index.clear()
+            manifest = {"settings": settings, "files": {}, "ingesting": {}}
+            save_manifest(manifest=manifest)
+
+        file_hashes = {file: hash_file(path=file) for file in files}
+        new_files = [
+            file for file in files if manifest["files"].get(file) != file_hashes[file]
+        ]
+        # Files whose interrupted ingestion can't be resumed, since they changed again, are stale as well
+        stale_files = [
+            file
+            for recorded in (manifest["files"], manifest["ingesting"])
+            for file, file_hash in recorded.items()
+            if file_hash != file_hashes.get(file)
+        ]
+
+        # Delete chunks before dropping files from the manifest so an interrupted run retries the deletion
+        for file in stale_files:
+            collection.delete(where={"filename": file})
+            lexical_index.delete_file(filename=file)
+            manifest["files"].pop(file, None)
+            manifest["ingesting"].pop(file, None)
+        save_manifest(manifest=manifest)
+
+        if new_files:
+            # Recorded before any chunk is written, so the next run only resumes from chunks of the same content
+            for file in new_files:
+                manifest["ingesting"][file] = file_hashes[file]
+            save_manifest(manifest=manifest)
+            tasks = plan_ingestion_tasks(files=new_files)
+            # Pages of the files before each file, to report progress in pages
+            pages_before = {}
+            pages_total = 0
+            for file, start, end in tasks:
+                pages_before.setdefault(file, pages_total - start)
+                pages_total += end - start
+            update_ingestion_status(
+                message=f"Ingesting {len(new_files)} new or changed documents",
+                pages_done=0,
+                pages_total=pages_total,
+            )
+
+            # Already embedded chunks are skipped, so a run interrupted mid-ingestion resumes where it stopped
+            num_chunks = 0
+            num_inserted = 0
+            for chunk_list, metadata_list, id_list in stream_chunks(tasks=tasks):
+                num_inserted += insert_data_to_db(
+                    collection=collection,
+                    chunk_list=chunk_list,
+                    metadata_list=metadata_list,
+                    id_list=id_list,
+                )
+                lexical_index.add(
+                    ids=id_list, documents=chunk_list, metadatas=metadata_list
+                )
+                num_chunks += len(id_list)
+                logger.info(
+                    f"Ingestion progress: {num_chunks} chunks processed, {num_inserted} embedded"
+                )
+                # Tasks are streamed in order, so every page up to the batch's last chunk is stored
+                last = metadata_list[-1]
+                update_ingestion_status(
+                    pages_done=pages_before[last["filename"]] + last["page_number"]
+                )
+            for file in new_files:
+                manifest["files"][file] = file_hashes[file]
+                del manifest["ingesting"][file]
+            save_manifest(manifest=manifest)
+
+        # Stores ingested before the keyword index existed are indexed from the chunks already in the vectorstore
+        if lexical_index.count() != collection.count():
+            update_ingestion_status(message="Rebuilding the keyword index")
+            rebuild_lexical_index(collection=collection, lexical_index=lexical_index)
+
+        # Imported here, since the summary index is built with the functions of this module
+        from backend.summary_index import build_summaries
+
+        # Only files without summaries of their current content are summarized, if SUMMARY_MODEL is set
+        build_summaries(files=files, file_hashes=file_hashes)
 
     return collection
 
 
-def read_data() -> Tuple[List[List[str]], List[str]]:
+def rebuild_lexical_index(
+    collection: VectorStore,
+    lexical_index: LexicalIndex,
+    batch_size: int = REINDEX_BATCH_SIZE,
+) -> None:
     """
-    Read all data from the input data directory and extract the raw text.
+    Rebuild the keyword index from the chunks stored in the vectorstore
+
+    Args:
+        collection (VectorStore): The ChromaDB collection set up in manage_db()
+        lexical_index (LexicalIndex): Keyword index to rebuild
+        batch_size (int, optional): Number of chunks read at a time. Defaults to REINDEX_BATCH_SIZE.
+    """
+
+    logger.info("Rebuilding the keyword index from the vectorstore")
+    lexical_index.clear()
+    for offset in range(0, collection.count(), batch_size):
+        batch = collection.get(
+            limit=batch_size, offset=offset, include=["documents", "metadatas"]
+        )
+        lexical_index.add(
+            ids=batch["ids"], documents=batch["documents"], metadatas=batch["metadatas"]
+        )
+
+
+def list_data_files() -> List[str]:
+    """
+    List all PDF files in the input data directory.
 
     Returns:
-        Tuple[List[List[str]], List[str]]: Tuple with the list of raw text per document (one entry per page), and a list of the filenames.
+        List[str]: Sorted list of PDF file paths
     """
 
-    files = glob.glob("./data/*.pdf")
+    files = sorted(glob.glob("./data/*.pdf"))
     if len(files) < 1:
         raise OSError(
             "No PDF files were found in the /data directory. Be sure to add at least one PDF file that you want to ask questions about."
         )
 
+    return files
+
+
+def hash_file(path: str) -> str:
+    """
+    Compute the SHA-256 hash of a file's contents.
+
+    Args:
+        path (str): Path to the file
+
+    Returns:
+        str: Hex digest of the file contents
+    """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def load_manifest() -> dict:
+    """
+    Load the ingestion manifest, which records the chunker settings and the content hash of every ingested file.
+
+    Returns:
+        dict: Manifest with "settings" (dict), "files" (dict of filename to content hash), and "ingesting" (dict of
+            filename to content hash of files whose ingestion started but didn't finish). Empty if no manifest exists yet.
+    """
+
+    if not os.path.isfile(MANIFEST_PATH):
+        return {"settings": None, "files": {}, "ingesting": {}}
+
+    with open(MANIFEST_PATH, "r") as f:
+        return json.load(f)
+
+
+def get_index_version() -> str:
+    """
+    Fingerprint the ingested corpus. The version changes whenever files are added, changed, or removed, or the chunker settings change.
+
+    Returns:
+        str: Hex digest of the ingestion manifest
+    """
+
+    manifest = json.dumps(load_manifest(), sort_keys=True)
+
+    return hashlib.sha256(manifest.encode("utf-8")).hexdigest()
+
+
+def save_manifest(manifest: dict) -> None:
+    """
+    Atomically write the ingestion manifest to disk.
+
+    Args:
+        manifest (dict): Manifest with "settings", "files", and "ingesting"
+    """
+
+    os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+    tmp_path = f"{MANIFEST_PATH}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def read_data(files: List[str] = None) -> Tuple[List[List[str]], List[str]]:
+    """
+    Read all data from the input data directory and extract the raw text.
+
+    Args:
+        files (List[str], optional): Files to read. Defaults to every PDF file in the input data directory.
+
+    Returns:
+        Tuple[List[List[str]], List[str]]: Tuple with the list of raw text per document (one entry per page), and a list of the filenames.
+    """
+
+    if files is None:
+        files = list_data_files()
+
     extracted_files = []
     extracted_filenames = []
     for file in files:
@@ -82,63 +453,387 @@ def chunk_data(
         Tuple[List[str], List[dict], List[str]]: List of text chunks, the associated metadata (filename, page_number, chunk_number), and doc id
     """
 
-    chunker = semchunk.chunkerify(
-        tokenizer_or_token_counter=AutoTokenizer.from_pretrained(
-            "sentence-transformers/all-MiniLM-L6-v2"
-        ),
-        chunk_size=CHUNK_SIZE,
+    chunk_text = []
+    chunk_metadata = []
+    chunk_ids = []
+    for i, doc in enumerate(docs):
+        text, metadata, ids = chunk_pages(pages=doc, doc_name=doc_names[i])
+        chunk_text.extend(text)
+        chunk_metadata.extend(metadata)
+        chunk_ids.extend(ids)
+
+    return chunk_text, chunk_metadata, chunk_ids
+
+
+@lru_cache(maxsize=1)
+def get_chunker() -> Callable:
+    """
+    Build the chunker once per process. Loading the tokenizer is expensive, so it is reused for every page.
+
+    Returns:
+        Callable: semchunk chunker that splits text into chunks of at most CHUNK_SIZE tokens
+    """
+
+    import semchunk
+
+    return semchunk.chunkerify(
+        tokenizer_or_token_counter=get_tokenizer(), chunk_size=CHUNK_SIZE
     )
 
+
+@lru_cache(maxsize=1)
+def get_tokenizer() -> "PreTrainedTokenizerBase":
+    """
+    Load the tokenizer of the embedding model once per process
+
+    Returns:
+        PreTrainedTokenizerBase: sentence-transformers/all-MiniLM-L6-v2 tokenizer
+    """
+
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained("sentence-transformers/all-MiniLM-L6-v2")
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count the tokens of a text with the tokenizer used for chunking. Used as an estimate of LLM prompt length.
+
+    Args:
+        text (str): Text to count
+
+    Returns:
+        int: Number of tokens
+    """
+
+    return len(get_tokenizer().encode(text, add_special_tokens=False, verbose=False))
+
+
+def chunk_pages(
+    pages: List[str], doc_name: str, first_page: int = 0
+) -> Tuple[List[str], List[dict], List[str]]:
+    """
+    Break consecutive pages of one document into smaller chunks for retrieval and embedding.
+
+    Args:
+        pages (List[str]): Text of consecutive pages, one entry per page
+        doc_name (str): Document filename
+        first_page (int, optional): Zero-based page index of the first entry in pages. Defaults to 0.
+
+    Returns:
+        Tuple[List[str], List[dict], List[str]]: List of text chunks, the associated metadata (filename, page_number, chunk_number), and doc id
+    """
+
+    chunker = get_chunker()
+
     chunk_text = []
     chunk_metadata = []
     chunk_ids = []
-    for i, doc in enumerate(docs):
-        for j, page in enumerate(doc):
-            chunks = chunker(text_or_texts=page, overlap=CHUNK_OVERLAP)
-            for k, chunk in enumerate(chunks):
-                chunk_text.append(chunk)
-                chunk_metadata.append(
-                    {"filename": doc_names[i], "page_number": j + 1, "chunk_number": k}
-                )
-                chunk_ids.append(f"{doc_names[i]}_page{j}_chunk{k}")
+    for j, page in enumerate(pages, start=first_page):
+        chunks = chunker(text_or_texts=page, overlap=CHUNK_OVERLAP)
+        for k, chunk in enumerate(chunks):
+            chunk_text.append(chunk)
+            chunk_metadata.append(
+                {"filename": doc_name, "page_number": j + 1, "chunk_number": k}
+            )
+            chunk_ids.append(f"{doc_name}_page{j}_chunk{k}")
 
     return chunk_text, chunk_metadata, chunk_ids
 
 
-def manage_db() -> chromadb.Collection:
+def extract_and_chunk(
+    task: Tuple[str, int, int],
+) -> Tuple[List[str], List[dict], List[str]]:
+    """
+    Extract the text of a page range of one PDF and chunk it. Runs inside the ingestion process pool.
+
+    Args:
+        task (Tuple[str, int, int]): Filename, first page index (inclusive), and last page index (exclusive)
+
+    Returns:
+        Tuple[List[str], List[dict], List[str]]: List of text chunks, the associated metadata (filename, page_number, chunk_number), and doc id
+    """
+
+    file, start, end = task
+    reader = PdfReader(file)
+    pages = [reader.pages[i].extract_text() for i in range(start, end)]
+
+    return chunk_pages(pages=pages, doc_name=file, first_page=start)
+
+
+def plan_ingestion_tasks(files: List[str]) -> List[Tuple[str, int, int]]:
+    """
+    Split the files to ingest into page ranges of at most PAGES_PER_TASK pages.
+
+    Args:
+        files (List[str]): PDF files to ingest
+
+    Returns:
+        List[Tuple[str, int, int]]: Filename, first page index (inclusive), and last page index (exclusive) of each task
+    """
+
+    tasks = []
+    for file in files:
+        num_pages = len(PdfReader(file).pages)
+        for start in range(0, num_pages, PAGES_PER_TASK):
+            tasks.append((file, start, min(start + PAGES_PER_TASK, num_pages)))
+
+    return tasks
+
+
+def stream_chunks(
+    tasks: List[Tuple[str, int, int]],
+    workers: int = INGEST_WORKERS,
+    batch_size: int = INGEST_BATCH_SIZE,
+) -> Iterator[Tuple[List[str], List[dict], List[str]]]:
+    """
+    Extract and chunk page ranges in parallel and stream the chunks in batches, in task order, so memory use is bounded by the batch size rather than the corpus size.
+
+    Args:
+        tasks (List[Tuple[str, int, int]]): Page ranges to ingest, from plan_ingestion_tasks()
+        workers (int, optional): Number of worker processes. 1 processes everything in the calling process. Defaults to INGEST_WORKERS.
+        batch_size (int, optional): Maximum number of chunks per batch. Defaults to INGEST_BATCH_SIZE.
+
+    Yields:
+        Tuple[List[str], List[dict], List[str]]: Batch of text chunks, the associated metadata, and doc ids
+    """
+
+    if workers <= 1 or len(tasks) <= 1:
+        yield from _batch_chunks(
+            results=map(extract_and_chunk, tasks), batch_size=batch_size
+        )
+        return
+
+    # spawn avoids forking the threads of a running Streamlit server
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(tasks)),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        results = _bounded_map(
+            executor=executor,
+            fn=extract_and_chunk,
+            tasks=tasks,
+            max_pending=2 * workers,
+        )
+        yield from _batch_chunks(results=results, batch_size=batch_size)
+
+
+def _bounded_map(
+    executor: Executor, fn: Callable, tasks: List, max_pending: int
+) -> Iterator:
+    """Like executor.map, but keeps at most max_pending tasks in flight so finished results can't pile up in memory"""
+
+    pending = deque()
+    for task in tasks:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, task))
+    while pending:
+        yield pending.popleft().result()
+
+
+def _batch_chunks(
+    results: Iterable[Tuple[List[str], List[dict], List[str]]], batch_size: int
+) -> Iterator[Tuple[List[str], List[dict], List[str]]]:
+    """Regroup per-task chunk results into batches of at most batch_size chunks"""
+
+    chunk_text, chunk_metadata, chunk_ids = [], [], []
+    for text, metadata, ids in results:
+        chunk_text.extend(text)
+        chunk_metadata.extend(metadata)
+        chunk_ids.extend(ids)
+        while len(chunk_ids) >= batch_size:
+            yield (
+                chunk_text[:batch_size],
+                chunk_metadata[:batch_size],
+                chunk_ids[:batch_size],
+            )
+            chunk_text = chunk_text[batch_size:]
+            chunk_metadata = chunk_metadata[batch_size:]
+            chunk_ids = chunk_ids[batch_size:]
+    if chunk_ids:
+        yield chunk_text, chunk_metadata, chunk_ids
+
+
+@lru_cache(maxsize=1)
+def get_chroma_client() -> chromadb.ClientAPI:
+    """
+    Open the persistent chroma db once per process
+
+    Returns:
+        chromadb.ClientAPI: Shared persistent ChromaDB client
+    """
+
+    return chromadb.PersistentClient(path=CHROMADB_PATH)
+
+
+def get_collection_names() -> List[str]:
+    """
+    Get the names of the collections the vectorstore is stored in
+
+    Returns:
+        List[str]: "docs", or "docs_0" to "docs_<n - 1>" for n VECTORSTORE_SHARDS
+    """
+
+    if VECTORSTORE_SHARDS <= 1:
+        return ["docs"]
+
+    return [f"docs_{i}" for i in range(VECTORSTORE_SHARDS)]
+
+
+def manage_db() -> VectorStore:
     """
     Create the persistent chroma db and set up the vectorstore. If the collection already exists, connect to it.
 
     Returns:
-        chromadb.Collection: Persistent ChromaDB collection (vectorstore)
+        VectorStore: Persistent ChromaDB collection (vectorstore), sharded if VECTORSTORE_SHARDS > 1
+    """
+    chroma_client = get_chroma_client()
+
+    # Create the collections if they don't already exist. The metadata is only set when a collection is created, so it
+    # records the embedding model of the stored vectors.
+    collections = [
+        chroma_client.get_or_create_collection(
+            name=name,
+            metadata={"hnsw:space": "ip", "embedding_model": get_embedding_model()},
+            embedding_function=get_embedding_function(),
+        )
+        for name in get_collection_names()
+    ]
+    if len(collections) == 1:
+        return collections[0]
+
+    return ShardedCollection(shards=collections)
+
+
+def reset_db() -> VectorStore:
     """
-    chroma_client = chromadb.PersistentClient(path="./data/chromadb/")
+    Delete the vectorstore collections, including those of other shard counts, and create empty ones in their place.
 
-    # Create a collection if it doesn't already exist, default embedding model is sentence-transformers/all-MiniLM-L6-v2
-    collection = chroma_client.get_or_create_collection(
-        name="docs", metadata={"hnsw:space": "ip"}
+    Returns:
+        VectorStore: Empty persistent ChromaDB collection (vectorstore)
+    """
+    chroma_client = get_chroma_client()
+    for collection in chroma_client.list_collections():
+        name = getattr(collection, "name", collection)
+        if name == "docs" or re.fullmatch(r"docs_\d+", name):
+            chroma_client.delete_collection(name=name)
+
+    return manage_db()
+
+
+def get_document_pages() -> Dict[str, int]:
+    """
+    Count the pages of every PDF file in the input data directory, e.g. to offer page filters
+
+    Returns:
+        Dict[str, int]: Number of pages per filename, as stored in the chunk metadata
+    """
+
+    return {file: len(PdfReader(file).pages) for file in list_data_files()}
+
+
+def get_embedding_model() -> str:
+    """
+    Get the name of the embedding model selected with EMBEDDING_BACKEND
+
+    Raises:
+        ValueError: If EMBEDDING_BACKEND is not one of EMBEDDING_MODELS
+
+    Returns:
+        str: Embedding model name
+    """
+
+    if EMBEDDING_BACKEND not in EMBEDDING_MODELS:
+        raise ValueError(
+            f"Unknown EMBEDDING_BACKEND {EMBEDDING_BACKEND!r}. Use one of {', '.join(EMBEDDING_MODELS)}."
+        )
+
+    return EMBEDDING_MODELS[EMBEDDING_BACKEND]
+
+
+@lru_cache(maxsize=1)
+def get_embedding_function() -> EmbeddingFunction:
+    """
+    Load the EMBEDDING_BACKEND embedding function once per process and share it between ingestion and retrieval.
+    Embeddings are cached on disk by text hash, per embedding model, so re-ingested chunks and repeated queries skip
+    the embedding model.
+
+    Returns:
+        EmbeddingFunction: Cached all-MiniLM-L6-v2 embedding function
+    """
+
+    embedding_model = get_embedding_model()
+    if EMBEDDING_BACKEND == "onnx-int8":
+        from backend.onnx_embedding import QuantizedOnnxEmbeddingFunction
+
+        embedding_function = QuantizedOnnxEmbeddingFunction(batch_size=EMBED_BATCH_SIZE)
+    else:
+        embedding_function = DefaultEmbeddingFunction()
+    cache = EmbeddingCache(
+        path=os.path.join(EMBEDDING_CACHE_DIR, embedding_model), dim=384
     )
 
-    return collection
+    return CachedEmbeddingFunction(embedding_function=embedding_function, cache=cache)
 
 
 def insert_data_to_db(
-    collection: chromadb.Collection,
+    collection: VectorStore,
     chunk_list: List[str],
     metadata_list: List[dict],
     id_list: List[str],
-) -> None:
+    insert_batch_size: int = INSERT_BATCH_SIZE,
+    embed_batch_size: int = EMBED_BATCH_SIZE,
+) -> int:
     """
-    Embed and add all chunks of data to the ChromaDB
+    Embed and add all chunks of data to the ChromaDB in batches. Chunks whose id is already in the collection are skipped,
+    so an interrupted ingestion can be resumed without re-embedding the chunks that were already written.
 
     Args:
-        collection (chromadb.Collection): The ChromaDB collection set up in manage_db()
+        collection (VectorStore): The ChromaDB collection set up in manage_db()
         chunk_list (List[str]): List of text chunks
         metadata_list (List[dict]): List of metadata (filename, page_number, chunk_number) for each chunk
         id_list (List[str]): List of ids for each chunk
+        insert_batch_size (int, optional): Number of chunks written per write. Defaults to INSERT_BATCH_SIZE.
+        embed_batch_size (int, optional): Number of chunks embedded per call to the embedding model. Defaults to EMBED_BATCH_SIZE.
+
+    Returns:
+        int: Number of chunks that were embedded and added
     """
 
-    collection.add(documents=chunk_list, metadatas=metadata_list, ids=id_list)
+    embedding_function = get_embedding_function()
+    num_inserted = 0
+
+    for start in range(0, len(id_list), insert_batch_size):
+        batch_ids = id_list[start : start + insert_batch_size]
+        existing_ids = set(collection.get(ids=batch_ids, include=[])["ids"])
+        keep = [
+            i for i, chunk_id in enumerate(batch_ids) if chunk_id not in existing_ids
+        ]
+        if not keep:
+            continue
+
+        documents = [chunk_list[start + i] for i in keep]
+        embeddings = []
+        for embed_start in range(0, len(documents), embed_batch_size):
+            embeddings.extend(
+                embedding_function(
+                    documents[embed_start : embed_start + embed_batch_size]
+                )
+            )
+
+        collection.add(
+            documents=documents,
+            embeddings=embeddings,
+            metadatas=[metadata_list[start + i] for i in keep],
+            ids=[batch_ids[i] for i in keep],
+        )
+        num_inserted += len(keep)
+        logger.info(
+            f"Embedded {min(start + insert_batch_size, len(id_list))} of {len(id_list)} chunks in batch ({len(batch_ids) - len(keep)} already present)"
+        )
+
+    return num_inserted
 
 
 def get_available_models() -> List[str]:
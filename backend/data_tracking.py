@@ -1,85 +1,763 @@
 # File to create and manage a database that tracks all user queries, responses, and feedback for continuous model improvement
 
+import argparse
+import atexit
+from datetime import datetime, timedelta, timezone
+import hashlib
 import json
+import logging
+import queue
 import sqlite3
-from typing import List
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
 
+from backend.instrumentation import OLLAMA_METRICS, percentile
 
-def manage_tracking_db() -> sqlite3.Connection:
+TRACKING_DB_PATH = "/app/data/chatbot_data.db"
+WRITE_BATCH_SIZE = 100  # Maximum number of statements committed in one transaction
+# A batch that fails with a transient error, e.g. a lock held by compaction, is retried this often before every
+# queued item is written on its own, so one bad statement can't lose the whole batch
+WRITE_ATTEMPTS = 3
+# Seconds before the first retry, doubled for each further retry
+WRITE_RETRY_DELAY = 0.2
+# Seconds a connection waits for another connection's lock before it raises "database is locked"
+BUSY_TIMEOUT = 30.0
+# Stored in PRAGMA user_version. 0 is the original untyped table without an id column, 1 has no model column or timings
+# table, 2 stores every prompt in full in the full_query column
+SCHEMA_VERSION = 3
+LATENCY_SUMMARY_ENTRIES = (
+    1000  # Number of most recent entries used for latency percentiles
+)
+CREATE_CHATBOT_TABLE = """CREATE TABLE IF NOT EXISTS chatbot(
+    id INTEGER PRIMARY KEY,
+    query_timestamp TEXT NOT NULL,
+    user_query TEXT NOT NULL,
+    retrieval_query TEXT,
+    full_query TEXT,
+    llm_response TEXT,
+    sources TEXT,
+    is_good INTEGER,
+    cache_hit INTEGER NOT NULL DEFAULT 0,
+    model TEXT,
+    prompt TEXT
+)"""
+CREATE_TIMINGS_TABLE = """CREATE TABLE IF NOT EXISTS timings(
+    entry_id INTEGER NOT NULL REFERENCES chatbot(id),
+    stage TEXT NOT NULL,
+    duration_ms REAL NOT NULL,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    prompt_eval_ms REAL,
+    eval_ms REAL,
+    load_ms REAL
+)"""
+# Prompt messages and retrieved chunks are stored once and referenced by the SHA-256 hash of their content, since the
+# same instructions, chat history, and chunks are sent to the LLM again and again
+CREATE_PROMPT_PARTS_TABLE = """CREATE TABLE IF NOT EXISTS prompt_parts(
+    hash TEXT PRIMARY KEY,
+    content TEXT NOT NULL
+) WITHOUT ROWID"""
+CREATE_PROMPT_CHUNKS_TABLE = """CREATE TABLE IF NOT EXISTS prompt_chunks(
+    hash TEXT PRIMARY KEY,
+    chunk_id TEXT,
+    content TEXT NOT NULL
+) WITHOUT ROWID"""
+# Chunks shorter than this stay in the prompt parts, since a reference to them saves next to nothing
+MIN_CHUNK_REFERENCE_CHARS = 100
+
+logger = logging.getLogger(__name__)
+
+
+class TrackingWriter:
+    """
+    Executes writes to the tracking database on a dedicated background thread, so tracking never blocks a chat response.
+    Statements are queued and committed in batches, one transaction per batch, on the writer thread's own connection.
+    Entry ids are handed out by the writer, so callers know the id of an entry before it is written. This assumes the
+    writer is the only process writing to the database.
+    """
+
+    def __init__(self, path: str):
+        """
+        Start the writer thread for the database at path
+
+        Args:
+            path (str): Path of the sqlite database
+        """
+
+        self.path = path
+        self._queue = queue.Queue()
+        self._closed = False
+        self._id_lock = threading.Lock()
+        con = sqlite3.connect(path)
+        self._last_id = con.execute(
+            "SELECT COALESCE(MAX(id), 0) FROM chatbot"
+        ).fetchone()[0]
+        con.close()
+        self._thread = threading.Thread(
+            target=self._run, name="tracking-writer", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def next_id(self) -> int:
+        """
+        Reserve the id of a new chatbot table entry
+
+        Returns:
+            int: Unused entry id
+        """
+
+        with self._id_lock:
+            self._last_id += 1
+            return self._last_id
+
+    def submit(self, sql: str, parameters: Tuple = ()) -> None:
+        """
+        Queue a write statement
+
+        Args:
+            sql (str): SQL statement
+            parameters (Tuple, optional): Statement parameters. Defaults to ().
+        """
+
+        if self._closed:
+            raise RuntimeError("The tracking database writer is closed")
+        self._queue.put((sql, parameters))
+
+    def submit_many(self, statements: List[Tuple[str, Tuple]]) -> None:
+        """
+        Queue write statements that are committed together in one transaction
+
+        Args:
+            statements (List[Tuple[str, Tuple]]): SQL statements and their parameters
+        """
+
+        if self._closed:
+            raise RuntimeError("The tracking database writer is closed")
+        self._queue.put(statements)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until every statement queued so far is committed
+
+        Args:
+            timeout (Optional[float], optional): Maximum number of seconds to wait. Defaults to None (no limit).
+
+        Returns:
+            bool: True if all queued statements were committed in time
+        """
+
+        if not self._thread.is_alive():
+            return self._queue.empty()
+        done = threading.Event()
+        self._queue.put(done)
+
+        return done.wait(timeout=timeout)
+
+    def close(self, timeout: Optional[float] = 10.0) -> None:
+        """
+        Commit all queued statements and stop the writer thread. Registered to run at interpreter shutdown.
+
+        Args:
+            timeout (Optional[float], optional): Maximum number of seconds to wait for pending writes. Defaults to 10.
+        """
+
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout=timeout)
+
+    def _run(self) -> None:
+        """Writer thread loop. Drains the queue in batches and commits each batch as one transaction."""
+
+        connection = connect(path=self.path)
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            writes = []
+            flushed = []
+            for item in batch:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    flushed.append(item)
+                else:
+                    writes.append(item)
+            if writes:
+                self._write_batch(connection=connection, writes=writes)
+            for event in flushed:
+                event.set()
+
+        connection.close()
+
+    @staticmethod
+    def _write_batch(connection: sqlite3.Connection, writes: List) -> None:
+        """
+        Commit queued writes as one transaction. Transient errors are retried with exponential backoff. If the batch
+        still fails, every write is committed in its own transaction, so only the failing ones are lost.
+
+        Args:
+            connection (sqlite3.Connection): Connection of the writer thread
+            writes (List): Queued statements, or lists of statements that belong to one transaction
+        """
+
+        for attempt in range(WRITE_ATTEMPTS):
+            try:
+                execute_writes(connection=connection, writes=writes)
+                return
+            except sqlite3.OperationalError:
+                logger.warning(
+                    "Failed to write a batch to the tracking database (attempt %d of %d)",
+                    attempt + 1,
+                    WRITE_ATTEMPTS,
+                    exc_info=True,
+                )
+                if attempt + 1 < WRITE_ATTEMPTS:
+                    time.sleep(WRITE_RETRY_DELAY * 2**attempt)
+            except sqlite3.Error:
+                logger.warning(
+                    "Failed to write a batch to the tracking database", exc_info=True
+                )
+                break
+
+        for write in writes:
+            try:
+                execute_writes(connection=connection, writes=[write])
+            except sqlite3.Error:
+                logger.exception(
+                    "Dropped a write to the tracking database: %s",
+                    write if isinstance(write, tuple) else [sql for sql, _ in write],
+                )
+
+
+def execute_writes(connection: sqlite3.Connection, writes: Iterable) -> None:
+    """
+    Execute queued writes and commit them in one transaction, or roll all of them back if one fails
+
+    Args:
+        connection (sqlite3.Connection): Database connection
+        writes (Iterable): Statements as (sql, parameters), or lists of them
+    """
+
+    try:
+        for write in writes:
+            for statement in write if isinstance(write, list) else [write]:
+                connection.execute(*statement)
+        connection.commit()
+    except sqlite3.Error:
+        connection.rollback()
+        raise
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """
+    Open a connection to the tracking database with write-ahead logging, so reads don't block the writer thread. Writes
+    wait up to BUSY_TIMEOUT seconds for locks held by other connections, e.g. compaction, instead of failing at once.
+
+    Args:
+        path (str): Path of the sqlite database
+
+    Returns:
+        sqlite3.Connection: Database connection
+    """
+
+    con = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+    con.execute("PRAGMA journal_mode=WAL")
+    # With WAL, NORMAL only syncs at checkpoints. A power loss may drop the latest entries but can't corrupt the database.
+    con.execute("PRAGMA synchronous=NORMAL")
+
+    return con
+
+
+def manage_tracking_db() -> TrackingWriter:
     """Connect to the chatbot_data database. Create it if it doesn't exist.
-    Creates the chatbot table. Primary key is (query_timestamp, user_query)"""
+    Creates the chatbot table, or migrates an existing table to the current schema. Primary key is the integer id.
+    Returns the background writer that all tracking writes go through."""
 
-    con = sqlite3.connect(
-        "/app/data/chatbot_data.db", check_same_thread=False
-    )  # Only one execute at a time will be run, so check_same_thread=False is safe
+    con = connect(path=TRACKING_DB_PATH)
     cursor = con.cursor()
 
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    table_exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chatbot'"
+    ).fetchone()
+    if table_exists and version < 1:
+        migrate_untyped_table(cursor=cursor)
+    elif table_exists:
+        if version < 2:
+            cursor.execute("ALTER TABLE chatbot ADD COLUMN model TEXT")
+        if version < 3:
+            # Entries before version 3 keep their full_query until compact_tracking_db() converts them
+            cursor.execute("ALTER TABLE chatbot ADD COLUMN prompt TEXT")
+
+    cursor.execute(CREATE_CHATBOT_TABLE)
     cursor.execute(
-        "CREATE TABLE IF NOT EXISTS chatbot(query_timestamp, user_query, retrieval_query, full_query, llm_response, sources, is_good)"
+        "CREATE INDEX IF NOT EXISTS chatbot_query_timestamp ON chatbot(query_timestamp)"
     )
+    cursor.execute("CREATE INDEX IF NOT EXISTS chatbot_model ON chatbot(model)")
+    cursor.execute(CREATE_TIMINGS_TABLE)
+    cursor.execute("CREATE INDEX IF NOT EXISTS timings_entry_id ON timings(entry_id)")
+    cursor.execute(CREATE_PROMPT_PARTS_TABLE)
+    cursor.execute(CREATE_PROMPT_CHUNKS_TABLE)
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    con.commit()
+    con.close()
 
-    return con
+    return TrackingWriter(path=TRACKING_DB_PATH)
+
+
+def migrate_untyped_table(cursor: sqlite3.Cursor) -> None:
+    """
+    Migrate the original chatbot table (untyped columns, no id) to the typed schema with an integer id.
+    Existing rows keep their order, so ids follow the original insertion order.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of an open connection to the tracking database
+    """
+
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(chatbot)")]
+    cache_hit = "COALESCE(cache_hit, 0)" if "cache_hit" in columns else "0"
+
+    cursor.execute("ALTER TABLE chatbot RENAME TO chatbot_untyped")
+    cursor.execute(CREATE_CHATBOT_TABLE)
+    cursor.execute(
+        f"""INSERT INTO chatbot (query_timestamp, user_query, retrieval_query, full_query, llm_response, sources, is_good, cache_hit)
+        SELECT query_timestamp, user_query, retrieval_query, full_query, llm_response, sources, is_good, {cache_hit}
+        FROM chatbot_untyped ORDER BY rowid"""
+    )
+    cursor.execute("DROP TABLE chatbot_untyped")
 
 
 def add_tracking_entry(
-    connection: sqlite3.Connection,
+    connection: TrackingWriter,
     query_timestamp: str,
     user_query: str,
     retrieval_query: str,
-    full_query: str,
+    full_query: List[dict],
     llm_response: str,
     sources: List[str],
-) -> None:
+    cache_hit: bool = False,
+    model: Optional[str] = None,
+    chunks: Optional[Dict[str, str]] = None,
+) -> int:
     """
-    Add an entry to the chatbot data tracking database. Primary key is (query_timestamp, user_query)
+    Add an entry to the chatbot data tracking database. Primary key is the integer id.
+    The entry is written asynchronously by the background writer. The prompt is stored as references to its messages
+    and chunks, which are stored once, see store_prompt(). get_full_query() rebuilds it.
 
     Args:
-        connection (sqlite3.Connection): Valid sqlite3 connection for the database
+        connection (TrackingWriter): Background writer for the database
         query_timestamp (str): The timestamp of the query as a string
         user_query (str): The original user query as typed into the chatbot
         retrieval_query (str): The LLM-modified user query used to retrieve information from the vectorstore with sources material embedded and chunked
-        full_query (str): The full query sent to the LLM, contains the user query and the context
+        full_query (List[dict]): The full query sent to the LLM, contains the user query and the context
         llm_response (str): The response generated by the LLM
         sources (List[str]): The list of sources (filename and page number in a string) in the context
+        cache_hit (bool, optional): True if the response was served from the response cache. Defaults to False.
+        model (Optional[str], optional): The LLM that generated the response. Defaults to None.
+        chunks (Optional[Dict[str, str]], optional): Text of the chunks in the prompt by chunk id. Defaults to None.
+
+    Returns:
+        int: Id of the new entry, used to attach user feedback and timings to it
     """
 
-    cursor = connection.cursor()
+    entry_id = connection.next_id()
+    prompt, statements = store_prompt(full_query=full_query, chunks=chunks or {})
 
-    # is_good is the final column. This is NULL until the user clicks the UI button that designates this response as good or bad
-    cursor.execute(
-        """INSERT INTO chatbot (query_timestamp, user_query, retrieval_query, full_query, llm_response, sources) VALUES (?, ?, ?, ?, ?, ?)""",
+    # is_good is NULL until the user clicks the UI button that designates this response as good or bad
+    statements.append(
         (
-            query_timestamp,
-            user_query,
-            retrieval_query,
-            json.dumps(full_query),
-            llm_response,
-            json.dumps(sources),
-        ),
+            """INSERT INTO chatbot (id, query_timestamp, user_query, retrieval_query, llm_response, sources, cache_hit, model, prompt) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (
+                entry_id,
+                query_timestamp,
+                user_query,
+                retrieval_query,
+                llm_response,
+                json.dumps(sources),
+                cache_hit,
+                model,
+                prompt,
+            ),
+        )
     )
-    connection.commit()
+    # One transaction, so the entry is never written without the parts it references
+    connection.submit_many(statements=statements)
+
+    return entry_id
+
+
+def hash_content(content: str) -> str:
+    """
+    Hash stored prompt content
+
+    Args:
+        content (str): Prompt message or chunk text
+
+    Returns:
+        str: SHA-256 hex digest
+    """
+
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
 
 
-def update_entry_with_feedback(connection: sqlite3.Connection, is_good: bool) -> None:
+def store_prompt(
+    full_query: List[dict], chunks: Dict[str, str]
+) -> Tuple[str, List[Tuple[str, Tuple]]]:
     """
-    Update the most recent entry in the chatbot data tracking database with user feedback (is_good column, true or false)
+    Split a prompt into content-addressed parts. The text of the chunks is cut out of each message and stored once,
+    and the rest of the message is stored once as its part, so repeated instructions, chat history, and chunks are
+    stored once. The offset of every cut out chunk is kept with the reference to the part.
 
     Args:
-        connection (sqlite3.Connection): Valid sqlite3 connection for the database
+        full_query (List[dict]): Messages sent to the LLM, with "role" and "content"
+        chunks (Dict[str, str]): Text of the chunks in the prompt by chunk id
+
+    Returns:
+        Tuple[str, List[Tuple[str, Tuple]]]: The prompt as a JSON list of message roles, part hashes, and chunk
+            offsets and hashes, and the statements that store the parts and chunks
+    """
+
+    statements = []
+    chunk_hashes = {}
+    for chunk_id, text in chunks.items():
+        text = text.strip()
+        if len(text) >= MIN_CHUNK_REFERENCE_CHARS and text not in chunk_hashes:
+            chunk_hashes[text] = hash_content(content=text)
+            statements.append(
+                (
+                    "INSERT OR IGNORE INTO prompt_chunks VALUES (?, ?, ?)",
+                    (chunk_hashes[text], chunk_id, text),
+                )
+            )
+
+    prompt = []
+    for message in full_query:
+        content = message["content"]
+        # Offsets are positions in the part, where the chunk text is inserted again
+        pieces, offsets, position, length = [], [], 0, 0
+        for start, text in find_chunks(content=content, chunk_texts=chunk_hashes):
+            pieces.append(content[position:start])
+            length += start - position
+            offsets.append([length, chunk_hashes[text]])
+            position = start + len(text)
+        pieces.append(content[position:])
+        part_content = "".join(pieces)
+        part = hash_content(content=part_content)
+        statements.append(
+            ("INSERT OR IGNORE INTO prompt_parts VALUES (?, ?)", (part, part_content))
+        )
+        prompt.append({"role": message["role"], "part": part, "chunks": offsets})
+
+    return json.dumps(prompt), statements
+
+
+def find_chunks(content: str, chunk_texts: Iterable[str]) -> List[Tuple[int, str]]:
+    """
+    Find the non-overlapping occurrences of chunks in a message. Longer chunks are matched first, so a chunk that is
+    part of a longer one doesn't split it.
+
+    Args:
+        content (str): Message content
+        chunk_texts (Iterable[str]): Chunk texts
+
+    Returns:
+        List[Tuple[int, str]]: Start and text of every occurrence, in order of their position
+    """
+
+    spans = []
+    for text in sorted(chunk_texts, key=len, reverse=True):
+        start = content.find(text)
+        while start != -1:
+            end = start + len(text)
+            if all(end <= other or start >= other + len(t) for other, t in spans):
+                spans.append((start, text))
+                start = content.find(text, end)
+            else:
+                start = content.find(text, start + 1)
+
+    return sorted(spans)
+
+
+def get_full_query(entry_id: int, path: str = TRACKING_DB_PATH) -> List[dict]:
+    """
+    Rebuild the full query of an entry exactly as it was sent to the LLM
+
+    Args:
+        entry_id (int): Id of the entry
+        path (str, optional): Path of the tracking database. Defaults to TRACKING_DB_PATH.
+
+    Raises:
+        KeyError: If there is no entry with this id
+
+    Returns:
+        List[dict]: Messages with "role" and "content"
+    """
+
+    con = connect(path=path)
+    try:
+        row = con.execute(
+            "SELECT prompt, full_query FROM chatbot WHERE id = ?", (entry_id,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(f"No tracking entry with id {entry_id}")
+        prompt, full_query = row
+        if prompt is None:
+            # Entries written before prompts were stored as parts
+            return json.loads(full_query) if full_query else []
+
+        return [
+            {"role": message["role"], "content": load_message(con=con, message=message)}
+            for message in json.loads(prompt)
+        ]
+    finally:
+        con.close()
+
+
+def load_message(con: sqlite3.Connection, message: dict) -> str:
+    """
+    Load the stored part of a prompt message and insert the text of its chunks again
+
+    Args:
+        con (sqlite3.Connection): Connection to the tracking database
+        message (dict): Reference to the message with "part", and "chunks" offsets and hashes
+
+    Returns:
+        str: Message content
+    """
+
+    content = con.execute(
+        "SELECT content FROM prompt_parts WHERE hash = ?", (message["part"],)
+    ).fetchone()[0]
+    chunk_hashes = {chunk for _, chunk in message["chunks"]}
+    if not chunk_hashes:
+        return content
+
+    placeholders = ",".join("?" * len(chunk_hashes))
+    chunk_texts = dict(
+        con.execute(
+            f"SELECT hash, content FROM prompt_chunks WHERE hash IN ({placeholders})",
+            list(chunk_hashes),
+        ).fetchall()
+    )
+
+    pieces, position = [], 0
+    for offset, chunk in message["chunks"]:
+        pieces.append(content[position:offset])
+        pieces.append(chunk_texts[chunk])
+        position = offset
+    pieces.append(content[position:])
+
+    return "".join(pieces)
+
+
+def add_stage_timings(
+    connection: TrackingWriter, entry_id: int, stages: List[dict]
+) -> None:
+    """
+    Add the per-stage latency of a chatbot request to the tracking database
+
+    Args:
+        connection (TrackingWriter): Background writer for the database
+        entry_id (int): Id of the entry returned by add_tracking_entry
+        stages (List[dict]): One row per stage with "stage", "duration_ms", and optionally the Ollama metrics (see Timings.to_rows)
+    """
+
+    for row in stages:
+        connection.submit(
+            """INSERT INTO timings (entry_id, stage, duration_ms, prompt_tokens, completion_tokens, prompt_eval_ms, eval_ms, load_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (entry_id, row["stage"], row["duration_ms"])
+            + tuple(row.get(metric) for metric in OLLAMA_METRICS),
+        )
+
+
+def get_latency_summary(
+    path: str = TRACKING_DB_PATH, num_entries: int = LATENCY_SUMMARY_ENTRIES
+) -> List[Dict]:
+    """
+    Aggregate the stage latencies of the most recent entries into p50 and p95 per model and stage
+
+    Args:
+        path (str, optional): Path of the tracking database. Defaults to TRACKING_DB_PATH.
+        num_entries (int, optional): Number of most recent entries to aggregate. Defaults to LATENCY_SUMMARY_ENTRIES.
+
+    Returns:
+        List[Dict]: One row per model and stage with "model", "stage", "count", "p50_ms", and "p95_ms"
+    """
+
+    con = connect(path=path)
+    rows = con.execute(
+        """SELECT c.model, t.stage, t.duration_ms FROM timings t
+        JOIN (SELECT id, model FROM chatbot ORDER BY id DESC LIMIT ?) c ON c.id = t.entry_id""",
+        (num_entries,),
+    ).fetchall()
+    con.close()
+
+    durations = {}
+    for model, stage, duration_ms in rows:
+        durations.setdefault((model, stage), []).append(duration_ms)
+
+    return [
+        {
+            "model": model,
+            "stage": stage,
+            "count": len(values),
+            "p50_ms": round(percentile(values=values, q=50), 1),
+            "p95_ms": round(percentile(values=values, q=95), 1),
+        }
+        for (model, stage), values in sorted(
+            durations.items(), key=lambda item: (item[0][0] or "", item[0][1])
+        )
+    ]
+
+
+def update_entry_with_feedback(
+    connection: TrackingWriter, entry_id: int, is_good: bool
+) -> None:
+    """
+    Update an entry in the chatbot data tracking database with user feedback (is_good column, true or false)
+
+    Args:
+        connection (TrackingWriter): Background writer for the database
+        entry_id (int): Id of the entry returned by add_tracking_entry
         is_good (bool): True if the LLM response was good, False if it was not
     """
-    cursor = connection.cursor()
 
-    # Assume we're using the most recent entry
-    output = cursor.execute(
-        """SELECT query_timestamp, user_query FROM chatbot WHERE query_timestamp == (SELECT MAX(query_timestamp) FROM chatbot)"""
+    # The update is queued behind the insert of the entry, so the entry always exists when it runs
+    connection.submit(
+        """UPDATE chatbot SET is_good = ? WHERE id = ?""", (is_good, entry_id)
     )
-    row = output.fetchone()
-    query_timestamp = row[0]
-    user_query = row[1]
 
-    cursor.execute(
-        """UPDATE chatbot SET is_good = ? WHERE query_timestamp = ? AND user_query = ?""",
-        (is_good, query_timestamp, user_query),
+
+def compact_tracking_db(
+    path: str = TRACKING_DB_PATH,
+    retention_days: Optional[int] = None,
+    keep_feedback: bool = True,
+) -> Dict[str, int]:
+    """
+    Shrink the tracking database. Deletes entries older than the retention period, converts entries that still store
+    their full query to part references, deletes prompt parts and chunks no entry references, and reclaims the freed
+    space. Stop the app first, since the writer thread hands out entry ids that assume no other process writes.
+
+    Args:
+        path (str, optional): Path of the tracking database. Defaults to TRACKING_DB_PATH.
+        retention_days (Optional[int], optional): Delete entries older than this many days. Defaults to None (keep all).
+        keep_feedback (bool, optional): Keep entries with user feedback regardless of age. Defaults to True.
+
+    Returns:
+        Dict[str, int]: Number of "deleted_entries", "converted_entries", "deleted_parts", and "deleted_chunks", and
+            the database size in bytes "size_before" and "size_after"
+    """
+
+    con = connect(path=path)
+    size_before = get_database_size(con=con)
+    stats = {}
+
+    # The whole compaction is one transaction, so an interrupted run leaves the database unchanged
+    con.execute("BEGIN IMMEDIATE")
+    stats["deleted_entries"] = 0
+    if retention_days is not None:
+        cutoff = str(datetime.now(timezone.utc) - timedelta(days=retention_days))
+        condition = "query_timestamp < ?" + (
+            " AND is_good IS NULL" if keep_feedback else ""
+        )
+        con.execute(
+            f"DELETE FROM timings WHERE entry_id IN (SELECT id FROM chatbot WHERE {condition})",
+            (cutoff,),
+        )
+        stats["deleted_entries"] = con.execute(
+            f"DELETE FROM chatbot WHERE {condition}", (cutoff,)
+        ).rowcount
+
+    legacy_rows = con.execute(
+        "SELECT id, full_query FROM chatbot WHERE prompt IS NULL AND full_query IS NOT NULL"
+    ).fetchall()
+    for entry_id, full_query in legacy_rows:
+        # Chunks of old entries aren't known, so only repeated messages are shared
+        prompt, statements = store_prompt(full_query=json.loads(full_query), chunks={})
+        for statement in statements:
+            con.execute(*statement)
+        con.execute(
+            "UPDATE chatbot SET prompt = ?, full_query = NULL WHERE id = ?",
+            (prompt, entry_id),
+        )
+    stats["converted_entries"] = len(legacy_rows)
+
+    parts = set()
+    chunks = set()
+    for (prompt,) in con.execute("SELECT prompt FROM chatbot WHERE prompt IS NOT NULL"):
+        for message in json.loads(prompt):
+            parts.add(message["part"])
+            chunks.update(chunk for _, chunk in message["chunks"])
+    stats["deleted_parts"] = 0
+    for (part,) in con.execute("SELECT hash FROM prompt_parts").fetchall():
+        if part not in parts:
+            con.execute("DELETE FROM prompt_parts WHERE hash = ?", (part,))
+            stats["deleted_parts"] += 1
+    stats["deleted_chunks"] = 0
+    for (chunk,) in con.execute("SELECT hash FROM prompt_chunks").fetchall():
+        if chunk not in chunks:
+            con.execute("DELETE FROM prompt_chunks WHERE hash = ?", (chunk,))
+            stats["deleted_chunks"] += 1
+    con.commit()
+
+    con.execute("VACUUM")
+    con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    stats["size_before"] = size_before
+    stats["size_after"] = get_database_size(con=con)
+    con.close()
+
+    return stats
+
+
+def get_database_size(con: sqlite3.Connection) -> int:
+    """
+    Size of the database in bytes, without the write-ahead log
+
+    Args:
+        con (sqlite3.Connection): Connection to the database
+
+    Returns:
+        int: Number of bytes
+    """
+
+    page_count = con.execute("PRAGMA page_count").fetchone()[0]
+    page_size = con.execute("PRAGMA page_size").fetchone()[0]
+
+    return page_count * page_size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compact the chatbot tracking database. Stop the app before running this."
+    )
+    parser.add_argument(
+        "--path", default=TRACKING_DB_PATH, help="Path of the tracking database"
+    )
+    parser.add_argument(
+        "--retention-days",
+        type=int,
+        default=None,
+        help="Delete entries older than this many days (default: keep all entries)",
+    )
+    parser.add_argument(
+        "--delete-feedback",
+        action="store_true",
+        help="Also delete old entries that have user feedback",
+    )
+    args = parser.parse_args()
+
+    stats = compact_tracking_db(
+        path=args.path,
+        retention_days=args.retention_days,
+        keep_feedback=not args.delete_feedback,
     )
-    connection.commit()
+    print(json.dumps(stats, indent=2))
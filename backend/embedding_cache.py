@@ -0,0 +1,236 @@
+# File to cache embeddings on disk so identical text is only embedded once
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterator, List, Optional
+
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+import numpy as np
+
+EMBEDDING_CACHE_DIR = "./data/embedding_cache/"
+# About 300 MB of vectors for a 384 dimension embedding model
+EMBEDDING_CACHE_MAX_ENTRIES = 200_000
+# Keep IN (...) lookups well below sqlite's bound parameter limit
+SQLITE_MAX_VARIABLES = 500
+# Lookups only record the time an entry was used if the recorded time is older than this many seconds, so most
+# lookups don't write to the index. Eviction order is accurate to this interval.
+LAST_USED_UPDATE_INTERVAL = 600.0
+# Seconds to wait for another process's lock on the hash index
+INDEX_TIMEOUT = 30.0
+
+
+class EmbeddingCache:
+    """
+    Disk-backed embedding cache keyed by the SHA-256 hash of the embedded text.
+    Vectors are stored in a memory-mapped float32 matrix and a sqlite index maps text hashes to matrix rows.
+    When the cache is full the least recently used rows are overwritten. Processes using the same directory share the
+    cache: lookups take a shared file lock and writes an exclusive one, so no process reads a row while another
+    process allocates or overwrites it.
+    """
+
+    def __init__(
+        self, path: str, dim: int, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES
+    ):
+        """
+        Open the cache at path, creating it if it doesn't exist.
+
+        Args:
+            path (str): Directory holding the vector matrix and the hash index
+            dim (int): Embedding dimension
+            max_entries (int, optional): Maximum number of cached vectors. Defaults to EMBEDDING_CACHE_MAX_ENTRIES.
+        """
+
+        os.makedirs(path, exist_ok=True)
+        self.dim = dim
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._lock_path = os.path.join(path, "lock")
+
+        self._index = sqlite3.connect(
+            os.path.join(path, "index.sqlite3"),
+            timeout=INDEX_TIMEOUT,
+            check_same_thread=False,
+        )  # All access goes through self._locked()
+        with self._locked(exclusive=True):
+            self._index.execute(
+                "CREATE TABLE IF NOT EXISTS entries(hash TEXT PRIMARY KEY, row INTEGER NOT NULL UNIQUE, last_used REAL NOT NULL)"
+            )
+            self._index.execute(
+                "CREATE INDEX IF NOT EXISTS entries_last_used ON entries(last_used)"
+            )
+
+            # The matrix file is preallocated (sparse on most filesystems). Start over if the dimension or size changed.
+            matrix_path = os.path.join(path, "vectors.f32")
+            expected_size = max_entries * dim * np.dtype(np.float32).itemsize
+            is_valid = (
+                os.path.isfile(matrix_path)
+                and os.path.getsize(matrix_path) == expected_size
+            )
+            if not is_valid:
+                self._index.execute("DELETE FROM entries")
+            self._index.commit()
+            self._matrix = np.memmap(
+                matrix_path,
+                dtype=np.float32,
+                mode="r+" if is_valid else "w+",
+                shape=(max_entries, dim),
+            )
+
+    @contextmanager
+    def _locked(self, exclusive: bool) -> Iterator[None]:
+        """
+        Hold the lock of this process's threads and a file lock shared with other processes using the cache
+
+        Args:
+            exclusive (bool): True to write to the cache, False to only read it
+        """
+
+        with self._lock, open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def hash_text(text: str) -> str:
+        """Hash the text that is used as the cache key"""
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Look up the cached embedding of each text.
+
+        Args:
+            texts (List[str]): Texts to look up
+
+        Returns:
+            List[Optional[np.ndarray]]: Cached embedding for each text, None where the text is not cached
+        """
+
+        hashes = [self.hash_text(text) for text in texts]
+        rows = {}
+        with self._locked(exclusive=False):
+            unique_hashes = list(dict.fromkeys(hashes))
+            for start in range(0, len(unique_hashes), SQLITE_MAX_VARIABLES):
+                batch = unique_hashes[start : start + SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" * len(batch))
+                rows.update(
+                    (h, (row, last_used))
+                    for h, row, last_used in self._index.execute(
+                        f"SELECT hash, row, last_used FROM entries WHERE hash IN ({placeholders})",
+                        batch,
+                    )
+                )
+            now = time.time()
+            stale = [
+                h
+                for h, (_, last_used) in rows.items()
+                if now - last_used >= LAST_USED_UPDATE_INTERVAL
+            ]
+            if stale:
+                self._index.executemany(
+                    "UPDATE entries SET last_used = ? WHERE hash = ?",
+                    [(now, h) for h in stale],
+                )
+                self._index.commit()
+            vectors = {h: np.array(self._matrix[row]) for h, (row, _) in rows.items()}
+
+        return [vectors.get(h) for h in hashes]
+
+    def put_many(self, texts: List[str], embeddings: List[np.ndarray]) -> None:
+        """
+        Add embeddings to the cache, evicting the least recently used entries if the cache is full.
+
+        Args:
+            texts (List[str]): Embedded texts
+            embeddings (List[np.ndarray]): Embedding of each text
+        """
+
+        new_entries = {}
+        for text, embedding in zip(texts, embeddings):
+            new_entries[self.hash_text(text)] = embedding
+        new_entries = dict(list(new_entries.items())[: self.max_entries])
+
+        with self._locked(exclusive=True):
+            for h in list(new_entries):
+                if self._index.execute(
+                    "SELECT 1 FROM entries WHERE hash = ?", (h,)
+                ).fetchone():
+                    del new_entries[h]
+            if not new_entries:
+                return
+
+            # Use free rows first, then reuse the rows of the least recently used entries
+            num_used = self._index.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            free_rows = list(
+                range(num_used, min(num_used + len(new_entries), self.max_entries))
+            )
+            num_evict = len(new_entries) - len(free_rows)
+            if num_evict > 0:
+                evicted = self._index.execute(
+                    "SELECT hash, row FROM entries ORDER BY last_used LIMIT ?",
+                    (num_evict,),
+                ).fetchall()
+                self._index.executemany(
+                    "DELETE FROM entries WHERE hash = ?", [(h,) for h, _ in evicted]
+                )
+                free_rows.extend(row for _, row in evicted)
+
+            # Write the vectors before the index so a crash can't leave the index pointing at missing data
+            for row, embedding in zip(free_rows, new_entries.values()):
+                self._matrix[row] = np.asarray(embedding, dtype=np.float32)
+            self._matrix.flush()
+
+            now = time.time()
+            self._index.executemany(
+                "INSERT INTO entries (hash, row, last_used) VALUES (?, ?, ?)",
+                [(h, row, now) for h, row in zip(new_entries, free_rows)],
+            )
+            self._index.commit()
+
+
+class CachedEmbeddingFunction(EmbeddingFunction[Documents]):
+    """Embedding function that serves repeated texts from an EmbeddingCache and only embeds cache misses"""
+
+    def __init__(self, embedding_function: EmbeddingFunction, cache: EmbeddingCache):
+        """
+        Args:
+            embedding_function (EmbeddingFunction): Embedding function used for cache misses
+            cache (EmbeddingCache): Cache of previously computed embeddings
+        """
+
+        self.embedding_function = embedding_function
+        self.cache = cache
+
+    def __call__(self, input: Documents) -> Embeddings:
+        """
+        Embed the input texts, using cached embeddings where possible.
+
+        Args:
+            input (Documents): Texts to embed
+
+        Returns:
+            Embeddings: One embedding per input text
+        """
+
+        embeddings = self.cache.get_many(texts=input)
+        misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+
+        if misses:
+            # Embed each distinct missing text once, e.g. boilerplate repeated across pages
+            missing_texts = list(dict.fromkeys(input[i] for i in misses))
+            computed = dict(zip(missing_texts, self.embedding_function(missing_texts)))
+            self.cache.put_many(
+                texts=missing_texts,
+                embeddings=[computed[text] for text in missing_texts],
+            )
+            for i in misses:
+                embeddings[i] = np.asarray(computed[input[i]], dtype=np.float32)
+
+        return embeddings
@@ -0,0 +1,173 @@
+# File to measure the latency of each stage of the RAG pipeline
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional
+
+# Ollama reports durations in nanoseconds
+OLLAMA_METRICS = {
+    "prompt_tokens": "prompt_eval_count",
+    "completion_tokens": "eval_count",
+    "prompt_eval_ms": "prompt_eval_duration",
+    "eval_ms": "eval_duration",
+    "load_ms": "load_duration",
+}
+
+
+class Timings:
+    """Per-stage wall clock durations and Ollama token counts and durations for one chatbot request"""
+
+    def __init__(self):
+        self.stages: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def add_duration(self, stage: str, duration_ms: float) -> None:
+        """
+        Add a duration to a stage. Stages that run more than once accumulate their durations.
+
+        Args:
+            stage (str): Stage name
+            duration_ms (float): Duration in milliseconds
+        """
+
+        with self._lock:
+            entry = self.stages.setdefault(stage, {"duration_ms": 0.0})
+            entry["duration_ms"] += duration_ms
+
+    def add_llm_metrics(self, stage: str, response) -> None:
+        """
+        Record the token counts and durations Ollama reports in a chat response
+
+        Args:
+            stage (str): Stage name
+            response (ChatResponse): Final Ollama chat response (the last chunk when streaming)
+        """
+
+        with self._lock:
+            entry = self.stages.setdefault(stage, {"duration_ms": 0.0})
+            for name, field in OLLAMA_METRICS.items():
+                value = getattr(response, field, None)
+                if value is None:
+                    continue
+                if name.endswith("_ms"):
+                    value = value / 1e6
+                entry[name] = entry.get(name, 0) + value
+
+    def to_rows(self) -> List[dict]:
+        """
+        Flatten the timings into one row per stage
+
+        Returns:
+            List[dict]: Rows with "stage", "duration_ms", and the Ollama metrics if the stage called the LLM
+        """
+
+        with self._lock:
+            return [{"stage": stage, **entry} for stage, entry in self.stages.items()]
+
+
+_current_timings: ContextVar[Optional[Timings]] = ContextVar(
+    "current_timings", default=None
+)
+_current_stage: ContextVar[Optional[str]] = ContextVar("current_stage", default=None)
+
+
+@contextmanager
+def collect_timings(timings: Optional[Timings] = None) -> Iterator[Timings]:
+    """
+    Collect the timings of every span entered in this context (including threads started with a copy of it)
+
+    Args:
+        timings (Optional[Timings], optional): Existing timings to add to, e.g. to resume collecting in a generator. Defaults to new timings.
+
+    Yields:
+        Timings: The timings of the request
+    """
+
+    if timings is None:
+        timings = Timings()
+    token = _current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _current_timings.reset(token)
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """
+    Time the enclosed block as a stage of the current request. Does nothing outside of collect_timings.
+
+    Args:
+        stage (str): Stage name
+    """
+
+    timings = _current_timings.get()
+    stage_token = _current_stage.set(stage)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current_stage.reset(stage_token)
+        if timings is not None:
+            timings.add_duration(
+                stage=stage, duration_ms=(time.perf_counter() - start) * 1000
+            )
+
+
+def timed(stage: str) -> Callable:
+    """
+    Decorator that times every call of the function as a stage of the current request
+
+    Args:
+        stage (str): Stage name
+
+    Returns:
+        Callable: Decorator
+    """
+
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage=stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_llm_metrics(response) -> None:
+    """
+    Attach Ollama's token counts and durations from a chat response to the innermost active stage
+
+    Args:
+        response (ChatResponse): Final Ollama chat response (the last chunk when streaming)
+    """
+
+    timings = _current_timings.get()
+    stage = _current_stage.get()
+    if timings is not None and stage is not None:
+        timings.add_llm_metrics(stage=stage, response=response)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Compute a percentile with linear interpolation between the closest ranks
+
+    Args:
+        values (List[float]): Values, at least one
+        q (float): Percentile between 0 and 100
+
+    Returns:
+        float: The q-th percentile of the values
+    """
+
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
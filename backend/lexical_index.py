@@ -0,0 +1,320 @@
+# File to build and query a persistent BM25 keyword index of the chunks in the vectorstore
+
+from collections import Counter
+from functools import lru_cache
+import math
+import os
+import re
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+LEXICAL_INDEX_PATH = "./data/chromadb/bm25.sqlite3"
+BM25_K1 = 1.2  # Term frequency saturation
+BM25_B = 0.75  # Document length normalization
+# Words too common to help find a chunk
+STOPWORDS = {
+    "a",
+    "an",
+    "and",
+    "are",
+    "as",
+    "at",
+    "be",
+    "by",
+    "for",
+    "from",
+    "how",
+    "in",
+    "is",
+    "it",
+    "of",
+    "on",
+    "or",
+    "that",
+    "the",
+    "this",
+    "to",
+    "was",
+    "were",
+    "what",
+    "which",
+    "with",
+}
+# Words, numbers, and compound terms such as "her-2/neu" or "3.5"
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-/.][a-z0-9]+)*")
+SQLITE_MAX_VARIABLES = 500  # Maximum number of parameters bound in one statement
+# Chunk metadata fields that can be filtered on, and the comparison operators of Chroma where clauses
+FILTER_FIELDS = {"filename", "page_number"}
+FILTER_OPERATORS = {
+    "$eq": "=",
+    "$ne": "!=",
+    "$gt": ">",
+    "$gte": ">=",
+    "$lt": "<",
+    "$lte": "<=",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into index terms. Compound terms are indexed both whole and by their parts, so "HER-2/neu" matches
+    queries for "HER-2/neu", "her", and "neu".
+
+    Args:
+        text (str): Text to tokenize
+
+    Returns:
+        List[str]: Lowercase terms, without stopwords
+    """
+
+    terms = []
+    for match in TOKEN_PATTERN.findall(text.lower()):
+        parts = re.split(r"[-/.]", match)
+        if len(parts) > 1:
+            terms.append(match)
+            # "her-2" is also indexed as "her2", the way it is often written
+            terms.append("".join(parts))
+        terms.extend(parts)
+
+    return [term for term in terms if term not in STOPWORDS]
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index stored in sqlite next to the vectorstore. Holds the term frequencies of every chunk,
+    and the chunk count and total length in a stats row, so a query only reads the postings of its terms.
+    """
+
+    def __init__(self, path: str):
+        """
+        Open the index at path, creating it if it doesn't exist
+
+        Args:
+            path (str): Path of the sqlite database
+        """
+
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        con = self._connection()
+        con.executescript("""CREATE TABLE IF NOT EXISTS chunks(
+                id TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                page_number INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS chunks_filename ON chunks(filename);
+            CREATE TABLE IF NOT EXISTS postings(
+                term TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (term, chunk_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_chunk_id ON postings(chunk_id);
+            CREATE TABLE IF NOT EXISTS stats(
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                num_chunks INTEGER NOT NULL,
+                total_length INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO stats VALUES (0, 0, 0);""")
+        con.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread, so retrievals in parallel threads don't share a connection"""
+        if not hasattr(self._local, "connection"):
+            con = sqlite3.connect(self.path)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = con
+        return self._local.connection
+
+    def count(self) -> int:
+        """
+        Count the indexed chunks
+
+        Returns:
+            int: Number of chunks
+        """
+
+        return self._connection().execute("SELECT num_chunks FROM stats").fetchone()[0]
+
+    def add(self, ids: List[str], documents: List[str], metadatas: List[dict]) -> None:
+        """
+        Index chunks. Chunks that are already indexed are replaced, so adding a batch again is harmless.
+
+        Args:
+            ids (List[str]): Chunk ids, the same as in the vectorstore
+            documents (List[str]): Chunk text
+            metadatas (List[dict]): Chunk metadata with "filename" and "page_number"
+        """
+
+        con = self._connection()
+        with con:
+            self._delete(con=con, ids=ids)
+            total_length = 0
+            for chunk_id, document, metadata in zip(ids, documents, metadatas):
+                terms = Counter(tokenize(text=document))
+                length = sum(terms.values())
+                total_length += length
+                con.execute(
+                    "INSERT INTO chunks VALUES (?, ?, ?, ?)",
+                    (chunk_id, metadata["filename"], metadata["page_number"], length),
+                )
+                con.executemany(
+                    "INSERT INTO postings VALUES (?, ?, ?)",
+                    [(term, chunk_id, tf) for term, tf in terms.items()],
+                )
+            con.execute(
+                "UPDATE stats SET num_chunks = num_chunks + ?, total_length = total_length + ?",
+                (len(ids), total_length),
+            )
+
+    def delete_file(self, filename: str) -> None:
+        """
+        Remove all chunks of a file from the index
+
+        Args:
+            filename (str): Filename as stored in the chunk metadata
+        """
+
+        con = self._connection()
+        with con:
+            ids = [
+                row[0]
+                for row in con.execute(
+                    "SELECT id FROM chunks WHERE filename = ?", (filename,)
+                )
+            ]
+            self._delete(con=con, ids=ids)
+
+    def _delete(self, con: sqlite3.Connection, ids: List[str]) -> None:
+        """Delete chunks and update the stats, inside the caller's transaction"""
+        for start in range(0, len(ids), SQLITE_MAX_VARIABLES):
+            batch = ids[start : start + SQLITE_MAX_VARIABLES]
+            placeholders = ",".join("?" * len(batch))
+            num_chunks, total_length = con.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks WHERE id IN ({placeholders})",
+                batch,
+            ).fetchone()
+            if not num_chunks:
+                continue
+            con.execute(
+                f"DELETE FROM postings WHERE chunk_id IN ({placeholders})", batch
+            )
+            con.execute(f"DELETE FROM chunks WHERE id IN ({placeholders})", batch)
+            con.execute(
+                "UPDATE stats SET num_chunks = num_chunks - ?, total_length = total_length - ?",
+                (num_chunks, total_length),
+            )
+
+    def clear(self) -> None:
+        """Remove every chunk from the index"""
+        con = self._connection()
+        with con:
+            con.execute("DELETE FROM postings")
+            con.execute("DELETE FROM chunks")
+            con.execute("UPDATE stats SET num_chunks = 0, total_length = 0")
+
+    def search(
+        self, query: str, n_results: int, where: Optional[dict] = None
+    ) -> List[Tuple[str, float]]:
+        """
+        Rank chunks by their BM25 score for the query
+
+        Args:
+            query (str): Search query
+            n_results (int): Maximum number of chunks to return
+            where (Optional[dict], optional): Chroma where clause on "filename" and "page_number" that chunks must
+                match. Defaults to None (all chunks).
+
+        Returns:
+            List[Tuple[str, float]]: Chunk ids and scores, best first. Chunks without any query term are left out.
+        """
+
+        terms = list(dict.fromkeys(tokenize(text=query)))[:SQLITE_MAX_VARIABLES]
+        if not terms:
+            return []
+
+        con = self._connection()
+        num_chunks, total_length = con.execute(
+            "SELECT num_chunks, total_length FROM stats"
+        ).fetchone()
+        if not num_chunks:
+            return []
+        average_length = total_length / num_chunks
+
+        placeholders = ",".join("?" * len(terms))
+        filter_sql, filter_params = where_to_sql(where=where) if where else ("1", [])
+        rows = con.execute(
+            f"""SELECT p.term, p.chunk_id, p.tf, c.length FROM postings p
+            JOIN chunks c ON c.id = p.chunk_id WHERE p.term IN ({placeholders}) AND {filter_sql}""",
+            terms + filter_params,
+        ).fetchall()
+
+        document_frequency = Counter(term for term, _, _, _ in rows)
+        scores: Dict[str, float] = {}
+        for term, chunk_id, tf, length in rows:
+            df = document_frequency[term]
+            idf = math.log(1 + (num_chunks - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / (
+                tf + norm
+            )
+
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[
+            :n_results
+        ]
+
+
+def where_to_sql(where: dict) -> Tuple[str, list]:
+    """
+    Translate a Chroma where clause on chunk metadata into a condition on the chunks table
+
+    Args:
+        where (dict): Where clause with "$and", "$or", and comparisons of FILTER_FIELDS
+
+    Raises:
+        ValueError: If the clause uses other fields or operators
+
+    Returns:
+        Tuple[str, list]: SQL condition and its parameters
+    """
+
+    conditions, params = [], []
+    for key, value in where.items():
+        if key in ("$and", "$or"):
+            parts = [where_to_sql(where=condition) for condition in value]
+            joiner = " AND " if key == "$and" else " OR "
+            conditions.append("(" + joiner.join(sql for sql, _ in parts) + ")")
+            params.extend(param for _, part_params in parts for param in part_params)
+            continue
+        if key not in FILTER_FIELDS:
+            raise ValueError(f"Can't filter keyword search on {key!r}")
+
+        comparisons = value if isinstance(value, dict) else {"$eq": value}
+        for operator, operand in comparisons.items():
+            if operator in ("$in", "$nin"):
+                placeholders = ",".join("?" * len(operand))
+                negation = "NOT " if operator == "$nin" else ""
+                conditions.append(f"c.{key} {negation}IN ({placeholders})")
+                params.extend(operand)
+            elif operator in FILTER_OPERATORS:
+                conditions.append(f"c.{key} {FILTER_OPERATORS[operator]} ?")
+                params.append(operand)
+            else:
+                raise ValueError(f"Unsupported filter operator {operator!r}")
+
+    return " AND ".join(conditions), params
+
+
+@lru_cache(maxsize=1)
+def get_lexical_index() -> LexicalIndex:
+    """
+    Open the keyword index once per process
+
+    Returns:
+        LexicalIndex: Shared BM25 index at LEXICAL_INDEX_PATH
+    """
+
+    return LexicalIndex(path=LEXICAL_INDEX_PATH)
@@ -0,0 +1,163 @@
+# File to manage the shared Ollama client used for all LLM calls
+
+from functools import lru_cache
+import logging
+import os
+import time
+from typing import Callable, Iterator, List
+
+import httpx
+from ollama import ChatResponse, Client, ResponseError
+
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://host.docker.internal:11434")
+# Seconds to wait for a response. Generation on CPU can take minutes, so only the connect timeout is short
+OLLAMA_TIMEOUT = float(os.environ.get("OLLAMA_TIMEOUT", "600"))
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get("OLLAMA_CONNECT_TIMEOUT", "10"))
+# How long Ollama keeps the model loaded after a request, so it isn't reloaded between turns
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+# Load a model in Ollama as soon as it is selected in the app, so the first response doesn't wait for it to load
+MODEL_WARMUP = os.environ.get("MODEL_WARMUP", "true").lower() == "true"
+OLLAMA_MAX_CONNECTIONS = int(os.environ.get("OLLAMA_MAX_CONNECTIONS", "10"))
+OLLAMA_MAX_RETRIES = int(os.environ.get("OLLAMA_MAX_RETRIES", "3"))
+# Seconds to wait before the first retry, doubled after each failed attempt
+OLLAMA_RETRY_BACKOFF = float(os.environ.get("OLLAMA_RETRY_BACKOFF", "0.5"))
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=1)
+def get_client() -> Client:
+    """
+    Create the Ollama client once per process. The underlying HTTP connection pool is thread-safe and keeps
+    connections alive, so requests don't pay connection setup.
+
+    Returns:
+        Client: Shared Ollama client
+    """
+
+    return Client(
+        host=OLLAMA_HOST,
+        timeout=httpx.Timeout(OLLAMA_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=OLLAMA_MAX_CONNECTIONS,
+            max_keepalive_connections=OLLAMA_MAX_CONNECTIONS,
+        ),
+    )
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Determine whether a failed Ollama request is worth retrying
+
+    Args:
+        error (Exception): Error raised by the Ollama client
+
+    Returns:
+        bool: True for connection problems, timeouts, and server-side errors
+    """
+
+    if isinstance(error, ResponseError):
+        return error.status_code >= 500 or error.status_code == 429
+
+    return isinstance(error, (ConnectionError, httpx.TransportError))
+
+
+def with_retries(request: Callable):
+    """
+    Run the request, retrying with exponential backoff when it fails with a retryable error
+
+    Args:
+        request (Callable): Function without arguments that sends the request
+
+    Returns:
+        Any: Result of the request
+    """
+
+    for attempt in range(OLLAMA_MAX_RETRIES + 1):
+        try:
+            return request()
+        except Exception as error:
+            if attempt == OLLAMA_MAX_RETRIES or not is_retryable(error):
+                raise
+            delay = OLLAMA_RETRY_BACKOFF * 2**attempt
+            logger.warning(
+                f"Ollama request failed ({error}), retrying in {delay:.1f} seconds"
+            )
+            time.sleep(delay)
+
+
+def chat(model: str, messages: List[dict], options: dict) -> ChatResponse:
+    """
+    Send a chat request to Ollama with the shared client
+
+    Args:
+        model (str): The model name to use for completion
+        messages (List[dict]): Input messages
+        options (dict): Model options, e.g. temperature
+
+    Returns:
+        ChatResponse: Full chat response, including the message and Ollama's timing and token counts
+    """
+
+    return with_retries(
+        lambda: get_client().chat(
+            model=model,
+            messages=messages,
+            options=options,
+            keep_alive=OLLAMA_KEEP_ALIVE,
+        )
+    )
+
+
+def chat_stream(
+    model: str, messages: List[dict], options: dict
+) -> Iterator[ChatResponse]:
+    """
+    Send a streaming chat request to Ollama with the shared client. The request is retried until the first chunk
+    arrives; errors after that are raised to the caller since part of the response was already consumed. Closing the
+    iterator before the last chunk closes the HTTP response, which makes Ollama stop generating.
+
+    Args:
+        model (str): The model name to use for completion
+        messages (List[dict]): Input messages
+        options (dict): Model options, e.g. temperature
+
+    Yields:
+        ChatResponse: Chat response chunks. The final chunk has done=True and Ollama's timing and token counts.
+    """
+
+    def start_stream():
+        stream = get_client().chat(
+            model=model,
+            messages=messages,
+            options=options,
+            keep_alive=OLLAMA_KEEP_ALIVE,
+            stream=True,
+        )
+        return stream, next(stream, None)
+
+    stream, first_chunk = with_retries(start_stream)
+    if first_chunk is None:
+        return
+
+    try:
+        yield first_chunk
+        yield from stream
+    finally:
+        stream.close()
+
+
+def preload(model: str, options: dict) -> None:
+    """
+    Load a model in Ollama without generating anything, and keep it loaded for OLLAMA_KEEP_ALIVE
+
+    Args:
+        model (str): The model name to load
+        options (dict): Model options of later requests. Ollama reloads the model if num_ctx differs.
+    """
+
+    with_retries(
+        lambda: get_client().chat(
+            model=model, messages=[], options=options, keep_alive=OLLAMA_KEEP_ALIVE
+        )
+    )
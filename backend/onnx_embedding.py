@@ -0,0 +1,120 @@
+# File to embed text with an int8 quantized ONNX export of the MiniLM embedding model on the CPU
+
+import os
+from typing import List
+
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+import numpy as np
+
+# Hugging Face Hub repository with ONNX exports of the embedding model, including int8 quantized ones
+EMBEDDING_ONNX_REPO = "sentence-transformers/all-MiniLM-L6-v2"
+# Quantized export to run. onnx/model_qint8_avx512.onnx suits CPUs with AVX-512, onnx/model_qint8_arm64.onnx ARM CPUs
+EMBEDDING_ONNX_FILE = os.environ.get(
+    "EMBEDDING_ONNX_FILE", "onnx/model_quint8_avx2.onnx"
+)
+EMBEDDING_MODEL_DIR = "./models/embedding/"
+# Threads used by one embedding call. 0 lets onnxruntime use every physical core.
+EMBEDDING_THREADS = int(os.environ.get("EMBEDDING_THREADS", "0"))
+# Texts are truncated to this many tokens, the length the model was trained on
+EMBEDDING_MAX_TOKENS = 256
+
+
+class QuantizedOnnxEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    Embedding function that runs an int8 quantized ONNX export of the embedding model with onnxruntime.
+    Embeddings are mean pooled and normalized, like those of Chroma's default embedding function, but not identical
+    to them, so a collection must be embedded with one or the other.
+    """
+
+    def __init__(
+        self,
+        model_name: str = EMBEDDING_ONNX_REPO,
+        model_file: str = EMBEDDING_ONNX_FILE,
+        cache_dir: str = EMBEDDING_MODEL_DIR,
+        threads: int = EMBEDDING_THREADS,
+        batch_size: int = 32,
+    ):
+        """
+        Download the model if needed and load it
+
+        Args:
+            model_name (str, optional): Hugging Face Hub repository of the model. Defaults to EMBEDDING_ONNX_REPO.
+            model_file (str, optional): ONNX file in the repository. Defaults to EMBEDDING_ONNX_FILE.
+            cache_dir (str, optional): Directory the model is downloaded to. Defaults to EMBEDDING_MODEL_DIR.
+            threads (int, optional): Intra-op threads of onnxruntime, 0 for its default. Defaults to EMBEDDING_THREADS.
+            batch_size (int, optional): Number of texts per model call. Defaults to 32.
+        """
+
+        # Imported here, so they are only loaded when this embedding function is used
+        from huggingface_hub import hf_hub_download
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        model_path = hf_hub_download(
+            repo_id=model_name, filename=model_file, cache_dir=cache_dir
+        )
+        tokenizer_path = hf_hub_download(
+            repo_id=model_name, filename="tokenizer.json", cache_dir=cache_dir
+        )
+
+        self.batch_size = batch_size
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length=EMBEDDING_MAX_TOKENS)
+        self.tokenizer.enable_padding()
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        # A single model call never runs independent branches in parallel, so one inter-op thread is enough
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self.session = onnxruntime.InferenceSession(
+            model_path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {
+            model_input.name for model_input in self.session.get_inputs()
+        }
+
+    def __call__(self, input: Documents) -> Embeddings:
+        """
+        Embed the input texts
+
+        Args:
+            input (Documents): Texts to embed
+
+        Returns:
+            Embeddings: One normalized float32 embedding per input text
+        """
+
+        # Texts of similar length are batched together, so little compute is spent on padding
+        order = sorted(range(len(input)), key=lambda i: len(input[i]))
+        embeddings: List[np.ndarray] = [None] * len(input)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            for i, embedding in zip(batch, self._embed([input[i] for i in batch])):
+                embeddings[i] = embedding
+
+        return embeddings
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        """Embed one batch of texts with the model, mean pooling the token embeddings"""
+        encoded = self.tokenizer.encode_batch(texts)
+        attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+        inputs = {
+            "input_ids": np.array([e.ids for e in encoded], dtype=np.int64),
+            "attention_mask": attention_mask,
+            "token_type_ids": np.array([e.type_ids for e in encoded], dtype=np.int64),
+        }
+        token_embeddings = self.session.run(
+            None,
+            {name: value for name, value in inputs.items() if name in self.input_names},
+        )[0]
+
+        mask = attention_mask[:, :, None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(
+            mask.sum(axis=1), 1e-9, None
+        )
+        norms = np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+        return (pooled / norms).astype(np.float32)
@@ -0,0 +1,111 @@
+# File to assemble LLM prompts from templates and the per-corpus configuration
+
+from functools import lru_cache
+import json
+import os
+
+# Optional description of the documents in /data. "abstract" (str) is added to every prompt, "document_type" (str, e.g.
+# "article") is used to refer to the documents. Without the file, prompts only use the retrieved context.
+CORPUS_CONFIG_PATH = "./data/corpus.json"
+DEFAULT_DOCUMENT_TYPE = "documents"
+
+# Each prompt starts with the same static instructions (and abstract), followed by the parts that change per request.
+# Keeping the static part first lets Ollama reuse its cached computation of that prefix across requests.
+PROMPT_TEMPLATES = {
+    "response": {
+        "instructions": "You are an assistant that answers user questions based only on the supplied {sources}. "
+        "Only answer using information in the {sources}. "
+        "If the information needed to answer the question is not in the {sources}, just answer with 'I don't know the answer.' and no other text. "
+        "Only include your answer and no additional reasoning or thought process.",
+        "sources": "context",
+        "sources_with_abstract": "context and abstract",
+        "context": "BEGIN CONTEXT:\n{context}\nEND CONTEXT",
+    },
+    "rewrite": {
+        "instructions": "Use the recent chat history{sources} to rewrite the last user message into an updated user query "
+        "that will return relevant context from the {document_type} to answer their question. "
+        "If the current user query is sufficient, just return the same query. "
+        "Only return the updated user query and no additional text, explanation, or thought process.",
+        "sources": "",
+        "sources_with_abstract": " and the {document_type} abstract",
+    },
+}
+ABSTRACT_TEMPLATE = "BEGIN ABSTRACT:\n{abstract}\nEND ABSTRACT"
+
+
+def load_corpus_config(path: str = CORPUS_CONFIG_PATH) -> dict:
+    """
+    Load the corpus configuration. It is read again only when the file changes.
+
+    Args:
+        path (str, optional): Path of the configuration file. Defaults to CORPUS_CONFIG_PATH.
+
+    Returns:
+        dict: Corpus configuration, empty if the file doesn't exist
+    """
+
+    if not os.path.isfile(path):
+        return {}
+
+    return read_corpus_config(path=path, modified=os.path.getmtime(path))
+
+
+@lru_cache(maxsize=4)
+def read_corpus_config(path: str, modified: float) -> dict:
+    """
+    Read the corpus configuration file, cached per modification time
+
+    Args:
+        path (str): Path of the configuration file
+        modified (float): Modification time of the file, part of the cache key
+
+    Returns:
+        dict: Corpus configuration
+    """
+
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def get_static_prompt(name: str) -> str:
+    """
+    Build the static part of a prompt: the instructions followed by the corpus abstract, if configured.
+    The result is identical for every request, so it can be reused from Ollama's prompt cache.
+
+    Args:
+        name (str): Template name in PROMPT_TEMPLATES
+
+    Returns:
+        str: Static system prompt
+    """
+
+    config = load_corpus_config()
+    template = PROMPT_TEMPLATES[name]
+    document_type = config.get("document_type", DEFAULT_DOCUMENT_TYPE)
+    abstract = config.get("abstract", "").strip()
+
+    sources = template["sources_with_abstract" if abstract else "sources"]
+    prompt = template["instructions"].format(
+        sources=sources.format(document_type=document_type),
+        document_type=document_type,
+    )
+    if abstract:
+        prompt = f"{prompt}\n\n{ABSTRACT_TEMPLATE.format(abstract=abstract)}"
+
+    return prompt
+
+
+def render_prompt_part(name: str, part: str, **values: str) -> str:
+    """
+    Fill in a variable part of a prompt template
+
+    Args:
+        name (str): Template name in PROMPT_TEMPLATES
+        part (str): Part of the template, e.g. "context"
+        **values (str): Values of the template fields
+
+    Returns:
+        str: The filled in part
+    """
+
+    return PROMPT_TEMPLATES[name][part].format(**values)
@@ -0,0 +1,156 @@
+# File to rerank retrieved chunks with a local cross-encoder
+
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import math
+import os
+import threading
+from typing import List
+
+import numpy as np
+
+from backend.instrumentation import timed
+
+# Rerank retrieved chunks before they are sent to the LLM. Set RERANKER_ENABLED=true to turn it on for a deployment.
+RERANKER_ENABLED = os.environ.get("RERANKER_ENABLED", "false").lower() == "true"
+# ONNX export of a cross-encoder on the Hugging Face Hub, with onnx/model.onnx and tokenizer.json
+RERANKER_MODEL = os.environ.get("RERANKER_MODEL", "cross-encoder/ms-marco-MiniLM-L6-v2")
+RERANKER_CACHE_DIR = "./models/reranker/"
+RERANK_CANDIDATES = 30  # Number of chunks retrieved for reranking
+RERANK_RESULTS = 3  # Number of best reranked chunks passed to the LLM
+RERANK_BATCH_SIZE = 16  # Number of query and chunk pairs scored per model call
+RERANK_MAX_TOKENS = 512  # Query and chunk pairs are truncated to this many tokens
+RERANK_CACHE_SIZE = 10000  # Number of query and chunk scores kept in memory
+
+
+class CrossEncoder:
+    """
+    Cross-encoder that scores the relevance of a chunk to a query, run with onnxruntime on the CPU.
+    Scores of query and chunk pairs are cached, so chunks retrieved again for the same query aren't scored again.
+    """
+
+    def __init__(self, model_name: str, cache_dir: str):
+        """
+        Download the model if needed and load it
+
+        Args:
+            model_name (str): Hugging Face Hub repository of the model
+            cache_dir (str): Directory the model is downloaded to
+        """
+
+        # Imported here, so the app doesn't load them unless reranking is enabled
+        from huggingface_hub import hf_hub_download
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        model_path = hf_hub_download(
+            repo_id=model_name, filename="onnx/model.onnx", cache_dir=cache_dir
+        )
+        tokenizer_path = hf_hub_download(
+            repo_id=model_name, filename="tokenizer.json", cache_dir=cache_dir
+        )
+
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length=RERANK_MAX_TOKENS)
+        self.tokenizer.enable_padding()
+        self.session = onnxruntime.InferenceSession(
+            model_path, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {
+            model_input.name for model_input in self.session.get_inputs()
+        }
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def score(self, query: str, documents: List[str]) -> List[float]:
+        """
+        Score the relevance of each document to the query
+
+        Args:
+            query (str): Search query
+            documents (List[str]): Documents to score
+
+        Returns:
+            List[float]: Relevance score of each document, higher is more relevant
+        """
+
+        keys = [
+            hashlib.sha256(f"{query}\x00{document}".encode("utf-8")).hexdigest()
+            for document in documents
+        ]
+        with self._lock:
+            scores = {key: self._cache[key] for key in keys if key in self._cache}
+        missing = [i for i, key in enumerate(keys) if key not in scores]
+
+        for start in range(0, len(missing), RERANK_BATCH_SIZE):
+            batch = missing[start : start + RERANK_BATCH_SIZE]
+            encoded = self.tokenizer.encode_batch(
+                [(query, documents[i]) for i in batch]
+            )
+            inputs = {
+                "input_ids": np.array([e.ids for e in encoded], dtype=np.int64),
+                "attention_mask": np.array(
+                    [e.attention_mask for e in encoded], dtype=np.int64
+                ),
+                "token_type_ids": np.array(
+                    [e.type_ids for e in encoded], dtype=np.int64
+                ),
+            }
+            logits = self.session.run(
+                None,
+                {
+                    name: value
+                    for name, value in inputs.items()
+                    if name in self.input_names
+                },
+            )[0]
+            for i, logit in zip(batch, logits[:, 0]):
+                scores[keys[i]] = float(logit)
+
+        with self._lock:
+            for key in keys:
+                self._cache[key] = scores[key]
+                self._cache.move_to_end(key)
+            while len(self._cache) > RERANK_CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+        return [scores[key] for key in keys]
+
+
+@lru_cache(maxsize=1)
+def get_cross_encoder() -> CrossEncoder:
+    """
+    Load the cross-encoder once per process
+
+    Returns:
+        CrossEncoder: Shared RERANKER_MODEL cross-encoder
+    """
+
+    return CrossEncoder(model_name=RERANKER_MODEL, cache_dir=RERANKER_CACHE_DIR)
+
+
+@timed(stage="rerank")
+def rerank(query: str, context: dict, n_results: int) -> dict:
+    """
+    Reorder retrieved chunks by cross-encoder relevance and keep the best ones
+
+    Args:
+        query (str): Query the context was retrieved for
+        context (dict): Retrieved context with ids, documents, metadatas and distances for a single query
+        n_results (int): Number of chunks to keep
+
+    Returns:
+        dict: Context with the n_results most relevant chunks. The distance is 1 minus the relevance as a probability.
+    """
+
+    scores = get_cross_encoder().score(query=query, documents=context["documents"][0])
+    best = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+    best = best[:n_results]
+
+    return {
+        "ids": [[context["ids"][0][i] for i in best]],
+        "documents": [[context["documents"][0][i] for i in best]],
+        "metadatas": [[context["metadatas"][0][i] for i in best]],
+        "distances": [[1 - 1 / (1 + math.exp(-scores[i])) for i in best]],
+    }
@@ -0,0 +1,168 @@
+# File to cache chatbot responses so repeated questions about the same context skip generation
+
+from collections import OrderedDict
+from dataclasses import dataclass
+import re
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+RESPONSE_CACHE_TTL = 24 * 60 * 60  # Seconds before a cached response expires
+# Minimum cosine similarity for a differently worded query with the same model and retrieved chunks to reuse a response. None disables fuzzy matches
+RESPONSE_CACHE_SIMILARITY = 0.95
+
+
+@dataclass
+class CachedResponse:
+    """A cached LLM response and the query embedding used for similarity matches"""
+
+    response: str
+    query_embedding: Optional[np.ndarray]
+    created: float
+
+
+class ResponseCache:
+    """
+    In-memory LRU cache of LLM responses keyed on model, normalized retrieval query, and retrieved chunk ids.
+    Entries expire after a TTL, and the whole cache is cleared when the index version changes.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        ttl: float = RESPONSE_CACHE_TTL,
+        similarity_threshold: Optional[float] = RESPONSE_CACHE_SIMILARITY,
+        clock: Callable[[], float] = time.time,
+    ):
+        """
+        Args:
+            max_entries (int, optional): Maximum number of cached responses. Defaults to RESPONSE_CACHE_MAX_ENTRIES.
+            ttl (float, optional): Seconds before a cached response expires. Defaults to RESPONSE_CACHE_TTL.
+            similarity_threshold (Optional[float], optional): Minimum query embedding similarity for fuzzy matches. Defaults to RESPONSE_CACHE_SIMILARITY.
+            clock (Callable[[], float], optional): Current time in seconds, used for expiry. Defaults to time.time.
+        """
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.clock = clock
+        self._entries: OrderedDict[Tuple, CachedResponse] = OrderedDict()
+        self._index_version = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """Lowercase the query, collapse whitespace, and drop trailing punctuation"""
+        return re.sub(r"\s+", " ", query.lower()).strip().rstrip("?.! ")
+
+    def get(
+        self,
+        model: str,
+        retrieval_query: str,
+        chunk_ids: List[str],
+        index_version: str,
+        query_embedding: Optional[np.ndarray] = None,
+    ) -> Optional[str]:
+        """
+        Look up a cached response
+
+        Args:
+            model (str): LLM used to generate the response
+            retrieval_query (str): Query used to retrieve the context
+            chunk_ids (List[str]): Ids of the retrieved chunks, in order
+            index_version (str): Version of the indexed corpus. A new version clears the cache.
+            query_embedding (Optional[np.ndarray], optional): Embedding of the retrieval query, enables similarity matches. Defaults to None.
+
+        Returns:
+            Optional[str]: The cached response, or None on a cache miss
+        """
+
+        key = (model, self.normalize_query(retrieval_query), tuple(chunk_ids))
+        with self._lock:
+            self._check_version(index_version=index_version)
+
+            entry = self._entries.get(key)
+            if entry is None and query_embedding is not None:
+                key, entry = self._find_similar(
+                    model=model,
+                    chunk_ids=tuple(chunk_ids),
+                    query_embedding=query_embedding,
+                )
+            if entry is None:
+                return None
+
+            if self.clock() - entry.created > self.ttl:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return entry.response
+
+    def put(
+        self,
+        model: str,
+        retrieval_query: str,
+        chunk_ids: List[str],
+        index_version: str,
+        response: str,
+        query_embedding: Optional[np.ndarray] = None,
+    ) -> None:
+        """
+        Add a response to the cache, evicting the least recently used entry if the cache is full
+
+        Args:
+            model (str): LLM used to generate the response
+            retrieval_query (str): Query used to retrieve the context
+            chunk_ids (List[str]): Ids of the retrieved chunks, in order
+            index_version (str): Version of the indexed corpus the response was generated from
+            response (str): The generated response
+            query_embedding (Optional[np.ndarray], optional): Embedding of the retrieval query. Defaults to None.
+        """
+
+        key = (model, self.normalize_query(retrieval_query), tuple(chunk_ids))
+        with self._lock:
+            self._check_version(index_version=index_version)
+            self._entries[key] = CachedResponse(
+                response=response, query_embedding=query_embedding, created=self.clock()
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Remove all cached responses"""
+        with self._lock:
+            self._entries.clear()
+
+    def _check_version(self, index_version: str) -> None:
+        """Clear the cache if the indexed corpus changed since the cached responses were generated"""
+        if index_version != self._index_version:
+            self._entries.clear()
+            self._index_version = index_version
+
+    def _find_similar(
+        self, model: str, chunk_ids: Tuple[str], query_embedding: np.ndarray
+    ) -> Tuple[Optional[Tuple], Optional[CachedResponse]]:
+        """Find the most similar cached query with the same model and retrieved chunks"""
+
+        if self.similarity_threshold is None:
+            return None, None
+
+        best_key, best_entry, best_similarity = None, None, self.similarity_threshold
+        for key, entry in self._entries.items():
+            if key[0] != model or key[2] != chunk_ids or entry.query_embedding is None:
+                continue
+            similarity = np.dot(query_embedding, entry.query_embedding) / (
+                np.linalg.norm(query_embedding) * np.linalg.norm(entry.query_embedding)
+            )
+            if similarity >= best_similarity:
+                best_key, best_entry, best_similarity = key, entry, similarity
+
+        return best_key, best_entry
+
+
+response_cache = ResponseCache()
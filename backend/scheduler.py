@@ -0,0 +1,208 @@
+# File to schedule chatbot requests from concurrent user sessions onto the LLM server
+
+from collections import deque
+from functools import lru_cache
+import os
+import threading
+from typing import Dict, Iterator, Optional
+
+# Requests generating with the same model at once. Match OLLAMA_NUM_PARALLEL of the Ollama server, more requests only
+# make every response slower. Additional requests wait in a first in, first out queue per model.
+MODEL_CONCURRENCY = int(os.environ.get("MODEL_CONCURRENCY", "1"))
+# Requests that may wait across all models. Beyond this, new requests are rejected instead of waiting indefinitely.
+MAX_QUEUED_REQUESTS = int(os.environ.get("MAX_QUEUED_REQUESTS", "20"))
+
+
+class QueueFullError(RuntimeError):
+    """Raised when a request is submitted while MAX_QUEUED_REQUESTS requests are already waiting"""
+
+
+class Ticket:
+    """
+    A request's place in the scheduler. The request may run once wait() returns with the ticket not cancelled,
+    and must call release() when it is done, also when it failed or was cancelled.
+    """
+
+    def __init__(self, scheduler: "RequestScheduler", session_id: str, model: str):
+        """
+        Args:
+            scheduler (RequestScheduler): Scheduler that issued the ticket
+            session_id (str): Id of the user session the request belongs to
+            model (str): The LLM the request uses
+        """
+
+        self.scheduler = scheduler
+        self.session_id = session_id
+        self.model = model
+        self.state = "waiting"  # "waiting", "running", or "done"
+        # Set when the request is cancelled, e.g. because its session submitted a newer request
+        self.cancelled = False
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until the request may run or is cancelled
+
+        Args:
+            timeout (Optional[float], optional): Maximum number of seconds to wait. Defaults to None (no limit).
+
+        Returns:
+            bool: True if the request may run or was cancelled, False if it is still waiting
+        """
+
+        with self.scheduler.condition:
+            return self.scheduler.condition.wait_for(
+                lambda: self.state != "waiting" or self.cancelled, timeout=timeout
+            )
+
+    def position(self) -> int:
+        """
+        Get the number of requests for the same model ahead of this one
+
+        Returns:
+            int: Requests ahead in the queue, 0 once the request runs
+        """
+
+        with self.scheduler.condition:
+            queue = self.scheduler.waiting.get(self.model, deque())
+            return queue.index(self) if self in queue else 0
+
+    def guard(self, stream: Iterator[str]) -> Iterator[str]:
+        """
+        Pass tokens through until the request is cancelled. The stream is closed when the guard stops, also when the
+        caller stops reading early, so the LLM server stops generating a response nobody reads.
+
+        Args:
+            stream (Iterator[str]): Response tokens
+
+        Yields:
+            str: Response tokens, stopping early if the request is cancelled
+        """
+
+        try:
+            for token in stream:
+                if self.cancelled:
+                    return
+                yield token
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+
+    def release(self) -> None:
+        """Give up the request's place, so the next waiting request can run"""
+        self.scheduler.release(ticket=self)
+
+
+class RequestScheduler:
+    """
+    Admits chatbot requests to the LLM server with a bounded number of requests per model running at once.
+    Requests that can't run yet wait in a bounded first in, first out queue per model. Each session has at most one
+    request: submitting a new one cancels the session's previous request, e.g. when the user sends another message
+    before the response finished.
+    """
+
+    def __init__(
+        self,
+        model_concurrency: int = MODEL_CONCURRENCY,
+        max_queued: int = MAX_QUEUED_REQUESTS,
+    ):
+        """
+        Args:
+            model_concurrency (int, optional): Requests running at once per model. Defaults to MODEL_CONCURRENCY.
+            max_queued (int, optional): Maximum number of waiting requests. Defaults to MAX_QUEUED_REQUESTS.
+        """
+
+        self.model_concurrency = model_concurrency
+        self.max_queued = max_queued
+        self.condition = threading.Condition()
+        self.waiting: Dict[str, deque] = {}
+        self.running: Dict[str, int] = {}
+        self.sessions: Dict[str, Ticket] = {}
+
+    def submit(self, session_id: str, model: str) -> Ticket:
+        """
+        Queue a request. The session's previous request is cancelled.
+
+        Args:
+            session_id (str): Id of the user session
+            model (str): The LLM the request uses
+
+        Raises:
+            QueueFullError: If MAX_QUEUED_REQUESTS requests are already waiting
+
+        Returns:
+            Ticket: The request's ticket
+        """
+
+        with self.condition:
+            previous = self.sessions.get(session_id)
+            if previous is not None:
+                self.cancel(ticket=previous)
+
+            if sum(len(queue) for queue in self.waiting.values()) >= self.max_queued:
+                raise QueueFullError(
+                    "The chatbot is busy with other requests. Please try again in a moment."
+                )
+
+            ticket = Ticket(scheduler=self, session_id=session_id, model=model)
+            self.waiting.setdefault(model, deque()).append(ticket)
+            self.sessions[session_id] = ticket
+            self._dispatch(model=model)
+
+        return ticket
+
+    def cancel(self, ticket: Ticket) -> None:
+        """
+        Cancel a request. A waiting request leaves the queue. A running request keeps its place until it is released,
+        since the LLM may still be generating, but stops streaming its response.
+
+        Args:
+            ticket (Ticket): The request's ticket
+        """
+
+        with self.condition:
+            ticket.cancelled = True
+            if ticket.state == "waiting":
+                self.waiting[ticket.model].remove(ticket)
+                ticket.state = "done"
+            self.condition.notify_all()
+
+    def release(self, ticket: Ticket) -> None:
+        """
+        Release a request's place and start the next waiting request for the model
+
+        Args:
+            ticket (Ticket): The request's ticket
+        """
+
+        with self.condition:
+            if ticket.state == "waiting":
+                self.waiting[ticket.model].remove(ticket)
+            elif ticket.state == "running":
+                self.running[ticket.model] -= 1
+            ticket.state = "done"
+            if self.sessions.get(ticket.session_id) is ticket:
+                del self.sessions[ticket.session_id]
+            self._dispatch(model=ticket.model)
+
+    def _dispatch(self, model: str) -> None:
+        """Start waiting requests for the model while it has free places. Called with the condition held."""
+        queue = self.waiting.get(model, deque())
+        while queue and self.running.get(model, 0) < self.model_concurrency:
+            ticket = queue.popleft()
+            ticket.state = "running"
+            self.running[model] = self.running.get(model, 0) + 1
+        self.condition.notify_all()
+
+
+@lru_cache(maxsize=1)
+def get_scheduler() -> RequestScheduler:
+    """
+    Create the scheduler once per process, so chat responses and background LLM calls, e.g. chat history summaries,
+    share the per-model limits
+
+    Returns:
+        RequestScheduler: Shared scheduler
+    """
+
+    return RequestScheduler()
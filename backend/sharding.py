@@ -0,0 +1,248 @@
+# File to spread the vectorstore over several collections, each holding a fixed set of documents
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from typing import Dict, List, Optional
+
+import chromadb
+import numpy as np
+
+
+def shard_for_file(filename: str, num_shards: int) -> int:
+    """
+    Pick the shard that stores all chunks of a file. The assignment only depends on the filename, so it stays the same
+    across restarts and adding files never moves the chunks of other files.
+
+    Args:
+        filename (str): Filename as stored in the chunk metadata
+        num_shards (int): Number of shards
+
+    Returns:
+        int: Shard number
+    """
+
+    digest = hashlib.sha256(filename.encode("utf-8")).hexdigest()
+
+    return int(digest, 16) % num_shards
+
+
+def filter_filenames(where: Optional[dict]) -> Optional[List[str]]:
+    """
+    Find the files a where clause restricts the chunks to
+
+    Args:
+        where (Optional[dict]): Chroma where clause
+
+    Returns:
+        Optional[List[str]]: Filenames that matching chunks can belong to, or None if any file can match
+    """
+
+    if not where:
+        return None
+    if "$and" in where:
+        for condition in where["$and"]:
+            filenames = filter_filenames(where=condition)
+            if filenames is not None:
+                return filenames
+        return None
+
+    condition = where.get("filename")
+    if isinstance(condition, str):
+        return [condition]
+    if isinstance(condition, dict):
+        if "$eq" in condition:
+            return [condition["$eq"]]
+        if "$in" in condition:
+            return list(condition["$in"])
+
+    return None
+
+
+class ShardedCollection:
+    """
+    Vectorstore split over several ChromaDB collections, with all chunks of a document in the same collection.
+    Queries search the collections in parallel and merge the results by distance, so each search covers a fraction
+    of the corpus. Queries filtered to some documents only search the collections that hold them.
+    Provides the parts of the chromadb.Collection interface the app uses.
+    """
+
+    def __init__(self, shards: List[chromadb.Collection]):
+        """
+        Args:
+            shards (List[chromadb.Collection]): Collections in shard order
+        """
+
+        self.shards = shards
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(shards), thread_name_prefix="shard-query"
+        )
+
+    @property
+    def metadata(self) -> Optional[dict]:
+        """Metadata of the shards, which are all created with the same metadata"""
+        return self.shards[0].metadata
+
+    def _shards_for(self, where: Optional[dict]) -> List[chromadb.Collection]:
+        """Shards that can hold chunks matching the where clause"""
+        filenames = filter_filenames(where=where)
+        if filenames is None:
+            return self.shards
+
+        numbers = {shard_for_file(f, num_shards=len(self.shards)) for f in filenames}
+
+        return [self.shards[i] for i in sorted(numbers)]
+
+    def count(self) -> int:
+        """
+        Count the chunks in all shards
+
+        Returns:
+            int: Number of chunks
+        """
+
+        return sum(shard.count() for shard in self.shards)
+
+    def add(
+        self,
+        ids: List[str],
+        documents: List[str],
+        embeddings: List[np.ndarray],
+        metadatas: List[dict],
+    ) -> None:
+        """
+        Add chunks to the shards of their files
+
+        Args:
+            ids (List[str]): Chunk ids
+            documents (List[str]): Chunk text
+            embeddings (List[np.ndarray]): Chunk embeddings
+            metadatas (List[dict]): Chunk metadata with "filename"
+        """
+
+        groups: Dict[int, List[int]] = {}
+        for i, metadata in enumerate(metadatas):
+            shard = shard_for_file(metadata["filename"], num_shards=len(self.shards))
+            groups.setdefault(shard, []).append(i)
+
+        for shard, indices in groups.items():
+            self.shards[shard].add(
+                ids=[ids[i] for i in indices],
+                documents=[documents[i] for i in indices],
+                embeddings=[embeddings[i] for i in indices],
+                metadatas=[metadatas[i] for i in indices],
+            )
+
+    def delete(self, where: dict) -> None:
+        """
+        Delete the chunks matching a where clause
+
+        Args:
+            where (dict): Chroma where clause
+        """
+
+        for shard in self._shards_for(where=where):
+            shard.delete(where=where)
+
+    def get(
+        self,
+        ids: Optional[List[str]] = None,
+        where: Optional[dict] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        include: Optional[List[str]] = None,
+    ) -> dict:
+        """
+        Get chunks by id or where clause, or page through all chunks with limit and offset
+
+        Args:
+            ids (Optional[List[str]], optional): Chunk ids. Defaults to None.
+            where (Optional[dict], optional): Chroma where clause. Defaults to None.
+            limit (Optional[int], optional): Maximum number of chunks, only without ids and where. Defaults to None.
+            offset (Optional[int], optional): Chunks to skip over the shards in order, only without ids and where.
+                Defaults to None.
+            include (Optional[List[str]], optional): Fields to return. Defaults to documents and metadatas.
+
+        Raises:
+            ValueError: If limit or offset is combined with ids or where
+
+        Returns:
+            dict: "ids" and the included fields, each a flat list
+        """
+
+        include = ["documents", "metadatas"] if include is None else include
+
+        if limit is None and offset is None:
+            results = list(
+                self._executor.map(
+                    lambda shard: shard.get(ids=ids, where=where, include=include),
+                    self._shards_for(where=where),
+                )
+            )
+        elif ids is not None or where is not None:
+            raise ValueError(
+                "Paging with limit and offset is only supported over all chunks"
+            )
+        else:
+            # Walk the shards in order, so consecutive pages cover every chunk once
+            results = []
+            skip = offset or 0
+            remaining = limit
+            for shard in self.shards:
+                size = shard.count()
+                if skip >= size:
+                    skip -= size
+                    continue
+                result = shard.get(limit=remaining, offset=skip, include=include)
+                results.append(result)
+                skip = 0
+                if remaining is not None:
+                    remaining -= len(result["ids"])
+                    if remaining <= 0:
+                        break
+
+        merged = {"ids": [chunk_id for result in results for chunk_id in result["ids"]]}
+        for key in include:
+            merged[key] = [value for result in results for value in result[key]]
+
+        return merged
+
+    def query(
+        self,
+        query_embeddings: List[np.ndarray],
+        n_results: int,
+        where: Optional[dict] = None,
+    ) -> dict:
+        """
+        Search the shards in parallel and keep the closest chunks of all shards for each query
+
+        Args:
+            query_embeddings (List[np.ndarray]): Query embeddings
+            n_results (int): Number of chunks per query
+            where (Optional[dict], optional): Chroma where clause. Defaults to None.
+
+        Returns:
+            dict: "ids", "documents", "metadatas", and "distances", one list per query sorted by distance
+        """
+
+        results = list(
+            self._executor.map(
+                lambda shard: shard.query(
+                    query_embeddings=query_embeddings, n_results=n_results, where=where
+                ),
+                self._shards_for(where=where),
+            )
+        )
+
+        merged = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for i in range(len(query_embeddings)):
+            candidates = [
+                (result["distances"][i][j], result, j)
+                for result in results
+                for j in range(len(result["ids"][i]))
+            ]
+            candidates.sort(key=lambda candidate: candidate[0])
+            candidates = candidates[:n_results]
+            for key in merged:
+                merged[key].append([result[key][i][j] for _, result, j in candidates])
+
+        return merged
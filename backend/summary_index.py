@@ -0,0 +1,423 @@
+# File to summarize every page and document at ingestion time, and to retrieve the summaries for broad questions
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import logging
+import os
+from typing import Dict, List, Optional
+
+import chromadb
+from PyPDF2 import PdfReader
+
+from backend.chat_history import truncate
+from backend.context_packing import get_context_window
+from backend.data_prep import (
+    count_tokens,
+    get_chroma_client,
+    get_embedding_function,
+    get_embedding_model,
+    update_ingestion_status,
+)
+from backend.instrumentation import timed
+from backend.llm_client import chat
+from backend.prompts import DEFAULT_DOCUMENT_TYPE, load_corpus_config
+
+# Ollama model that writes the summaries during ingestion. Empty (the default) turns the summary index off.
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "")
+SUMMARY_COLLECTION = "summaries"
+# Pages summarized at once. Set OLLAMA_NUM_PARALLEL on the Ollama server to at least this.
+SUMMARY_WORKERS = int(os.environ.get("SUMMARY_WORKERS", "2"))
+# Target length of a page summary. Shorter pages are stored as they are.
+PAGE_SUMMARY_WORDS = 80
+DOCUMENT_SUMMARY_WORDS = 300  # Target length of a document summary
+# Tokens of text summarized in one LLM call. Longer pages are cut, and documents whose page summaries don't fit are
+# summarized in sections first.
+SUMMARY_INPUT_TOKENS = 2048
+SUMMARY_OPTIONS = {"temperature": 0.0}
+SUMMARY_DOCUMENTS = 5  # Number of document summaries retrieved for a broad question
+SUMMARY_PAGES = 20  # Number of page summaries retrieved for a broad question, packed after the document summaries
+PAGE_PROMPT = (
+    "Summarize this page of the {document_type} in at most {words} words. Keep the main topics, findings, names, "
+    "and numbers. Only return the summary and no additional text."
+)
+COMBINE_PROMPT = (
+    "Combine these summaries of consecutive parts of the {document_type} into one summary of at most {words} words. "
+    "Cover the purpose, the main findings, and the conclusions. Only return the summary and no additional text."
+)
+
+logger = logging.getLogger(__name__)
+
+
+def summaries_enabled() -> bool:
+    """
+    Check whether the summary index is built and used
+
+    Returns:
+        bool: True if SUMMARY_MODEL is set
+    """
+
+    return bool(SUMMARY_MODEL)
+
+
+@lru_cache(maxsize=1)
+def get_summary_collection() -> chromadb.Collection:
+    """
+    Open the collection of page and document summaries once per process, creating it if it doesn't exist. Summaries
+    embedded with another embedding model are embedded again, without summarizing them again.
+
+    Returns:
+        chromadb.Collection: Summaries with "filename", "page_number" (0 for document summaries), "level" ("page" or
+            "document"), and "file_hash" metadata
+    """
+
+    chroma_client = get_chroma_client()
+    embedding_model = get_embedding_model()
+    metadata = {"hnsw:space": "ip", "embedding_model": embedding_model}
+    collection = chroma_client.get_or_create_collection(
+        name=SUMMARY_COLLECTION,
+        metadata=metadata,
+        embedding_function=get_embedding_function(),
+    )
+    if (collection.metadata or {}).get("embedding_model") == embedding_model:
+        return collection
+
+    logger.info("Embedding the stored summaries with the new embedding model")
+    stored = collection.get(include=["documents", "metadatas"])
+    chroma_client.delete_collection(name=SUMMARY_COLLECTION)
+    collection = chroma_client.create_collection(
+        name=SUMMARY_COLLECTION,
+        metadata=metadata,
+        embedding_function=get_embedding_function(),
+    )
+    if stored["ids"]:
+        collection.add(
+            ids=stored["ids"],
+            documents=stored["documents"],
+            embeddings=get_embedding_function()(stored["documents"]),
+            metadatas=stored["metadatas"],
+        )
+
+    return collection
+
+
+def build_summaries(files: List[str], file_hashes: Dict[str, str]) -> None:
+    """
+    Summarize the pages of every file without current summaries, and then each such document from its page
+    summaries. Summaries are stored with the hash of their file, so they are only written again when the file changes,
+    and an interrupted run resumes with the pages it didn't summarize yet. Summaries of removed files are deleted.
+    Does nothing if SUMMARY_MODEL isn't set. Failures are only logged, since broad questions can still be answered
+    from the chunks.
+
+    Args:
+        files (List[str]): Every PDF file in the input data directory
+        file_hashes (Dict[str, str]): Content hash of each file
+    """
+
+    if not summaries_enabled():
+        return
+
+    collection = get_summary_collection()
+    collection.delete(where={"filename": {"$nin": files}})
+    stored = collection.get(where={"level": "document"}, include=["metadatas"])
+    current = {
+        metadata["filename"]
+        for metadata in stored["metadatas"]
+        if metadata["file_hash"] == file_hashes.get(metadata["filename"])
+    }
+    todo = [file for file in files if file not in current]
+    if not todo:
+        return
+
+    page_counts = {file: len(PdfReader(file).pages) for file in todo}
+    update_ingestion_status(
+        message=f"Summarizing {len(todo)} documents with {SUMMARY_MODEL}",
+        pages_done=0,
+        pages_total=sum(page_counts.values()),
+    )
+    pages_before = 0
+    try:
+        for file in todo:
+            summarize_file(
+                collection=collection,
+                file=file,
+                file_hash=file_hashes[file],
+                pages_before=pages_before,
+            )
+            pages_before += page_counts[file]
+    except Exception:
+        logger.exception(
+            "Summarizing the documents failed, broad questions are answered from the chunks"
+        )
+
+
+def summarize_file(
+    collection: chromadb.Collection, file: str, file_hash: str, pages_before: int = 0
+) -> None:
+    """
+    Summarize the pages of a file that aren't summarized yet, and then the whole file from its page summaries
+
+    Args:
+        collection (chromadb.Collection): Summary collection
+        file (str): PDF file
+        file_hash (str): Content hash of the file
+        pages_before (int, optional): Pages of the files summarized before this one, to report progress. Defaults to 0.
+    """
+
+    stored = collection.get(
+        where={"filename": file}, include=["documents", "metadatas"]
+    )
+    stale = [
+        summary_id
+        for summary_id, metadata in zip(stored["ids"], stored["metadatas"])
+        if metadata["file_hash"] != file_hash
+    ]
+    if stale:
+        collection.delete(ids=stale)
+    page_summaries = {
+        metadata["page_number"]: summary
+        for summary, metadata in zip(stored["documents"], stored["metadatas"])
+        if metadata["file_hash"] == file_hash and metadata["level"] == "page"
+    }
+
+    reader = PdfReader(file)
+    pages = [
+        (page_number, text)
+        for page_number, text in (
+            (i + 1, page.extract_text() or "") for i, page in enumerate(reader.pages)
+        )
+        if page_number not in page_summaries and text.strip()
+    ]
+    with ThreadPoolExecutor(
+        max_workers=SUMMARY_WORKERS, thread_name_prefix="page-summary"
+    ) as executor:
+        # Each summary is stored as soon as it is written, so an interrupted run keeps it
+        for (page_number, _), summary in zip(
+            pages, executor.map(lambda page: summarize_page(text=page[1]), pages)
+        ):
+            add_summary(
+                collection=collection,
+                file=file,
+                file_hash=file_hash,
+                page_number=page_number,
+                summary=summary,
+            )
+            page_summaries[page_number] = summary
+            update_ingestion_status(pages_done=pages_before + page_number)
+        logger.info(f"Summarized {len(pages)} pages of {file}")
+
+        if len(page_summaries) == 1:
+            document_summary = next(iter(page_summaries.values()))
+        elif page_summaries:
+            document_summary = combine_summaries(
+                summaries=[
+                    f"Page {page_number}: {page_summaries[page_number]}"
+                    for page_number in sorted(page_summaries)
+                ],
+                executor=executor,
+            )
+        if page_summaries:
+            add_summary(
+                collection=collection,
+                file=file,
+                file_hash=file_hash,
+                page_number=0,
+                summary=document_summary,
+            )
+
+
+def add_summary(
+    collection: chromadb.Collection,
+    file: str,
+    file_hash: str,
+    page_number: int,
+    summary: str,
+) -> None:
+    """
+    Embed and store a summary
+
+    Args:
+        collection (chromadb.Collection): Summary collection
+        file (str): PDF file
+        file_hash (str): Content hash of the file
+        page_number (int): Page number, or 0 for the summary of the whole document
+        summary (str): Summary text
+    """
+
+    if page_number == 0:
+        summary_id = f"{file}_summary"
+        level = "document"
+    else:
+        summary_id = f"{file}_page{page_number - 1}_summary"
+        level = "page"
+
+    collection.upsert(
+        ids=[summary_id],
+        documents=[summary],
+        embeddings=get_embedding_function()([summary]),
+        metadatas=[
+            {
+                "filename": file,
+                "page_number": page_number,
+                "level": level,
+                "file_hash": file_hash,
+            }
+        ],
+    )
+
+
+def summarize_page(text: str) -> str:
+    """
+    Summarize the text of a page. Pages that are already short are returned as they are.
+
+    Args:
+        text (str): Page text
+
+    Returns:
+        str: Summary
+    """
+
+    text = text.strip()
+    if len(text.split()) <= PAGE_SUMMARY_WORDS:
+        return text
+
+    return summarize(
+        instructions=PAGE_PROMPT,
+        text=truncate(text=text, max_tokens=SUMMARY_INPUT_TOKENS),
+        words=PAGE_SUMMARY_WORDS,
+    )
+
+
+def combine_summaries(summaries: List[str], executor: ThreadPoolExecutor) -> str:
+    """
+    Combine the page summaries of a document into one summary. Summaries that don't fit in one LLM call are combined
+    in sections first, and the section summaries are combined in turn, until one summary is left.
+
+    Args:
+        summaries (List[str]): Page summaries in page order
+        executor (ThreadPoolExecutor): Runs the section summaries in parallel
+
+    Returns:
+        str: Summary of the whole document
+    """
+
+    while True:
+        sections = [[]]
+        section_tokens = 0
+        for summary in summaries:
+            tokens = count_tokens(text=summary)
+            if sections[-1] and section_tokens + tokens > SUMMARY_INPUT_TOKENS:
+                sections.append([])
+                section_tokens = 0
+            sections[-1].append(summary)
+            section_tokens += tokens
+
+        summaries = list(
+            executor.map(
+                lambda section: summarize(
+                    instructions=COMBINE_PROMPT,
+                    text="\n\n".join(section),
+                    words=DOCUMENT_SUMMARY_WORDS,
+                ),
+                sections,
+            )
+        )
+        if len(summaries) == 1:
+            return summaries[0]
+
+
+def summarize(instructions: str, text: str, words: int) -> str:
+    """
+    Summarize a text with SUMMARY_MODEL. Not sent through the request scheduler: ingestion finishes before the app
+    accepts questions, so these calls don't compete with chat responses, and SUMMARY_WORKERS bounds them instead.
+
+    Args:
+        instructions (str): PAGE_PROMPT or COMBINE_PROMPT
+        text (str): Text to summarize
+        words (int): Target length of the summary
+
+    Returns:
+        str: Summary
+    """
+
+    document_type = load_corpus_config().get("document_type", DEFAULT_DOCUMENT_TYPE)
+    message = [
+        {
+            "role": "system",
+            "content": instructions.format(document_type=document_type, words=words),
+        },
+        {"role": "user", "content": text},
+    ]
+    response = chat(
+        model=SUMMARY_MODEL,
+        messages=message,
+        options={
+            **SUMMARY_OPTIONS,
+            "num_ctx": get_context_window(model=SUMMARY_MODEL),
+        },
+    )
+
+    return response.message.content.strip()
+
+
+def filters_pages(where: Optional[dict]) -> bool:
+    """
+    Check whether a where clause limits the page numbers
+
+    Args:
+        where (Optional[dict]): Chroma where clause
+
+    Returns:
+        bool: True if it has a page_number condition
+    """
+
+    if not where:
+        return False
+    if "$and" in where or "$or" in where:
+        return any(
+            filters_pages(where=condition)
+            for condition in where.get("$and", []) + where.get("$or", [])
+        )
+
+    return "page_number" in where
+
+
+@timed(stage="retrieve_summaries")
+def retrieve_summaries(query: str, where: Optional[dict] = None) -> dict:
+    """
+    Retrieve the summaries most relevant to a broad question: the summaries of the closest documents, followed by the
+    closest page summaries. If the where clause limits the pages, only summaries of those pages are retrieved.
+
+    Args:
+        query (str): User query
+        where (Optional[dict], optional): Chroma where clause limiting retrieval to some documents or pages. Defaults
+            to None (all documents).
+
+    Returns:
+        dict: Context with ids, documents, metadatas and distances in the format of retrieved chunks, document
+            summaries first. The distance is the rank scaled to [0, 1).
+    """
+
+    collection = get_summary_collection()
+    query_embeddings = get_embedding_function()([query])
+    levels = [("page", SUMMARY_PAGES)]
+    if not filters_pages(where=where):
+        levels.insert(0, ("document", SUMMARY_DOCUMENTS))
+
+    ids, documents, metadatas = [], [], []
+    for level, n_results in levels:
+        condition = {"level": level}
+        results = collection.query(
+            query_embeddings=query_embeddings,
+            n_results=n_results,
+            where={"$and": [condition, where]} if where else condition,
+        )
+        ids.extend(results["ids"][0])
+        documents.extend(results["documents"][0])
+        metadatas.extend(results["metadatas"][0])
+
+    return {
+        "ids": [ids],
+        "documents": [documents],
+        "metadatas": [metadatas],
+        "distances": [[rank / len(ids) for rank in range(len(ids))]],
+    }
@@ -1,30 +1,75 @@
 # This file controls the UI action in the streamlit app
 
-from sqlite3 import Connection
-from typing import Tuple, List
+import logging
+import os
+from typing import Dict, Tuple, List, Optional
+import uuid
 
-from chromadb import Collection
 import streamlit as st
 
-from backend.data_prep import prepare_data, get_available_models
-from backend.chatbot import query_chatbot
-from backend.data_tracking import manage_tracking_db, update_entry_with_feedback
+from backend.data_prep import (
+    get_available_models,
+    get_collection,
+    get_document_pages,
+    get_ingestion_status,
+    start_background_ingestion,
+)
+from backend.chatbot import build_filter, query_chatbot_stream, warm_up_model
+from backend.data_tracking import (
+    get_latency_summary,
+    manage_tracking_db,
+    update_entry_with_feedback,
+    TrackingWriter,
+)
+from backend.scheduler import get_scheduler, QueueFullError, RequestScheduler
+
+# Show backend progress (e.g. ingestion) in the container logs
+logging.basicConfig(level=logging.INFO)
 
 
 @st.cache_resource
-def init_function() -> Tuple[Collection, List[str], Connection]:
+def init_function() -> Tuple[List[str], TrackingWriter, RequestScheduler]:
     """
-    Initialize the backend. This includes ingesting data, connecting to the vector database, and connecting to the data tracking database.
-    This only runs on app startup.
+    Initialize the backend. This includes starting data ingestion in the background and connecting to the data tracking database.
+    This only runs on app startup. The vector database is available from get_collection() once the ingestion status is "ready".
 
     Returns:
-        Tuple[Collection, List[str]]: A tuple with the DB containing the embedded and chunked data, the list of available models, and the database cursor for the data tracking db.
+        Tuple[List[str], TrackingWriter, RequestScheduler]: A tuple with the list of available models, the background writer for the data tracking db, and the scheduler shared by all sessions.
     """
-    index = prepare_data()
+    start_background_ingestion()
     model_list = get_available_models()
     connection = manage_tracking_db()
+    scheduler = get_scheduler()
 
-    return index, model_list, connection
+    return model_list, connection, scheduler
+
+
+@st.cache_data
+def load_document_pages() -> Dict[str, int]:
+    """
+    Count the pages of the documents once, for the search scope selection
+
+    Returns:
+        Dict[str, int]: Number of pages per document filename
+    """
+    return get_document_pages()
+
+
+def get_search_filter() -> Optional[dict]:
+    """
+    Build the retrieval filter from the documents and pages selected in the sidebar
+
+    Returns:
+        Optional[dict]: Chroma where clause, or None to search all documents
+    """
+    documents = st.session_state.get("filter_documents", [])
+    pages = None
+    if len(documents) == 1:
+        pages = st.session_state.get(f"filter_pages_{documents[0]}")
+        if pages == (1, load_document_pages().get(documents[0])):
+            pages = None
+
+    return build_filter(filenames=documents, pages=pages)
 
 
 def clear_chat_history():
@@ -32,10 +77,26 @@ def clear_chat_history():
     st.session_state.messages = []
 
 
+def discard_message(message: dict):
+    """
+    Remove a message from the chat history, e.g. a user message that won't be answered. Compares by identity, since a
+    newer run of the session may have added an equal message in the meantime.
+
+    Args:
+        message (dict): Message as added to st.session_state.messages
+    """
+    for i, m in enumerate(st.session_state.messages):
+        if m is message:
+            del st.session_state.messages[i]
+            break
+
+
 def feedback_button_good():
-    """Update the most recent entry with positive user feedback"""
-    if len(st.session_state.messages) > 1:
-        update_entry_with_feedback(connection=connection, is_good=True)
+    """Update the most recent entry of this session with positive user feedback"""
+    if st.session_state.get("entry_id") is not None:
+        update_entry_with_feedback(
+            connection=connection, entry_id=st.session_state.entry_id, is_good=True
+        )
     else:
         raise ValueError(
             "Please use the chatbot before providing feedback on a response. Refresh the page to try again."
@@ -43,48 +104,107 @@ def feedback_button_good():
 
 
 def feedback_button_bad():
-    """Update the most recent entry with negative user feedback"""
-    if len(st.session_state.messages) > 1:
-        update_entry_with_feedback(connection=connection, is_good=False)
+    """Update the most recent entry of this session with negative user feedback"""
+    if st.session_state.get("entry_id") is not None:
+        update_entry_with_feedback(
+            connection=connection, entry_id=st.session_state.entry_id, is_good=False
+        )
     else:
         raise ValueError(
             "Please use the chatbot before providing feedback on a response. Refresh the page to try again."
         )
 
 
-index, model_list, connection = init_function()
+@st.fragment(run_every=1)
+def show_ingestion_progress():
+    """Show the progress of the background ingestion, and rerun the app once the documents are ready"""
+    status = get_ingestion_status()
+    if status["state"] == "ready":
+        st.rerun()
+    elif status["state"] == "failed":
+        st.error(
+            f"Preparing the documents failed: {status['error']}. Check the container logs, fix the problem, and restart the app."
+        )
+    elif status["pages_total"]:
+        st.progress(
+            value=status["pages_done"] / status["pages_total"],
+            text=f"{status['message']}: {status['pages_done']} of {status['pages_total']} pages",
+        )
+    else:
+        st.progress(value=0, text=f"{status['message']}...")
+
+
+model_list, connection, scheduler = init_function()
+is_ready = get_ingestion_status()["state"] == "ready"
 
 st.title("Flexible RAG Chatbot")
 
 # Initialize chat history
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "session_id" not in st.session_state:
+    st.session_state.session_id = str(uuid.uuid4())
 
 # Display chat messages from history on app rerun
 for message in st.session_state.messages:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
+# Questions can be asked once the documents are ingested
+if not is_ready:
+    show_ingestion_progress()
+
 # Manage main chat area
 if prompt := st.chat_input(
-    "Ask a question like, 'What is this article about?' or 'What is the HER-2/neu gene?'"
+    "Ask a question like, 'What is this article about?' or 'What is the HER-2/neu gene?'",
+    disabled=not is_ready,
 ):
     # Display user message in chat message container
     st.chat_message("user").markdown(prompt)
-    # Add user message to chat history
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    # Add user message to chat history. It is removed again if the question isn't answered.
+    user_message = {"role": "user", "content": prompt}
+    st.session_state.messages.append(user_message)
 
     # Generate response and add to chat history
     with st.chat_message("assistant"):
-        response = query_chatbot(
-            query=prompt,
-            index=index,
-            model=st.session_state.model,
-            history=st.session_state.messages,
-            connection=connection,
-            is_test=False,
-        )
-        st.write(response["response"])
+        # Wait for a free place on the model server. A newer message from this session cancels this request.
+        try:
+            ticket = scheduler.submit(
+                session_id=st.session_state.session_id, model=st.session_state.model
+            )
+        except QueueFullError as error:
+            discard_message(message=user_message)
+            st.error(str(error))
+            st.stop()
+        try:
+            status = st.empty()
+            while not ticket.wait(timeout=0.5):
+                status.info(
+                    f"Waiting for the model, position {ticket.position() + 1} in the queue..."
+                )
+            status.empty()
+            if ticket.cancelled:
+                discard_message(message=user_message)
+                st.stop()
+
+            # Stream tokens to the page as they are generated, the response is tracked once the stream ends
+            token_stream, response = query_chatbot_stream(
+                query=prompt,
+                index=get_collection(),
+                model=st.session_state.model,
+                history=st.session_state.messages,
+                connection=connection,
+                is_test=False,
+                where=get_search_filter(),
+            )
+            st.write_stream(ticket.guard(stream=token_stream))
+        finally:
+            ticket.release()
+        if ticket.cancelled:
+            discard_message(message=user_message)
+            st.stop()
+        # Remember this session's tracking entry so feedback updates exactly this response
+        st.session_state.entry_id = response.get("entry_id")
 
         # Get unique list of pages used (we can have multiple chunks used per page)
         unique_sources = list(dict.fromkeys(response["sources"]))
@@ -101,7 +221,33 @@ if prompt := st.chat_input(
 # Create and manage sidebar
 with st.sidebar:
     st.session_state.model = st.selectbox("Model Selection", model_list)
+    # Load a newly selected model in Ollama while the user types
+    if st.session_state.get("warm_model") != st.session_state.model:
+        warm_up_model(model=st.session_state.model)
+        st.session_state.warm_model = st.session_state.model
     st.button(label="Clear History", key="chat_clear", on_click=clear_chat_history)
+    st.header("Search Scope")
+    document_pages = load_document_pages()
+    selected_documents = st.multiselect(
+        "Documents",
+        options=list(document_pages),
+        format_func=os.path.basename,
+        placeholder="All documents",
+        key="filter_documents",
+    )
+    # Page ranges are offered for a single document, since page numbers differ between documents
+    if len(selected_documents) == 1 and document_pages[selected_documents[0]] > 1:
+        num_pages = document_pages[selected_documents[0]]
+        st.slider(
+            "Pages",
+            min_value=1,
+            max_value=num_pages,
+            value=(1, num_pages),
+            key=f"filter_pages_{selected_documents[0]}",
+        )
     st.header("Model Response Feedback")
     st.button(label="Good", key="good_feedback", on_click=feedback_button_good)
     st.button(label="Bad", key="bad_feedback", on_click=feedback_button_bad)
+    if st.checkbox("Show latency statistics"):
+        # p50/p95 per model and pipeline stage over the most recent responses
+        st.dataframe(get_latency_summary(), hide_index=True)
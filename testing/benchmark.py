@@ -0,0 +1,229 @@
+# Offline benchmark of ingestion, retrieval, and end-to-end chatbot latency against a synthetic corpus and a stand-in Ollama server.
+# Run from the project root, e.g. `python testing/benchmark.py --files 20 --pages 50`. Needs no GPU, network, or running Ollama
+# once the embedding model and tokenizer are in the local cache.
+
+import argparse
+import csv
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+from fake_ollama import FakeOllamaServer
+from synthetic_corpus import generate_corpus
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUERY_FILE = os.path.join(PROJECT_ROOT, "testing", "chatbot_tests_latency.csv")
+
+
+def summarize(latencies_ms: List[float], elapsed_s: Optional[float] = None) -> Dict:
+    """
+    Summarize request latencies
+
+    Args:
+        latencies_ms (List[float]): Latency of each request in milliseconds
+        elapsed_s (Optional[float], optional): Wall clock time of all requests in seconds. Defaults to None (no throughput).
+
+    Returns:
+        Dict: Request count, throughput, and latency percentiles
+    """
+
+    from backend.instrumentation import percentile
+
+    summary = {"requests": len(latencies_ms)}
+    if elapsed_s:
+        summary["throughput_per_s"] = round(len(latencies_ms) / elapsed_s, 2)
+
+    return {
+        **summary,
+        "p50_ms": round(percentile(values=latencies_ms, q=50), 2),
+        "p95_ms": round(percentile(values=latencies_ms, q=95), 2),
+        "p99_ms": round(percentile(values=latencies_ms, q=99), 2),
+        "max_ms": round(max(latencies_ms), 2),
+    }
+
+
+def measure(function: Callable) -> Dict:
+    """
+    Run a function once and measure its duration and peak Python heap allocation
+
+    Args:
+        function (Callable): Function without arguments
+
+    Returns:
+        Dict: Duration in seconds and peak traced memory in MB
+    """
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"seconds": round(elapsed, 3), "peak_python_mb": round(peak / 2**20, 1)}
+
+
+def load_queries(num_queries: int) -> List[str]:
+    """
+    Load benchmark queries from the latency test cases, repeated to the requested count
+
+    Args:
+        num_queries (int): Number of queries
+
+    Returns:
+        List[str]: Queries
+    """
+
+    with open(QUERY_FILE, newline="") as f:
+        queries = [row["input"] for row in csv.DictReader(f)]
+
+    return [queries[i % len(queries)] for i in range(num_queries)]
+
+
+def run_benchmarks(args: argparse.Namespace) -> Dict:
+    """
+    Generate the corpus, start the stand-in Ollama server, and benchmark each pipeline stage
+
+    Args:
+        args (argparse.Namespace): Command line arguments
+
+    Returns:
+        Dict: Benchmark results
+    """
+
+    server = FakeOllamaServer(
+        token_latency=args.token_latency,
+        prompt_latency=args.prompt_latency,
+        response_tokens=args.response_tokens,
+    ).start()
+    # The backend reads the Ollama host at import time, so import it after the server is up
+    os.environ["OLLAMA_HOST"] = server.url
+    sys.path.insert(0, PROJECT_ROOT)
+    import backend.chatbot as chatbot
+    from backend.data_prep import prepare_data
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="rag_benchmark_")
+    os.makedirs(workdir, exist_ok=True)
+    # The backend uses paths relative to the working directory, e.g. ./data/chromadb/
+    os.chdir(workdir)
+    generate_corpus(
+        directory="./data",
+        num_files=args.files,
+        pages_per_file=args.pages,
+        words_per_page=args.words_per_page,
+        seed=args.seed,
+    )
+    chatbot.RESPONSE_CACHE_ENABLED = args.response_cache
+    results = {"config": vars(args), "workdir": workdir}
+
+    results["ingestion_cold"] = measure(prepare_data)
+    results["ingestion_warm"] = measure(prepare_data)
+    index = prepare_data()
+    results["ingestion_cold"]["chunks"] = index.count()
+
+    queries = load_queries(num_queries=args.queries)
+
+    latencies = []
+    start = time.perf_counter()
+    for query in queries:
+        query_start = time.perf_counter()
+        chatbot.retrieve_context(query=query, index=index)
+        latencies.append((time.perf_counter() - query_start) * 1000)
+    results["retrieval"] = summarize(
+        latencies_ms=latencies, elapsed_s=time.perf_counter() - start
+    )
+
+    latencies = []
+    stage_latencies = {}
+    start = time.perf_counter()
+    for query in queries:
+        query_start = time.perf_counter()
+        output = chatbot.query_chatbot(
+            query=query,
+            index=index,
+            model=args.model,
+            history=[{"role": "user", "content": query}],
+            connection=None,
+            is_test=True,
+        )
+        latencies.append((time.perf_counter() - query_start) * 1000)
+        for row in output["timings"]:
+            stage_latencies.setdefault(row["stage"], []).append(row["duration_ms"])
+    elapsed = time.perf_counter() - start
+    results["end_to_end"] = summarize(latencies_ms=latencies, elapsed_s=elapsed)
+    results["end_to_end_stages"] = {
+        stage: summarize(latencies_ms=values)
+        for stage, values in stage_latencies.items()
+    }
+
+    latencies = []
+    start = time.perf_counter()
+    for query in queries:
+        query_start = time.perf_counter()
+        tokens, _ = chatbot.query_chatbot_stream(
+            query=query,
+            index=index,
+            model=args.model,
+            history=[{"role": "user", "content": query}],
+            connection=None,
+            is_test=True,
+        )
+        next(tokens, None)
+        latencies.append((time.perf_counter() - query_start) * 1000)
+        for _ in tokens:
+            pass
+    results["time_to_first_token"] = summarize(
+        latencies_ms=latencies, elapsed_s=time.perf_counter() - start
+    )
+
+    # ru_maxrss is in KB on Linux
+    results["peak_rss_mb"] = round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+    )
+    results["llm_requests"] = server.num_requests
+    server.stop()
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the chatbot backend offline with a synthetic corpus and a stand-in Ollama server"
+    )
+    parser.add_argument("--files", type=int, default=10, help="Number of PDF files")
+    parser.add_argument("--pages", type=int, default=20, help="Pages per PDF file")
+    parser.add_argument("--words-per-page", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--model", default="benchmark-model")
+    parser.add_argument(
+        "--token-latency", type=float, default=0.005, help="Seconds per token"
+    )
+    parser.add_argument(
+        "--prompt-latency", type=float, default=0.0, help="Seconds per prompt token"
+    )
+    parser.add_argument("--response-tokens", type=int, default=50)
+    parser.add_argument(
+        "--response-cache",
+        action="store_true",
+        help="Keep the response cache enabled (repeated queries become cache hits)",
+    )
+    parser.add_argument(
+        "--workdir", help="Directory for the corpus and stores. Defaults to a temp dir"
+    )
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    results = run_benchmarks(args=args)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
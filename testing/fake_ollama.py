@@ -0,0 +1,202 @@
+# Stand-in Ollama server with deterministic, tunable latency for offline benchmarks of the chatbot backend
+
+import argparse
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+# Rough prompt token estimate used to simulate prompt processing time
+CHARS_PER_TOKEN = 4
+
+
+class FakeOllamaServer:
+    """
+    Minimal HTTP server implementing the Ollama endpoints the chatbot uses (/api/chat, /api/generate, /api/tags).
+    Every response is the same fixed list of tokens. Prompt processing takes prompt_latency seconds per prompt token
+    and generation takes token_latency seconds per response token, so latencies are reproducible across runs.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        token_latency: float = 0.01,
+        prompt_latency: float = 0.0,
+        response_tokens: int = 50,
+    ):
+        """
+        Args:
+            host (str, optional): Interface to listen on. Defaults to "127.0.0.1".
+            port (int, optional): Port to listen on, 0 picks a free port. Defaults to 0.
+            token_latency (float, optional): Seconds per generated token. Defaults to 0.01.
+            prompt_latency (float, optional): Seconds per prompt token. Defaults to 0.0.
+            response_tokens (int, optional): Number of tokens in every response. Defaults to 50.
+        """
+
+        self.token_latency = token_latency
+        self.prompt_latency = prompt_latency
+        self.response_tokens = response_tokens
+        self.num_requests = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """Base URL of the server, e.g. for OLLAMA_HOST"""
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeOllamaServer":
+        """Serve requests on a background thread"""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop serving and close the socket"""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def tokens(self) -> list:
+        """The tokens of every response"""
+        return [f"token{i} " for i in range(self.response_tokens)]
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are separate small writes on a kept-alive connection. With Nagle's algorithm, each
+            # response would wait for the client's delayed ACK (about 40 ms), which would add to every latency measured.
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == "/api/tags":
+                    self._send_json({"models": []})
+                else:
+                    self._send_json({"status": "Ollama is running"})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                with server._lock:
+                    server.num_requests += 1
+
+                if self.path == "/api/chat":
+                    prompt = "".join(
+                        m.get("content", "") for m in request.get("messages", [])
+                    )
+                    self._respond(request=request, prompt=prompt, key="message")
+                elif self.path == "/api/generate":
+                    self._respond(
+                        request=request,
+                        prompt=request.get("prompt", ""),
+                        key="response",
+                    )
+                else:
+                    self.send_error(404)
+
+            def _respond(self, request: dict, prompt: str, key: str):
+                prompt_tokens = max(1, len(prompt) // CHARS_PER_TOKEN)
+                start = time.perf_counter_ns()
+                time.sleep(prompt_tokens * server.prompt_latency)
+                prompt_ns = time.perf_counter_ns() - start
+                # An empty request only loads the model (e.g. a warm-up), so nothing is generated
+                tokens = server.tokens() if prompt else []
+
+                def body(content: str) -> dict:
+                    if key == "message":
+                        return {"message": {"role": "assistant", "content": content}}
+                    return {"response": content}
+
+                base = {
+                    "model": request.get("model", ""),
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                }
+                final = {
+                    **base,
+                    "done": True,
+                    "done_reason": "stop",
+                    "load_duration": 0,
+                    "prompt_eval_count": prompt_tokens,
+                    "prompt_eval_duration": prompt_ns,
+                    "eval_count": len(tokens),
+                }
+
+                if request.get("stream", True):
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/x-ndjson")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    eval_start = time.perf_counter_ns()
+                    for token in tokens:
+                        time.sleep(server.token_latency)
+                        self._send_chunk({**base, **body(token), "done": False})
+                    eval_ns = time.perf_counter_ns() - eval_start
+                    self._send_chunk(
+                        {
+                            **final,
+                            **body(""),
+                            "eval_duration": eval_ns,
+                            "total_duration": prompt_ns + eval_ns,
+                        }
+                    )
+                    self.wfile.write(b"0\r\n\r\n")
+                else:
+                    eval_start = time.perf_counter_ns()
+                    time.sleep(len(tokens) * server.token_latency)
+                    eval_ns = time.perf_counter_ns() - eval_start
+                    self._send_json(
+                        {
+                            **final,
+                            **body("".join(tokens)),
+                            "eval_duration": eval_ns,
+                            "total_duration": prompt_ns + eval_ns,
+                        }
+                    )
+
+            def _send_chunk(self, payload: dict):
+                data = json.dumps(payload).encode("utf-8") + b"\n"
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def _send_json(self, payload: dict):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run a stand-in Ollama server with deterministic latency"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--token-latency", type=float, default=0.01)
+    parser.add_argument("--prompt-latency", type=float, default=0.0)
+    parser.add_argument("--response-tokens", type=int, default=50)
+    args = parser.parse_args()
+
+    server = FakeOllamaServer(
+        host=args.host,
+        port=args.port,
+        token_latency=args.token_latency,
+        prompt_latency=args.prompt_latency,
+        response_tokens=args.response_tokens,
+    ).start()
+    print(f"Fake Ollama server listening on {server.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
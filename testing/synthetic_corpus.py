@@ -0,0 +1,127 @@
+# Generates a reproducible corpus of text PDFs for benchmarking ingestion and retrieval
+
+import os
+import random
+from typing import List
+
+# Mix of domain terms and filler so chunks differ but retrieval queries still find matches
+VOCABULARY = (
+    "gene amplification tumor patient survival relapse receptor oncogene protein "
+    "expression cell cancer breast factor growth analysis study prognostic value "
+    "hormonal status lymph node disease marker treatment therapy clinical trial "
+    "result sample cohort significant correlation parameter measurement biology "
+    "the of and in to a with was were for by on is that as from this these"
+).split()
+WORDS_PER_LINE = 12
+LINES_PER_PAGE = 55  # Fits a US letter page at 10pt with 12pt leading
+
+
+def generate_page_text(rng: random.Random, num_words: int) -> List[str]:
+    """
+    Generate the lines of text of one page
+
+    Args:
+        rng (random.Random): Seeded random number generator
+        num_words (int): Number of words on the page
+
+    Returns:
+        List[str]: Lines of text
+    """
+
+    words = [rng.choice(VOCABULARY) for _ in range(num_words)]
+
+    return [
+        " ".join(words[i : i + WORDS_PER_LINE])
+        for i in range(0, len(words), WORDS_PER_LINE)
+    ]
+
+
+def write_pdf(path: str, pages: List[List[str]]) -> None:
+    """
+    Write a minimal text PDF with one Helvetica text block per page, without any PDF library
+
+    Args:
+        path (str): Output file path
+        pages (List[List[str]]): Lines of text for each page
+    """
+
+    def escape(text: str) -> str:
+        return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    num_pages = len(pages)
+    # Object numbers: 1 catalog, 2 page tree, 3 font, then a page and a content stream per page
+    page_ids = [4 + 2 * i for i in range(num_pages)]
+    objects = {
+        1: b"<< /Type /Catalog /Pages 2 0 R >>",
+        2: (
+            f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] /Count {num_pages} >>"
+        ).encode("ascii"),
+        3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    }
+    for page_id, lines in zip(page_ids, pages):
+        text = "".join(f"({escape(line)}) '\n" for line in lines[:LINES_PER_PAGE])
+        stream = f"BT /F1 10 Tf 12 TL 50 760 Td\n{text}ET".encode("latin-1")
+        objects[page_id] = (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {page_id + 1} 0 R >>"
+        ).encode("ascii")
+        objects[page_id + 1] = (
+            f"<< /Length {len(stream)} >>\nstream\n".encode("ascii")
+            + stream
+            + b"\nendstream"
+        )
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for object_id in sorted(objects):
+        offsets[object_id] = len(output)
+        output += f"{object_id} 0 obj\n".encode("ascii")
+        output += objects[object_id] + b"\nendobj\n"
+
+    xref_offset = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("ascii")
+    for object_id in sorted(objects):
+        output += f"{offsets[object_id]:010d} 00000 n \n".encode("ascii")
+    output += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+        f"startxref\n{xref_offset}\n%%EOF\n"
+    ).encode("ascii")
+
+    with open(path, "wb") as f:
+        f.write(output)
+
+
+def generate_corpus(
+    directory: str,
+    num_files: int,
+    pages_per_file: int,
+    words_per_page: int,
+    seed: int = 0,
+) -> List[str]:
+    """
+    Write a reproducible set of synthetic PDFs
+
+    Args:
+        directory (str): Output directory
+        num_files (int): Number of PDF files
+        pages_per_file (int): Number of pages per file
+        words_per_page (int): Number of words per page (at most WORDS_PER_LINE * LINES_PER_PAGE fit on a page)
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        List[str]: Paths of the generated files
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    paths = []
+    for i in range(num_files):
+        pages = [
+            generate_page_text(rng=rng, num_words=words_per_page)
+            for _ in range(pages_per_file)
+        ]
+        path = os.path.join(directory, f"synthetic_{i:04d}.pdf")
+        write_pdf(path=path, pages=pages)
+        paths.append(path)
+
+    return paths
@@ -0,0 +1,98 @@
+# Tests that the chat history is kept verbatim within its budget and summarized beyond it
+
+import pytest
+
+from backend import chat_history
+from backend.chat_history import compact_history, MAX_HISTORY
+from backend.scheduler import RequestScheduler
+
+
+@pytest.fixture(autouse=True)
+def summaries(monkeypatch):
+    """Count words as tokens and summarize without an LLM. Yields the (summary, messages) of each summarize call."""
+
+    def summarize(summary, messages, model):
+        calls.append((summary, [m["content"] for m in messages]))
+        new = " ".join(m["content"].split()[0] for m in messages)
+        return f"{summary} {new}" if summary else new
+
+    calls = []
+    monkeypatch.setattr(chat_history, "count_tokens", lambda text: len(text.split()))
+    monkeypatch.setattr(chat_history, "summarize", summarize)
+    monkeypatch.setattr(chat_history, "get_scheduler", RequestScheduler)
+    chat_history.message_tokens.cache_clear()
+    chat_history._summaries.clear()
+    yield calls
+    chat_history.message_tokens.cache_clear()
+    chat_history._summaries.clear()
+
+
+def build_history(length: int) -> list:
+    """Alternating user and assistant messages of three tokens each, ending with a user query"""
+    roles = ["user", "assistant"] if length % 2 else ["assistant", "user"]
+    return [
+        {"role": roles[i % 2], "content": f"m{i} three tokens"} for i in range(length)
+    ]
+
+
+def wait_for_summaries() -> None:
+    """Wait until the summary thread finished the refreshes scheduled so far"""
+    chat_history._summary_executor.submit(lambda: None).result(timeout=10)
+
+
+def test_history_within_the_budget_is_kept_verbatim(summaries):
+    history = build_history(length=3)
+
+    assert compact_history(history=history, model="m") == history
+    wait_for_summaries()
+    assert summaries == []
+
+
+def test_long_messages_are_cut_but_not_the_query(monkeypatch):
+    monkeypatch.setattr(chat_history, "MAX_MESSAGE_TOKENS", 4)
+    history = [
+        {"role": "assistant", "content": "a b c d e f g h"},
+        {"role": "user", "content": "q r s t u v w x"},
+    ]
+
+    assert [m["content"] for m in compact_history(history=history, model="m")] == [
+        "a b c d ...",
+        "q r s t u v w x",
+    ]
+
+
+def test_history_over_the_budget_is_summarized(summaries):
+    history = build_history(length=6)
+
+    # Until the first summary is ready, the older messages are left out
+    assert compact_history(history=history, model="m", budget=9) == history[3:]
+    wait_for_summaries()
+    assert summaries == [
+        (None, ["m0 three tokens", "m1 three tokens", "m2 three tokens"])
+    ]
+    summary = {
+        "role": "system",
+        "content": "Summary of the earlier conversation: m0 m1 m2",
+    }
+    assert (
+        compact_history(history=history, model="m", budget=9) == [summary] + history[3:]
+    )
+
+    # Two turns later, the existing summary is used and only the new older messages are added to it
+    history = build_history(length=8)
+    assert compact_history(history=history, model="m", budget=9)[0]["content"] == (
+        "Summary of the earlier conversation: m0 m1 m2"
+    )
+    wait_for_summaries()
+    assert summaries[-1] == ("m0 m1 m2", ["m3 three tokens", "m4 three tokens"])
+    assert compact_history(history=history, model="m", budget=9)[0]["content"] == (
+        "Summary of the earlier conversation: m0 m1 m2 m3 m4"
+    )
+
+
+def test_at_most_max_history_earlier_messages_are_verbatim(summaries):
+    history = build_history(length=MAX_HISTORY + 3)
+
+    assert compact_history(history=history, model="m") == history[2:]
+    wait_for_summaries()
+    assert summaries == [(None, ["m0 three tokens", "m1 three tokens"])]
@@ -0,0 +1,111 @@
+# Tests that retrieved chunks are deduplicated, merged into passages, and packed into the token budget
+
+import pytest
+
+from backend import context_packing
+from backend.context_packing import merge_overlapping, pack_context
+
+FIRST = "The HER-2/neu gene was amplified in 30% of the primary human breast tumors studied."
+# Starts with the end of FIRST, as consecutive chunks with a chunk overlap do
+SECOND = (
+    "primary human breast tumors studied. Amplification predicted a shorter survival."
+)
+
+
+@pytest.fixture(autouse=True)
+def count_words(monkeypatch):
+    """Count words as tokens, so budgets don't depend on the tokenizer"""
+    monkeypatch.setattr(context_packing, "count_tokens", lambda text: len(text.split()))
+
+
+def build_context(chunks: list) -> dict:
+    """Build a retrieval result from (id, text, page, chunk number, distance) tuples"""
+    return {
+        "ids": [[chunk[0] for chunk in chunks]],
+        "documents": [[chunk[1] for chunk in chunks]],
+        "metadatas": [
+            [
+                {"filename": "a.pdf", "page_number": chunk[2], "chunk_number": chunk[3]}
+                for chunk in chunks
+            ]
+        ],
+        "distances": [[chunk[4] for chunk in chunks]],
+    }
+
+
+def test_overlapping_adjacent_chunks_become_one_passage():
+    context = build_context(
+        chunks=[("second", SECOND, 1, 1, 0.2), ("first", FIRST, 1, 0, 0.3)]
+    )
+
+    packed = pack_context(context=context, budget=1000)
+
+    assert packed["ids"] == [["first+second"]]
+    assert packed["documents"] == [
+        [
+            "The HER-2/neu gene was amplified in 30% of the primary human breast tumors studied. "
+            "Amplification predicted a shorter survival."
+        ]
+    ]
+    assert packed["metadatas"][0][0]["chunk_number"] == 0
+    assert packed["distances"] == [[0.2]]
+
+
+def test_duplicate_chunks_are_dropped():
+    context = build_context(
+        chunks=[
+            ("first", FIRST, 1, 0, 0.1),
+            # The same text retrieved again, e.g. from another shard, with different whitespace
+            ("copy", FIRST.replace(" ", "\n "), 2, 0, 0.2),
+            ("part", FIRST[4:40], 3, 0, 0.3),
+        ]
+    )
+
+    packed = pack_context(context=context, budget=1000)
+
+    assert packed["ids"] == [["first"]]
+
+
+def test_chunks_that_are_not_adjacent_stay_separate():
+    context = build_context(
+        chunks=[
+            ("page 1 chunk 0", FIRST, 1, 0, 0.4),
+            ("page 1 chunk 2", SECOND, 1, 2, 0.1),
+            ("page 2 chunk 1", "Another page entirely.", 2, 1, 0.2),
+        ]
+    )
+
+    packed = pack_context(context=context, budget=1000)
+
+    # Ordered by relevance, and not merged
+    assert packed["ids"] == [["page 1 chunk 2", "page 2 chunk 1", "page 1 chunk 0"]]
+    assert packed["documents"][0][0] == SECOND
+
+
+def test_passages_that_overflow_the_budget_are_skipped():
+    long_text = " ".join(["word"] * 50)
+    context = build_context(
+        chunks=[
+            ("short", "Five words in this chunk.", 1, 0, 0.1),
+            ("long", long_text, 2, 0, 0.2),
+            ("small", "Three more words.", 3, 0, 0.3),
+        ]
+    )
+
+    packed = pack_context(context=context, budget=10)
+
+    # The long passage doesn't fit, but a less relevant one that does is still used
+    assert packed["ids"] == [["short", "small"]]
+    assert sum(len(text.split()) for text in packed["documents"][0]) <= 10
+    assert pack_context(context=context, budget=2)["ids"] == [[]]
+
+
+def test_merge_overlapping():
+    assert merge_overlapping(text=FIRST, next_text=SECOND).count("tumors studied") == 1
+    # Without an overlap, or one shorter than MIN_OVERLAP_CHARS, chunks are joined with a space
+    assert merge_overlapping(text="One chunk.", next_text="Next chunk.") == (
+        "One chunk. Next chunk."
+    )
+    assert merge_overlapping(text="ends with abc", next_text="abc starts") == (
+        "ends with abc abc starts"
+    )
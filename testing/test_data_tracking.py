@@ -0,0 +1,122 @@
+# Tests that prompts stored as content-addressed parts are rebuilt exactly, before and after compaction
+
+import json
+import sqlite3
+
+import pytest
+
+from backend import data_tracking
+
+LONG_CHUNK = (
+    "Amplification of the HER-2/neu gene was a significant predictor of both overall survival and time to relapse "
+    "in patients with breast cancer, 2 to 20 fold in 30% of the tumors."
+)
+CHUNKS = {
+    "page_number": "2",
+    "year": "1987",
+    "long": LONG_CHUNK,
+    # Part of the long chunk, but also a passage of its own
+    "substring": LONG_CHUNK[:110],
+    "whitespace": f"  {LONG_CHUNK[50:]}\n",
+}
+
+
+def build_prompt(chunks: dict) -> list:
+    """Build a prompt the way the chatbot does, with every chunk as a numbered passage"""
+    passages = [
+        f"[{i}] article.pdf, page {i}\n{text.strip()}"
+        for i, text in enumerate(chunks.values(), start=1)
+    ]
+
+    return [
+        {"role": "system", "content": "Answer only from the context. Page 2 of 1987."},
+        {
+            "role": "system",
+            "content": "BEGIN CONTEXT:\n" + "\n\n".join(passages) + "\nEND CONTEXT",
+        },
+        {"role": "user", "content": "What was found in 1987 on page 2?"},
+    ]
+
+
+@pytest.mark.parametrize("min_chars", [1, data_tracking.MIN_CHUNK_REFERENCE_CHARS])
+def test_prompt_round_trip(tmp_path, monkeypatch, min_chars):
+    path = str(tmp_path / "chatbot_data.db")
+    monkeypatch.setattr(data_tracking, "TRACKING_DB_PATH", path)
+    monkeypatch.setattr(data_tracking, "MIN_CHUNK_REFERENCE_CHARS", min_chars)
+    writer = data_tracking.manage_tracking_db()
+
+    # An entry written before prompts were stored by hash, with the prompt in full_query
+    unconverted = build_prompt(chunks={"page_number": "2"})
+    con = sqlite3.connect(path)
+    con.execute(
+        "INSERT INTO chatbot (id, query_timestamp, user_query, full_query) VALUES (1, '2020-01-01', 'q', ?)",
+        (json.dumps(unconverted),),
+    )
+    con.commit()
+    con.close()
+    writer._last_id = 1
+
+    expected = {1: unconverted}
+    for i in range(1, len(CHUNKS) + 1):
+        chunks = dict(list(CHUNKS.items())[:i])
+        full_query = build_prompt(chunks=chunks)
+        entry_id = data_tracking.add_tracking_entry(
+            connection=writer,
+            query_timestamp="2026-01-01 00:00:00+00:00",
+            user_query="q",
+            retrieval_query="q",
+            full_query=full_query,
+            llm_response="a",
+            sources=[],
+            chunks=chunks,
+        )
+        expected[entry_id] = full_query
+    writer.close()
+
+    for entry_id, full_query in expected.items():
+        assert data_tracking.get_full_query(entry_id=entry_id, path=path) == full_query
+
+    stats = data_tracking.compact_tracking_db(path=path)
+    assert stats["converted_entries"] == 1
+    assert stats["deleted_chunks"] == 0
+    for entry_id, full_query in expected.items():
+        assert data_tracking.get_full_query(entry_id=entry_id, path=path) == full_query
+
+
+def test_find_chunks_skips_overlaps():
+    content = f"[1]\n{LONG_CHUNK}\n\n[2]\n2"
+    spans = data_tracking.find_chunks(content=content, chunk_texts=[LONG_CHUNK, "2"])
+
+    assert (4, LONG_CHUNK) in spans
+    for start, text in spans:
+        assert content[start : start + len(text)] == text
+    ends = [start + len(text) for start, text in spans]
+    assert all(end <= next_start for end, (next_start, _) in zip(ends, spans[1:]))
+
+
+@pytest.mark.parametrize(
+    "bad_sql",
+    ["INSERT INTO missing_table VALUES (1)", "INSERT INTO chatbot (id) VALUES (1)"],
+)
+def test_failed_write_only_drops_the_failing_statement(tmp_path, monkeypatch, bad_sql):
+    path = str(tmp_path / "chatbot_data.db")
+    monkeypatch.setattr(data_tracking, "TRACKING_DB_PATH", path)
+    monkeypatch.setattr(data_tracking, "WRITE_RETRY_DELAY", 0.0)
+    data_tracking.manage_tracking_db().close()
+    insert = "INSERT INTO chatbot (id, query_timestamp, user_query) VALUES (?, '2026-01-01', 'q')"
+
+    con = data_tracking.connect(path=path)
+    data_tracking.TrackingWriter._write_batch(
+        connection=con,
+        writes=[
+            (insert, (1,)),
+            (bad_sql, ()),
+            [(insert, (2,)), (insert, (3,))],
+            # A transaction that fails as a whole is still rolled back as a whole
+            [(insert, (4,)), (insert, (1,))],
+        ],
+    )
+    ids = [row[0] for row in con.execute("SELECT id FROM chatbot ORDER BY id")]
+    con.close()
+
+    assert ids == [1, 2, 3]
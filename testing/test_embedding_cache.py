@@ -0,0 +1,79 @@
+# Tests that the embedding cache returns the right vector for every text, also when several processes share it
+
+import multiprocessing
+import sqlite3
+
+import numpy as np
+
+from backend import embedding_cache
+from backend.embedding_cache import EmbeddingCache
+
+DIM = 8
+
+
+def vector(text: str) -> np.ndarray:
+    """Embedding that identifies its text, e.g. [1002, 1002, ...] for "1-2" """
+    process, i = text.split("-")
+    return np.full(DIM, int(process) * 1000 + int(i), dtype=np.float32)
+
+
+def assert_cached_correctly(cache: EmbeddingCache, texts: list) -> None:
+    """Each text is either not cached or cached with its own vector"""
+    for text, embedding in zip(texts, cache.get_many(texts=texts)):
+        if embedding is not None:
+            np.testing.assert_array_equal(embedding, vector(text))
+
+
+def fill_cache(path: str, process: int) -> None:
+    """Put and look up texts one at a time in a cache shared with other processes"""
+    cache = EmbeddingCache(path=path, dim=DIM, max_entries=64)
+    texts = [f"{process}-{i}" for i in range(100)]
+    for text in texts:
+        cache.put_many(texts=[text], embeddings=[vector(text)])
+        assert_cached_correctly(cache=cache, texts=texts)
+
+
+def test_processes_share_the_cache(tmp_path):
+    path = str(tmp_path / "embedding_cache")
+    EmbeddingCache(path=path, dim=DIM, max_entries=64)
+
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=fill_cache, args=(path, process))
+        for process in range(1, 5)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+
+    assert [process.exitcode for process in processes] == [0] * len(processes)
+    cache = EmbeddingCache(path=path, dim=DIM, max_entries=64)
+    texts = [f"{process}-{i}" for process in range(1, 5) for i in range(100)]
+    assert_cached_correctly(cache=cache, texts=texts)
+    assert sum(embedding is not None for embedding in cache.get_many(texts=texts)) == 64
+
+
+def test_lookups_refresh_recency_lazily(tmp_path, monkeypatch):
+    path = str(tmp_path / "embedding_cache")
+    cache = EmbeddingCache(path=path, dim=DIM, max_entries=2)
+    cache.put_many(texts=["1-1", "1-2"], embeddings=[vector("1-1"), vector("1-2")])
+
+    def last_used() -> dict:
+        con = sqlite3.connect(f"{path}/index.sqlite3")
+        rows = dict(con.execute("SELECT hash, last_used FROM entries"))
+        con.close()
+        return rows
+
+    # A lookup right after the put doesn't write to the index
+    before = last_used()
+    cache.get_many(texts=["1-1"])
+    assert last_used() == before
+
+    # Once the recorded time is old enough, a lookup makes the entry the most recently used
+    monkeypatch.setattr(embedding_cache, "LAST_USED_UPDATE_INTERVAL", 0.0)
+    cache.get_many(texts=["1-1"])
+    cache.put_many(texts=["1-3"], embeddings=[vector("1-3")])
+
+    assert cache.get_many(texts=["1-1", "1-2", "1-3"])[1] is None
+    assert_cached_correctly(cache=cache, texts=["1-1", "1-2", "1-3"])
@@ -0,0 +1,48 @@
+# Tests that the stand-in Ollama server answers like Ollama and adds no latency of its own
+
+import json
+import socket
+
+import httpx
+
+from testing.fake_ollama import FakeOllamaServer
+
+REQUEST = {"model": "m", "messages": [{"role": "user", "content": "hi"}]}
+
+
+def test_responses_are_sent_without_delay(monkeypatch):
+    server = FakeOllamaServer(token_latency=0.0, response_tokens=3)
+    # Record whether Nagle's algorithm is off on each connection, since it would delay every response by the
+    # client's delayed ACK
+    handler = server._httpd.RequestHandlerClass
+    setup = handler.setup
+    no_delay = []
+
+    def record_setup(self):
+        setup(self)
+        no_delay.append(
+            self.connection.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        )
+
+    monkeypatch.setattr(handler, "setup", record_setup)
+    server.start()
+    try:
+        with httpx.Client() as client:
+            response = client.post(
+                f"{server.url}/api/chat", json={**REQUEST, "stream": False}
+            ).json()
+            with client.stream(
+                "POST", f"{server.url}/api/chat", json={**REQUEST, "stream": True}
+            ) as stream:
+                chunks = [json.loads(line) for line in stream.iter_lines()]
+    finally:
+        server.stop()
+
+    assert no_delay and all(no_delay)
+    assert response["done"] and response["message"]["content"] == "".join(
+        server.tokens()
+    )
+    assert [chunk["done"] for chunk in chunks] == [False, False, False, True]
+    assert "".join(chunk["message"]["content"] for chunk in chunks) == "".join(
+        server.tokens()
+    )
@@ -0,0 +1,136 @@
+# Tests BM25 keyword search, its translation of Chroma where clauses, and the fusion with vector search results
+
+import pytest
+
+from backend.chatbot import fuse_results, RRF_K
+from backend.lexical_index import LexicalIndex, where_to_sql
+
+CHUNKS = {
+    "her2": ("a.pdf", 1, "The HER-2/neu gene is amplified in breast cancer"),
+    "survival": ("a.pdf", 2, "Breast cancer survival and relapse"),
+    "cancer": ("b.pdf", 3, "Cancer cells, cancer genes, and cancer patients"),
+    "pasta": ("b.pdf", 4, "Cooking pasta in salted water"),
+}
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = LexicalIndex(path=str(tmp_path / "bm25.sqlite3"))
+    index.add(
+        ids=list(CHUNKS),
+        documents=[text for _, _, text in CHUNKS.values()],
+        metadatas=[
+            {"filename": filename, "page_number": page}
+            for filename, page, _ in CHUNKS.values()
+        ],
+    )
+    return index
+
+
+def ranked_ids(index: LexicalIndex, query: str, where: dict = None) -> list:
+    return [
+        chunk_id for chunk_id, _ in index.search(query=query, n_results=10, where=where)
+    ]
+
+
+def test_bm25_ranking(index):
+    # Compound terms match whole and by their parts
+    assert ranked_ids(index=index, query="HER-2/neu") == ["her2"]
+    assert ranked_ids(index=index, query="her2neu neu") == ["her2"]
+    # Repeated terms score higher, and chunks without any query term are left out
+    assert ranked_ids(index=index, query="cancer") == ["cancer", "survival", "her2"]
+    # A rare term outweighs a common one
+    assert ranked_ids(index=index, query="cancer relapse")[0] == "survival"
+    # Stopwords alone match nothing
+    assert ranked_ids(index=index, query="what is the") == []
+    assert index.count() == len(CHUNKS)
+
+
+def test_bm25_search_filters(index):
+    where = {
+        "$and": [
+            {"filename": {"$in": ["a.pdf"]}},
+            {"page_number": {"$gte": 2}},
+        ]
+    }
+    assert ranked_ids(index=index, query="cancer", where=where) == ["survival"]
+    assert ranked_ids(index=index, query="cancer", where={"filename": "b.pdf"}) == [
+        "cancer"
+    ]
+
+    index.delete_file(filename="b.pdf")
+    assert ranked_ids(index=index, query="cancer") == ["survival", "her2"]
+    assert index.count() == 2
+
+
+def test_where_to_sql():
+    assert where_to_sql(
+        where={
+            "$and": [
+                {"filename": {"$in": ["a.pdf", "b.pdf"]}},
+                {"page_number": {"$gte": 2, "$lte": 5}},
+            ]
+        }
+    ) == (
+        "(c.filename IN (?,?) AND c.page_number >= ? AND c.page_number <= ?)",
+        ["a.pdf", "b.pdf", 2, 5],
+    )
+    assert where_to_sql(where={"$or": [{"filename": "a.pdf"}, {"page_number": 1}]}) == (
+        "(c.filename = ? OR c.page_number = ?)",
+        ["a.pdf", 1],
+    )
+    with pytest.raises(ValueError):
+        where_to_sql(where={"source": "a.pdf"})
+    with pytest.raises(ValueError):
+        where_to_sql(where={"page_number": {"$contains": 1}})
+
+
+class FakeCollection:
+    """Vectorstore holding the chunks that only keyword search found"""
+
+    def get(self, ids: list, include: list) -> dict:
+        return {
+            "ids": ids,
+            "documents": [f"text {chunk_id}" for chunk_id in ids],
+            "metadatas": [{"chunk": chunk_id} for chunk_id in ids],
+        }
+
+
+def vector_results(ids: list) -> dict:
+    return {
+        "ids": [ids],
+        "documents": [[f"text {chunk_id}" for chunk_id in ids]],
+        "metadatas": [[{"chunk": chunk_id} for chunk_id in ids]],
+        "distances": [[0.1] * len(ids)],
+    }
+
+
+def test_rrf_ranks_chunks_found_by_both_searches_first():
+    context = fuse_results(
+        index=FakeCollection(),
+        vector_results=vector_results(ids=["a", "b"]),
+        keyword_ids=["b", "c"],
+        n_results=3,
+    )
+
+    assert context["ids"] == [["b", "a", "c"]]
+    assert context["documents"] == [["text b", "text a", "text c"]]
+    assert context["metadatas"][0][2] == {"chunk": "c"}
+    best_score = 1 / (RRF_K + 2) + 1 / (RRF_K + 1)
+    assert context["distances"][0][0] == pytest.approx(
+        1 - best_score / (2 / (RRF_K + 1))
+    )
+    assert context["distances"][0] == sorted(context["distances"][0])
+
+
+def test_rrf_ties_keep_the_vector_result_first():
+    context = fuse_results(
+        index=FakeCollection(),
+        vector_results=vector_results(ids=["a", "b"]),
+        keyword_ids=["c", "d"],
+        n_results=3,
+    )
+
+    # Equal ranks in either list score the same, and the vector result comes first
+    assert context["ids"] == [["a", "c", "b"]]
+    assert context["distances"][0][0] == context["distances"][0][1]
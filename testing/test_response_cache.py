@@ -0,0 +1,120 @@
+# Tests eviction, expiry, similarity matches, and invalidation of the response cache
+
+import numpy as np
+
+from backend.response_cache import ResponseCache
+
+CHUNKS = ["a.pdf:1:0", "a.pdf:2:0"]
+
+
+class Clock:
+    """Clock that only moves when the test advances it"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def put(cache: ResponseCache, query: str, response: str, **kwargs) -> None:
+    cache.put(
+        model="m",
+        retrieval_query=query,
+        chunk_ids=kwargs.pop("chunk_ids", CHUNKS),
+        index_version=kwargs.pop("index_version", "v1"),
+        response=response,
+        **kwargs,
+    )
+
+
+def get(cache: ResponseCache, query: str, **kwargs):
+    return cache.get(
+        model=kwargs.pop("model", "m"),
+        retrieval_query=query,
+        chunk_ids=kwargs.pop("chunk_ids", CHUNKS),
+        index_version=kwargs.pop("index_version", "v1"),
+        **kwargs,
+    )
+
+
+def test_exact_matches_ignore_case_whitespace_and_punctuation():
+    cache = ResponseCache()
+    put(cache=cache, query="What is HER-2?", response="A gene")
+
+    assert get(cache=cache, query="  what is   her-2 ") == "A gene"
+    assert get(cache=cache, query="What is HER-2?", model="other") is None
+    assert get(cache=cache, query="What is HER-2?", chunk_ids=CHUNKS[::-1]) is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2)
+    put(cache=cache, query="first", response="1")
+    put(cache=cache, query="second", response="2")
+    # Using the first entry makes the second one the least recently used
+    assert get(cache=cache, query="first") == "1"
+    put(cache=cache, query="third", response="3")
+
+    assert get(cache=cache, query="second") is None
+    assert get(cache=cache, query="first") == "1"
+    assert get(cache=cache, query="third") == "3"
+
+
+def test_entries_expire_after_the_ttl():
+    clock = Clock()
+    cache = ResponseCache(ttl=60, clock=clock)
+    put(cache=cache, query="question", response="answer")
+
+    clock.now += 60
+    assert get(cache=cache, query="question") == "answer"
+    clock.now += 1
+    assert get(cache=cache, query="question") is None
+    # The expired entry is gone, also when the clock is set back
+    clock.now -= 61
+    assert get(cache=cache, query="question") is None
+
+
+def test_similar_queries_reuse_a_response():
+    cache = ResponseCache(similarity_threshold=0.95)
+    put(
+        cache=cache,
+        query="What does HER-2 predict?",
+        response="Survival",
+        query_embedding=np.array([1.0, 0.0]),
+    )
+
+    similar = np.array([0.99, 0.1])
+    different = np.array([0.5, 0.5])
+    assert get(cache=cache, query="HER-2 predicts what", query_embedding=similar) == (
+        "Survival"
+    )
+    assert get(cache=cache, query="HER-2 predicts", query_embedding=different) is None
+    # Only responses from the same chunks are reused
+    assert (
+        get(
+            cache=cache,
+            query="HER-2 predicts what",
+            query_embedding=similar,
+            chunk_ids=CHUNKS[:1],
+        )
+        is None
+    )
+    assert (
+        get(
+            cache=ResponseCache(similarity_threshold=None),
+            query="HER-2 predicts what",
+            query_embedding=similar,
+        )
+        is None
+    )
+
+
+def test_new_index_version_clears_the_cache():
+    cache = ResponseCache()
+    put(cache=cache, query="question", response="old answer")
+
+    assert get(cache=cache, query="question", index_version="v2") is None
+    put(cache=cache, query="question", response="new answer", index_version="v2")
+    assert get(cache=cache, query="question", index_version="v2") == "new answer"
+    # Returning to the old version doesn't bring old responses back
+    assert get(cache=cache, query="question", index_version="v1") is None
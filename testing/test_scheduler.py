@@ -0,0 +1,83 @@
+# Tests that a cancelled request stops streaming and closes its request to the LLM server
+
+import threading
+
+from backend import chat_history, llm_client
+from backend.scheduler import RequestScheduler
+
+
+class FakeClient:
+    """Ollama client whose streamed chat responses record whether they were closed"""
+
+    def __init__(self):
+        self.closed = False
+        # Kept, so the response is only closed explicitly and not when it is garbage collected
+        self.streams = []
+
+    def chat(self, **kwargs):
+        stream = self.stream()
+        self.streams.append(stream)
+        return stream
+
+    def stream(self):
+        try:
+            for i in range(100):
+                yield i
+        finally:
+            self.closed = True
+
+
+def test_cancelled_stream_closes_the_llm_request(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(llm_client, "get_client", lambda: client)
+    scheduler = RequestScheduler()
+    ticket = scheduler.submit(session_id="session", model="m")
+    assert ticket.wait(timeout=1)
+
+    chunks = llm_client.chat_stream(model="m", messages=[], options={})
+    stream = ticket.guard(stream=chunks)
+    assert [next(stream), next(stream)] == [0, 1]
+    # A newer request from the same session cancels this one
+    scheduler.submit(session_id="session", model="m")
+
+    assert list(stream) == []
+    assert client.closed
+    ticket.release()
+
+
+def test_abandoned_stream_closes_the_llm_request(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(llm_client, "get_client", lambda: client)
+    ticket = RequestScheduler().submit(session_id="session", model="m")
+
+    chunks = llm_client.chat_stream(model="m", messages=[], options={})
+    stream = ticket.guard(stream=chunks)
+    assert next(stream) == 0
+    stream.close()
+
+    assert client.closed
+    ticket.release()
+
+
+def test_history_summary_waits_for_a_place(monkeypatch):
+    scheduler = RequestScheduler()
+    monkeypatch.setattr(chat_history, "get_scheduler", lambda: scheduler)
+    started = threading.Event()
+    monkeypatch.setattr(
+        chat_history, "summarize", lambda **kwargs: started.set() or "summary"
+    )
+    ticket = scheduler.submit(session_id="session", model="m")
+
+    thread = threading.Thread(
+        target=chat_history.refresh_summary,
+        kwargs={"key": "key", "summary": None, "messages": [], "model": "m"},
+    )
+    thread.start()
+    # The chat response holds the model's only place
+    assert not started.wait(timeout=0.2)
+    ticket.release()
+    thread.join(timeout=1)
+
+    assert started.is_set()
+    assert chat_history._summaries.pop("key") == "summary"
+    assert not scheduler.sessions